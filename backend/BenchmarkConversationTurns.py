@@ -0,0 +1,91 @@
+"""
+per-turn write cost of a long conversation, appended turn rows against rewriting the JSON history
+
+python BenchmarkConversationTurns.py                        200 turns, 5 conversations
+python BenchmarkConversationTurns.py --turns 1000 --answer-chars 4000
+
+every turn stores a question and an answer: once with Database.append_conversation_turns, and once the way
+raw_conversation was written before, the whole history read back, extended and stored again as one JSON
+value; reports the write time and the bytes written per turn at points along the conversation, averaged
+over a window of turns and the conversations. The rewrite grows with the turn number, the append should not;
+runs in a temporary directory and leaves nothing behind
+
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+
+from BenchmarkRetrieval import FILLER, TOPICS
+from Database import Conversation, Database
+
+def append_by_rewrite(db, conversation_id, turns):
+    # the write append_conversation_turns replaced, returns the bytes of the stored value
+    with db.session_scope() as session:
+        conversation = session.query(Conversation).filter_by(conversation_id=conversation_id).first()
+        conversation.raw_conversation = (conversation.raw_conversation or []) + turns
+        session.commit()
+        return len(json.dumps(conversation.raw_conversation))
+
+def append_by_rows(db, conversation_id, turns):
+    db.append_conversation_turns(conversation_id, turns)
+    return sum(len(turn["content"]) for turn in turns)
+
+def run(workdir, args):
+    random.seed(args.seed)
+    db = Database(f"sqlite:///{os.path.join(workdir, 'database.db')}")
+    db.add_user("benchmark")
+    db.add_collection("benchmark", "benchmark", "benchmark")
+    words = FILLER + [word for topic in TOPICS.values() for word in topic]
+    text = lambda chars: " ".join(random.choices(words, k=chars // 6))[:chars]
+    checkpoints = sorted({1, *range(args.every, args.turns + 1, args.every)})
+
+    results = {}
+    for label, append in (("json rewrite", append_by_rewrite), ("turn rows", append_by_rows)):
+        seconds = {turn: [] for turn in range(1, args.turns + 1)}
+        written = {turn: [] for turn in range(1, args.turns + 1)}
+        for index in range(args.conversations):
+            conversation_id = f"{label}-{index}"
+            db.add_conversation(conversation_id, "benchmark", "benchmark")
+            append(db, conversation_id, [{"role": "system", "content": "You are a helpful knowledge retrieval agent."}])
+            for turn in range(1, args.turns + 1):
+                turns = [{"role": "user", "content": text(args.question_chars)}, {"role": "assistant", "content": text(args.answer_chars)}]
+                started = time.perf_counter()
+                written[turn].append(append(db, conversation_id, turns))
+                seconds[turn].append(time.perf_counter() - started)
+        results[label] = (seconds, written)
+
+    print(f"{'turn':>5}  " + "  ".join(f"{label + ' ms':>16} {label + ' KB':>16}" for label in results))
+    for checkpoint in checkpoints:
+        window = range(max(1, checkpoint - args.window + 1), checkpoint + 1)
+        row = []
+        for seconds, written in results.values():
+            row.append(f"{statistics.mean(value for turn in window for value in seconds[turn]) * 1000:16.2f}")
+            row.append(f"{statistics.mean(value for turn in window for value in written[turn]) / 1024:16.1f}")
+        print(f"{checkpoint:5}  " + "  ".join(f"{row[position]} {row[position + 1]}" for position in range(0, len(row), 2)))
+    for label, (seconds, written) in results.items():
+        total_seconds = sum(sum(values) for values in seconds.values()) / args.conversations
+        total_written = sum(sum(values) for values in written.values()) / args.conversations
+        print(f"{label:12}  {total_seconds:.2f}s and {total_written / 2**20:.1f} MB written per conversation of {args.turns} turns")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--conversations", type=int, default=5)
+    parser.add_argument("--question-chars", type=int, default=200)
+    parser.add_argument("--answer-chars", type=int, default=1500)
+    parser.add_argument("--every", type=int, default=25)
+    parser.add_argument("--window", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="conversation-turns-benchmark-")
+    try:
+        run(workdir, args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
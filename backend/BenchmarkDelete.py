@@ -0,0 +1,113 @@
+"""
+deletion benchmark, the per-row deletes that were replaced against the bulk deletes, on a generated collection
+
+python BenchmarkDelete.py                                  2000 documents of 10 chunks, 200 conversations of 20 messages
+python BenchmarkDelete.py --documents 10000 --conversations 1000
+
+two identical collections are generated, one is removed the old way and one the new way:
+  vectors of documents    one chroma delete per document against one delete with a document_id $in filter
+  vector partition        the same per-document loop over every document against dropping the partition
+  sql collection          every document, conversation, turn and message loaded and deleted as an object,
+                          a commit per conversation, against Database.remove_collection's set-based deletes
+chunks get random vectors, no embedding model is loaded; runs in a temporary directory and leaves nothing behind
+
+"""
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+import uuid
+
+from Database import Collection, Conversation, ConversationTurn, Database, Document, Message
+from Embeddings import EmbeddingHandler
+
+def generate(db, embedding_handler, collection_id, args):
+    random.seed(args.seed)
+    db.add_collection("benchmark", collection_id, collection_id)
+    document_ids = [str(uuid.uuid4()) for _ in range(args.documents)]
+    with db.session_scope() as session:
+        session.add_all(Document(document_id=document_id, title=f"document {index}", content="x" * 2000, collection_id=collection_id)
+                        for index, document_id in enumerate(document_ids))
+        for _ in range(args.conversations):
+            conversation_id = str(uuid.uuid4())
+            session.add(Conversation(conversation_id=conversation_id, collection_id=collection_id, user_id="benchmark", title="New chat"))
+            session.add_all(Message(message_id=str(uuid.uuid4()), text="y" * 500, is_user=index % 2 == 0, is_complete=True, conversation_id=conversation_id)
+                            for index in range(args.messages))
+            session.add_all(ConversationTurn(conversation_id=conversation_id, position=index, role="user", content="y" * 500)
+                            for index in range(args.messages))
+
+    partition = embedding_handler.get_partition(collection_id)
+    chunks = [(f"{document_id}-{index}", document_id) for document_id in document_ids for index in range(args.chunks)]
+    for start in range(0, len(chunks), 5000):
+        batch = chunks[start:start + 5000]
+        partition.add(ids=[chunk_id for chunk_id, _ in batch],
+                      embeddings=[[random.random() for _ in range(args.dimensions)] for _ in batch],
+                      documents=["chunk text"] * len(batch),
+                      metadatas=[{"document_id": document_id, "collection_id": collection_id, "filename": "generated"} for _, document_id in batch])
+    return document_ids
+
+def remove_collection_per_row(db, collection_id):
+    # the removal remove_collection replaced, every row is loaded as an object and deleted on its own
+    with db.session_scope() as session:
+        for document in session.query(Document).filter_by(collection_id=collection_id).all():
+            session.delete(document)
+        for conversation in session.query(Conversation).filter_by(collection_id=collection_id).all():
+            for message in session.query(Message).filter_by(conversation_id=conversation.conversation_id).all():
+                session.delete(message)
+            for turn in session.query(ConversationTurn).filter_by(conversation_id=conversation.conversation_id).all():
+                session.delete(turn)
+            session.delete(conversation)
+            session.commit()
+        session.delete(session.query(Collection).filter_by(collection_id=collection_id).first())
+        session.commit()
+
+def timed(work):
+    started = time.perf_counter()
+    work()
+    return time.perf_counter() - started
+
+def report(name, before, after):
+    print(f"{name:22}  per-row {before:8.2f}s  bulk {after:8.3f}s  ({before / max(after, 1e-9):.0f}x)")
+
+def run(workdir, args):
+    db = Database(f"sqlite:///{os.path.join(workdir, 'database.db')}")
+    db.add_user("benchmark")
+    embedding_handler = EmbeddingHandler(db, persist_directory=os.path.join(workdir, "chromadb"), reranker="none")
+    started = time.perf_counter()
+    old_ids = generate(db, embedding_handler, "old", args)
+    new_ids = generate(db, embedding_handler, "new", args)
+    print(f"Generated two collections of {args.documents} documents, {args.documents * args.chunks} chunks and "
+          f"{args.conversations} conversations of {args.messages} messages in {time.perf_counter() - started:.1f}s")
+
+    # half of the documents on their own, then whatever is left in the partition
+    old_partition, new_partition = embedding_handler.get_partition("old"), embedding_handler.get_partition("new")
+    half = args.documents // 2
+    before = timed(lambda: [old_partition.delete(where={"document_id": document_id}) for document_id in old_ids[:half]])
+    after = timed(lambda: new_partition.delete(where={"document_id": {"$in": new_ids[:half]}}))
+    report(f"vectors of {half} docs", before, after)
+    before = timed(lambda: [old_partition.delete(where={"document_id": document_id}) for document_id in old_ids[half:]])
+    after = timed(lambda: embedding_handler.remove_collection("new"))
+    report("vector partition", before, after)
+
+    before = timed(lambda: remove_collection_per_row(db, "old"))
+    after = timed(lambda: db.remove_collection("new"))
+    report("sql collection", before, after)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--documents", type=int, default=2000)
+    parser.add_argument("--chunks", type=int, default=10)
+    parser.add_argument("--conversations", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--dimensions", type=int, default=384)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="delete-benchmark-")
+    try:
+        run(workdir, args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
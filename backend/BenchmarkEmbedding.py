@@ -0,0 +1,53 @@
+"""
+ingest embedding throughput benchmark, chunks per second by embedding batch size and worker count
+
+python BenchmarkEmbedding.py                                  2000 chunks, batch sizes 32 128 512, 1 2 and all cores
+python BenchmarkEmbedding.py --chunks 10000 --batch-sizes 64 256 --workers 1 4 8
+
+chunks are generated like in BenchmarkRetrieval.py; every configuration is warmed up first so worker start-up and
+model loading are not counted, and only embedding is timed, the chroma writes are the same whatever the configuration;
+runs in a temporary directory and leaves nothing behind
+
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from BenchmarkRetrieval import generate_corpus
+from Embeddings import EmbeddingHandler
+
+def run(workdir, texts, batch_size, workers):
+    embedding_handler = EmbeddingHandler(None, persist_directory=os.path.join(workdir, "chromadb"), reranker="none",
+                                         embed_batch_size=batch_size, embed_workers=workers)
+    try:
+        # one batch per worker brings every worker up and loads its model
+        for _ in embedding_handler.embed(texts[:batch_size * workers]):
+            pass
+        started = time.perf_counter()
+        embedded = sum(len(batch) for batch in embedding_handler.embed(texts))
+        seconds = time.perf_counter() - started
+    finally:
+        if embedding_handler.embed_pool is not None:
+            embedding_handler.embed_pool.shutdown()
+    print(f"batch {batch_size:5}  workers {workers:3}  {embedded / seconds:8.1f} chunks/s  ({embedded} chunks in {seconds:.1f}s)")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, default=2000)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[32, 128, 512])
+    parser.add_argument("--workers", type=int, nargs="+", default=sorted({1, 2, os.cpu_count() or 1}))
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    # longer chunks than the retrieval benchmark, closer to the chunk_size the upload handler produces
+    texts = [" ".join(text for text, _, _ in corpus) for corpus in zip(*[generate_corpus(args.chunks, args.seed + offset) for offset in range(4)])]
+    workdir = tempfile.mkdtemp(prefix="embedding-benchmark-")
+    try:
+        for workers in args.workers:
+            for batch_size in args.batch_sizes:
+                run(workdir, texts, batch_size, workers)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,89 @@
+"""
+prompt size over a long conversation, the whole history against the packed prompt with a rolling summary
+
+python BenchmarkHistory.py                              50 turns, summaries take 2s
+python BenchmarkHistory.py --turns 200 --summary-delay 5
+
+every turn is stored like the chat endpoint stores it, the summary is folded by the background SummaryQueue
+while the next question is already being asked; the llm is replaced by canned answers and a canned summary
+that takes --summary-delay seconds, so the numbers are estimated prompt tokens, not model timings.
+The packed prompt should stay flat once the recent window is full while the whole history keeps growing;
+runs in a temporary directory and leaves nothing behind
+
+"""
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from BenchmarkRetrieval import FILLER, TOPICS, generate_corpus
+from Database import Database
+from HistoryManager import HistoryManager
+from SummaryQueue import SummaryQueue
+
+class CannedSummaries:
+    # stands in for LLMInteraction, the summary is about as long as the 150 words the real prompt asks for
+    def __init__(self, delay):
+        self.delay = delay
+
+    def generate_summary(self, previous_summary, turns, model=None):
+        time.sleep(self.delay)
+        return " ".join(random.choices(FILLER, k=150))
+
+def run(workdir, args):
+    random.seed(args.seed)
+    db = Database(f"sqlite:///{os.path.join(workdir, 'database.db')}")
+    db.add_user("benchmark")
+    db.add_collection("benchmark", "benchmark", "benchmark")
+    db.add_conversation("conversation", "benchmark", "benchmark")
+    history_manager = HistoryManager(CannedSummaries(args.summary_delay))
+    summary_queue = SummaryQueue(history_manager, db)
+    system_message = {"role": "system", "content": "You are a helpful knowledge retrieval agent."}
+    db.append_conversation_turns("conversation", [system_message])
+    words = FILLER + [word for topic in TOPICS.values() for word in topic]
+    context = "\n".join(text for text, _, _ in generate_corpus(args.context_chunks, args.seed))
+
+    print(f"{'turn':>5} {'whole history':>14} {'packed prompt':>14} {'summarized':>11}")
+    packed_sizes = []
+    for turn in range(1, args.turns + 1):
+        conversation_history = db.get_conversation_raw("conversation")
+        summary, summarized_messages = db.get_conversation_summary("conversation")
+        query = " ".join(random.choices(words, k=20))
+        prompt = context + query
+        whole = sum(history_manager.estimate_tokens(message["content"]) for message in conversation_history) + history_manager.estimate_tokens(prompt)
+        packed = sum(history_manager.estimate_tokens(message["content"]) for message in history_manager.build_prompt(conversation_history, summary, summarized_messages, prompt, args.model))
+        packed_sizes.append(packed)
+        if turn == 1 or turn % args.every == 0:
+            print(f"{turn:5} {whole:14} {packed:14} {summarized_messages:11}")
+
+        answer = " ".join(random.choices(words, k=args.answer_words))
+        new_turns = [{"role": "user", "content": query}, {"role": "assistant", "content": answer}]
+        db.append_conversation_turns("conversation", new_turns)
+        if history_manager.messages_to_fold(conversation_history + new_turns, summarized_messages):
+            summary_queue.submit("conversation", args.model)
+        time.sleep(args.turn_interval)
+
+    settled = packed_sizes[len(packed_sizes) // 2:]
+    print(f"packed prompt over the second half: min {min(settled)}, max {max(settled)} tokens (budget {history_manager.model_budgets.get(args.model, history_manager.default_budget)})")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=50)
+    parser.add_argument("--answer-words", type=int, default=200)
+    parser.add_argument("--context-chunks", type=int, default=5)
+    parser.add_argument("--summary-delay", type=float, default=2.0)
+    # time between a stored answer and the next question, the summary worker runs meanwhile
+    parser.add_argument("--turn-interval", type=float, default=1.0)
+    parser.add_argument("--model", default="llama3:instruct")
+    parser.add_argument("--every", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="history-benchmark-")
+    try:
+        run(workdir, args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
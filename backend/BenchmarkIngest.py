@@ -0,0 +1,115 @@
+"""
+zip ingest throughput benchmark, files and megabytes per second of parsing and chunking html members
+
+python BenchmarkIngest.py                                  3000 html files, inline and on 1, 2 and all cores
+python BenchmarkIngest.py --files 10000 --workers 4 8
+python BenchmarkIngest.py --embed                          also the whole ingest, parse, embed and write
+
+writes a zip of generated html pages and reads it back with UploadHandler.iter_segments; inline is the member by
+member parsing in the server process that the parse pool replaced, the pool rows go through
+EmbeddingHandler.parse_files. The pool is started and warmed up before it is timed; --embed runs
+IngestionPipeline.ingest_segments end to end and needs the embedding model;
+runs in a temporary directory and leaves nothing behind
+
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import shutil
+import tempfile
+import time
+import zipfile
+
+from BenchmarkRetrieval import FILLER, TOPICS
+from Database import Database
+from Embeddings import EmbeddingHandler
+from IngestionJobs import IngestionJob, IngestionPipeline
+
+def write_archive(path, files, paragraphs, seed):
+    random.seed(seed)
+    words = FILLER + [word for topic in TOPICS.values() for word in topic]
+    sentence = lambda: " ".join(random.choices(words, k=15)).capitalize() + "."
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        for index in range(files):
+            body = "".join(f"<h2>{' '.join(random.choices(words, k=4))}</h2>\n<p>{' '.join(sentence() for _ in range(6))}</p>\n"
+                           f"<ul><li><a href=\"/page/{random.randint(0, files)}\">{random.choice(words)}</a></li></ul>\n"
+                           for _ in range(paragraphs))
+            archive.writestr(f"pages/page-{index}.html", f"<html><head><title>page {index}</title></head><body>\n{body}</body></html>\n")
+
+def report(label, files, size, seconds):
+    print(f"{label:12}  {files / seconds:8.1f} files/s  {size / seconds / 2**20:6.2f} MB/s  ({files} files in {seconds:.1f}s)")
+
+def segments(embedding_handler, path):
+    return embedding_handler.upload_handler.iter_segments(path, "archive.zip", embedding_handler.segment_bytes)
+
+def run_inline(embedding_handler, path):
+    files, size = 0, 0
+    started = time.perf_counter()
+    for name, data, _, _, url_list in segments(embedding_handler, path):
+        result = embedding_handler.upload_handler.handle_file(data, name, url_list)
+        if result[0] != "success":
+            raise RuntimeError(result[1])
+        files, size = files + 1, size + len(data)
+    report("inline", files, size, time.perf_counter() - started)
+
+def run_pool(workdir, path, workers):
+    embedding_handler = EmbeddingHandler(None, persist_directory=os.path.join(workdir, "chromadb"), reranker="none", parse_workers=workers)
+    try:
+        # a few files per worker bring every worker up before the clock starts
+        for _ in embedding_handler.parse_files(segment for _, segment in zip(range(workers * 4), segments(embedding_handler, path))):
+            pass
+        files, size = 0, 0
+        started = time.perf_counter()
+        for (name, data, _, _, _), result in embedding_handler.parse_files(segments(embedding_handler, path)):
+            if result[0] != "success":
+                raise RuntimeError(result[1])
+            files, size = files + 1, size + len(data)
+        report(f"{workers} workers", files, size, time.perf_counter() - started)
+    finally:
+        embedding_handler.parse_pool.shutdown()
+
+def run_embed(workdir, path):
+    db = Database(f"sqlite:///{os.path.join(workdir, 'database.db')}")
+    db.add_user("benchmark")
+    db.add_collection("benchmark", "benchmark", "benchmark")
+    embedding_handler = EmbeddingHandler(db, persist_directory=os.path.join(workdir, "chromadb"), reranker="none")
+    pipeline = IngestionPipeline(embedding_handler, db)
+    embedding_handler.embedding_function(["warm up"])
+    with zipfile.ZipFile(path) as archive:
+        files, size = len(archive.infolist()), sum(info.file_size for info in archive.infolist())
+    job = IngestionJob("zip", "archive.zip", "benchmark")
+    started = time.perf_counter()
+    # the pipeline prints per batch, the report is all that is shown
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = pipeline.ingest_segments(job, segments(embedding_handler, path), "benchmark")
+    if result[0] != "success":
+        raise RuntimeError(result[1])
+    report("end to end", files, size, time.perf_counter() - started)
+    embedding_handler.parse_pool.shutdown()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=3000)
+    parser.add_argument("--paragraphs", type=int, default=20)
+    parser.add_argument("--workers", type=int, nargs="+", default=sorted({1, 2, os.cpu_count() or 1}))
+    parser.add_argument("--embed", action="store_true")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="ingest-benchmark-")
+    try:
+        path = os.path.join(workdir, "archive.zip")
+        write_archive(path, args.files, args.paragraphs, args.seed)
+        with zipfile.ZipFile(path) as archive:
+            print(f"Archive of {args.files} html files, {sum(info.file_size for info in archive.infolist()) / 2**20:.1f} MB "
+                  f"({os.path.getsize(path) / 2**20:.1f} MB compressed)")
+        run_inline(EmbeddingHandler(None, persist_directory=os.path.join(workdir, "chromadb"), reranker="none"), path)
+        for workers in args.workers:
+            run_pool(workdir, path, workers)
+        if args.embed:
+            run_embed(workdir, path)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
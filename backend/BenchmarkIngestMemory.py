@@ -0,0 +1,122 @@
+"""
+peak memory of the streaming ingest path against the configured memory limit
+
+python BenchmarkIngestMemory.py                                   200 MB archive, 64 MB limit
+python BenchmarkIngestMemory.py --archive-mb 1024 --memory-limit-mb 128
+python BenchmarkIngestMemory.py --parse-only                      segment and parse, without embedding
+python BenchmarkIngestMemory.py --parse-workers 4
+
+writes a zip of text members, one of them a single line of --long-line-mb megabytes with no line break,
+and ingests it through IngestionPipeline.ingest_segments; reports the largest segment read, the peak
+resident memory the server process gained while ingesting, what the largest parse worker gained over a
+worker that has not parsed anything yet, and the two together (every worker counted at the largest gain)
+next to the limit. A bounded path keeps them flat while the archive grows and under the limit. Like in
+EmbeddingHandler's budget, the parsing libraries every worker loads are not counted; without --parse-only
+the server figure also holds chroma's in-memory vector index, which grows with the chunks stored whatever
+the limit, and two archive sizes tell it apart. Runs in a temporary directory and leaves nothing behind
+
+"""
+
+import argparse
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+import zipfile
+
+from BenchmarkRetrieval import FILLER, TOPICS
+from Database import Database
+from Embeddings import EmbeddingHandler
+from IngestionJobs import IngestionJob, IngestionPipeline
+
+def write_archive(path, archive_mb, member_mb, long_line_mb, seed):
+    # members are streamed into the zip line by line, the benchmark itself never holds a member in memory
+    random.seed(seed)
+    words = FILLER + [word for topic in TOPICS.values() for word in topic]
+    line = lambda: " ".join(random.choices(words, k=12)) + "\n"
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        with archive.open("long-line.txt", "w") as member:
+            for _ in range(long_line_mb * 1024):
+                member.write((" ".join(random.choices(words, k=150)) + " ").encode()[:1024].ljust(1024))
+        for index in range(max(1, (archive_mb - long_line_mb) // member_mb)):
+            with archive.open(f"member-{index}.txt", "w") as member:
+                written = 0
+                while written < member_mb * 1024 * 1024:
+                    data = "".join(line() for _ in range(100)).encode()
+                    member.write(data)
+                    written += len(data)
+
+def peak_rss(who=resource.RUSAGE_SELF) -> int:
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(who).ru_maxrss * 1024
+
+def run(workdir, args):
+    memory_limit = args.memory_limit_mb * 1024 * 1024
+    db = Database(f"sqlite:///{os.path.join(workdir, 'database.db')}")
+    db.add_user("benchmark")
+    db.add_collection("benchmark", "benchmark", "benchmark")
+    embedding_handler = EmbeddingHandler(db, persist_directory=os.path.join(workdir, "chromadb"), reranker="none", memory_limit=memory_limit,
+                                         parse_workers=args.parse_workers)
+    pipeline = IngestionPipeline(embedding_handler, db)
+
+    path = os.path.join(workdir, "archive.zip")
+    write_archive(path, args.archive_mb, args.member_mb, args.long_line_mb, args.seed)
+    print(f"Archive of {os.path.getsize(path) / 2**20:.0f} MB compressed, {args.archive_mb} MB of text, segments of {embedding_handler.segment_bytes / 2**20:.1f} MB")
+
+    if not args.parse_only:
+        # load the model before the baseline so it is not counted as ingest memory
+        embedding_handler.embedding_function(["warm up"])
+    # every worker is started, and has loaded its libraries, before the baselines are taken
+    parse_pool = embedding_handler.get_parse_pool()
+    worker_baseline = max(parse_pool.map(peak_rss, [resource.RUSAGE_SELF] * embedding_handler.parse_workers * 4))
+    largest_segment = 0
+
+    def segments():
+        nonlocal largest_segment
+        for segment in embedding_handler.upload_handler.iter_segments(path, "archive.zip", embedding_handler.segment_bytes):
+            largest_segment = max(largest_segment, len(segment[1]))
+            yield segment
+
+    baseline = peak_rss()
+    started = time.perf_counter()
+    if args.parse_only:
+        chunks = 0
+        for (name, _, _, _, _), result in embedding_handler.parse_files(segments()):
+            if result[0] != "success":
+                raise RuntimeError(result[1])
+            chunks += len(result[1])
+    else:
+        job = IngestionJob("zip", "archive.zip", "benchmark")
+        result = pipeline.ingest_segments(job, segments(), "benchmark")
+        if result[0] != "success":
+            raise RuntimeError(result[1])
+        chunks = job.chunks_embedded
+    seconds = time.perf_counter() - started
+    embedding_handler.parse_pool.shutdown()
+
+    print(f"Ingested {chunks} chunks in {seconds:.1f}s")
+    print(f"largest segment        {largest_segment / 2**20:8.1f} MB  (segment size {embedding_handler.segment_bytes / 2**20:.1f} MB)")
+    server_gain = peak_rss() - baseline
+    worker_gain = peak_rss(resource.RUSAGE_CHILDREN) - worker_baseline
+    print(f"server peak rss gain   {server_gain / 2**20:8.1f} MB")
+    print(f"largest worker gain    {worker_gain / 2**20:8.1f} MB  (over {worker_baseline / 2**20:.0f} MB before parsing)")
+    print(f"server and workers     {(server_gain + worker_gain * embedding_handler.parse_workers) / 2**20:8.1f} MB  (limit {args.memory_limit_mb} MB)")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--archive-mb", type=int, default=200)
+    parser.add_argument("--member-mb", type=int, default=20)
+    parser.add_argument("--long-line-mb", type=int, default=20)
+    parser.add_argument("--memory-limit-mb", type=int, default=64)
+    parser.add_argument("--parse-workers", type=int, default=None)
+    parser.add_argument("--parse-only", action="store_true")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="ingest-memory-benchmark-")
+    try:
+        run(workdir, args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,89 @@
+"""
+rerank latency and recall benchmark on a generated corpus, cohere against the local cross-encoder and no reranking
+
+python BenchmarkReranker.py                                      2000 chunks, 100 queries, all three backends
+python BenchmarkReranker.py --backends cross-encoder none --candidates 50 --queries 300
+
+chunks and queries are generated like in BenchmarkRetrieval.py, the candidates of every query are retrieved once
+(hybrid, --candidates of them, what retrieve_documents sends to the reranker) and every backend reranks the same
+lists; recall@k is how often the asked-for chunk is among the first k after reranking, the pool line is the best
+any reranker can do. Only the rerank call is timed. cohere needs cohere.txt and network access, the cross-encoder
+needs sentence-transformers, a backend that cannot be built is reported and skipped;
+runs in a temporary directory and leaves nothing behind
+
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import statistics
+import tempfile
+import time
+
+from BenchmarkRetrieval import generate_corpus, generate_queries
+from Database import Database
+from Embeddings import EmbeddingHandler
+from Reranker import RERANKERS, get_reranker
+
+def find_pools(embedding_handler, collection_id, corpus, queries, candidates):
+    documents = [text for text, _, _ in corpus]
+    ids = [embedding_handler.chunk_hash(text) for text in documents]
+    metadatas = [{"document_id": "benchmark", "collection_id": collection_id, "filename": "generated"} for _ in documents]
+    partition = embedding_handler.get_partition(collection_id)
+    pools = []
+    # retrieval prints every query, the report is all that is shown
+    with contextlib.redirect_stdout(io.StringIO()):
+        status, message, _ = embedding_handler.add_processed_documents(documents, ids, metadatas, collection_id)
+        if status != "success":
+            raise RuntimeError(message)
+        embedding_handler.lexical_index.build(collection_id).result()
+        for query, expected in queries:
+            query_embedding = embedding_handler.embedding_function([query])[0]
+            found = embedding_handler.find_candidates(query, query_embedding, partition, collection_id, candidates, hybrid=True)
+            pools.append((query, expected, [candidate["text"] for candidate in found]))
+    return pools
+
+def run(name, reranker, pools, ks):
+    # the first call loads models and opens connections, it is not timed
+    reranker.rerank(pools[0][0], pools[0][2], max(ks))
+    latencies, hits = [], {k: 0 for k in ks}
+    for query, expected, texts in pools:
+        started = time.perf_counter()
+        ranking = reranker.rerank(query, texts, max(ks))
+        latencies.append(time.perf_counter() - started)
+        ranked = [texts[index] for index, _ in ranking]
+        for k in ks:
+            hits[k] += expected in ranked[:k]
+    latencies.sort()
+    recall = "  ".join(f"recall@{k} {hits[k] / len(pools):.3f}" for k in ks)
+    print(f"{name:13}  {recall}  latency p50 {statistics.median(latencies) * 1000:.1f}ms  p95 {latencies[int(len(latencies) * 0.95)] * 1000:.1f}ms")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--candidates", type=int, default=30)
+    parser.add_argument("--k", type=int, nargs="+", default=[1, 3, 5])
+    parser.add_argument("--backends", nargs="+", choices=list(RERANKERS), default=list(RERANKERS))
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="reranker-benchmark-")
+    try:
+        db = Database(f"sqlite:///{os.path.join(workdir, 'database.db')}")
+        db.add_user("benchmark")
+        db.add_collection("benchmark", "benchmark", "benchmark")
+        embedding_handler = EmbeddingHandler(db, persist_directory=os.path.join(workdir, "chromadb"), reranker="none", cache_options={"max_entries": 0})
+        corpus = generate_corpus(args.chunks, args.seed)
+        pools = find_pools(embedding_handler, "benchmark", corpus, generate_queries(corpus, args.queries, args.seed), args.candidates)
+        print(f"{'pool':13}  recall@{args.candidates} {sum(expected in texts for _, expected, texts in pools) / len(pools):.3f}")
+        for name in args.backends:
+            try:
+                reranker = get_reranker(name)
+                run(name, reranker, pools, args.k)
+            except Exception as e:
+                print(f"{name:13}  skipped: {str(e)}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
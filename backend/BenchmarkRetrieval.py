@@ -0,0 +1,94 @@
+"""
+retrieval latency and recall benchmark on a generated corpus, vector only against hybrid bm25 + vector
+
+python BenchmarkRetrieval.py                          2000 chunks, 200 queries
+python BenchmarkRetrieval.py --chunks 20000 --queries 500
+
+every chunk mixes words of one topic with a few rare identifier-like terms, every query asks for
+a chunk by some of its words, and recall@k is how often that chunk is among the first k candidates,
+the ones that would be sent to the reranker; runs in a temporary directory and leaves nothing behind
+
+"""
+
+import argparse
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+
+from Database import Database
+from Embeddings import EmbeddingHandler
+
+TOPICS = {
+    "flood": "flood river levee evacuation rainfall sandbag surge basin crest overflow".split(),
+    "fire": "wildfire smoke containment firebreak ember evacuation brush crew acreage hotspot".split(),
+    "medical": "triage casualty ambulance clinic dressing oxygen fracture bleeding stretcher paramedic".split(),
+    "shelter": "shelter intake cot blanket registration capacity volunteer meal generator dormitory".split(),
+    "power": "outage substation transformer grid restoration crew feeder generator voltage lineman".split(),
+}
+FILLER = "the team reported that during the operation the area was checked again and updates were shared with the command post".split()
+
+def generate_corpus(chunks, seed):
+    # each chunk gets a topic, shared topic words, filler and two rare codes that make it findable by name
+    random.seed(seed)
+    corpus = []
+    for index in range(chunks):
+        topic = random.choice(list(TOPICS))
+        codes = [f"{topic[:3]}{index}x{random.randint(100, 999)}", f"site{random.randint(0, chunks * 10)}"]
+        words = random.sample(TOPICS[topic], 5) + random.sample(FILLER, 10) + codes
+        random.shuffle(words)
+        corpus.append((" ".join(words), codes, topic))
+    return corpus
+
+def generate_queries(corpus, queries, seed):
+    random.seed(seed + 1)
+    picked = random.sample(range(len(corpus)), min(queries, len(corpus)))
+    return [(f"what happened at {corpus[index][1][0]} with the {random.choice(TOPICS[corpus[index][2]])}", corpus[index][0]) for index in picked]
+
+def run(embedding_handler, collection_id, corpus, queries, pool_sizes):
+    documents = [text for text, _, _ in corpus]
+    ids = [embedding_handler.chunk_hash(text) for text in documents]
+    metadatas = [{"document_id": "benchmark", "collection_id": collection_id, "filename": "generated"} for _ in documents]
+    started = time.perf_counter()
+    status, message, _ = embedding_handler.add_processed_documents(documents, ids, metadatas, collection_id)
+    if status != "success":
+        raise RuntimeError(message)
+    print(f"Embedded {len(documents)} chunks in {time.perf_counter() - started:.1f}s")
+    # the bm25 index is built in the background after ingest, hybrid queries before it is done are vector only
+    embedding_handler.lexical_index.build(collection_id).result()
+
+    partition = embedding_handler.get_partition(collection_id)
+    largest = max(pool_sizes)
+    for hybrid in (False, True):
+        latencies, hits = [], {size: 0 for size in pool_sizes}
+        for query, expected in queries:
+            query_embedding = embedding_handler.embedding_function([query])[0]
+            started = time.perf_counter()
+            candidates = embedding_handler.find_candidates(query, query_embedding, partition, collection_id, largest, hybrid=hybrid)
+            latencies.append(time.perf_counter() - started)
+            texts = [candidate["text"] for candidate in candidates]
+            for size in pool_sizes:
+                hits[size] += expected in texts[:size]
+        latencies.sort()
+        recall = "  ".join(f"recall@{size} {hits[size] / len(queries):.3f}" for size in pool_sizes)
+        print(f"{'hybrid' if hybrid else 'vector':6}  {recall}  latency p50 {statistics.median(latencies) * 1000:.1f}ms  p95 {latencies[int(len(latencies) * 0.95)] * 1000:.1f}ms")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chunks", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="retrieval-benchmark-")
+    try:
+        db = Database(f"sqlite:///{os.path.join(workdir, 'database.db')}")
+        db.add_user("benchmark")
+        db.add_collection("benchmark", "benchmark", "benchmark")
+        embedding_handler = EmbeddingHandler(db, persist_directory=os.path.join(workdir, "chromadb"), reranker="none")
+        corpus = generate_corpus(args.chunks, args.seed)
+        run(embedding_handler, "benchmark", corpus, generate_queries(corpus, args.queries, args.seed), [5, 10, 30, 100])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -1,44 +1,37 @@
 from Embeddings import EmbeddingHandler
+from Database import AsyncDatabase
 from LLM import LLMInteraction
+from HistoryManager import HistoryManager
+from TitleQueue import TitleQueue
+from SummaryQueue import SummaryQueue
+from Metrics import metrics
+import asyncio
+import time
 
 class ModularChatbot:
-    def __init__(self, database, context_text=None):
+    def __init__(self, database, context_text=None, async_database=None, title_model=None, cache_options=None):
         # initialize the chatbot with a database and optional context text
         self.database = database
+        self.async_database = async_database or AsyncDatabase(database)
         self.llm_interaction = LLMInteraction()
-        self.embedding_handler = EmbeddingHandler()
+        # cache_options go to the semantic cache, {"cache_answers": True} turns on answer reuse
+        self.embedding_handler = EmbeddingHandler(database, cache_options=cache_options)
+        self.history_manager = HistoryManager(self.llm_interaction)
+        self.title_queue = TitleQueue(self.llm_interaction, database, model=title_model)
+        self.summary_queue = SummaryQueue(self.history_manager, database)
         
         # set up initial conversation history with a system message
-        self.conversation_history = [
+        self.conversation_history = self.start_conversation()
+
+    def start_conversation(self):
+        return [
             {
                 "role": "system",
                 "content": "You are a helpful knowledge retrieval agent. You are provided documents that you can use to answer user queries. You should answer the user queries only based on the provided documents, and inform the user if you either were not provided documents, or the documents do not seem to answer their question.",
             }
         ]
 
-    def handle_query(self, query, userid, conversation_id):
-        full_response = ""
-        context = None
-        # retrieve the raw conversation history from the database
-        conversation_history = self.database.get_conversation_raw(conversation_id)
-        
-        # retrieve related documents for the conversation
-        related_docs = self.database.get_documents_by_conversation(conversation_id)
-        print(f"Related docs: {related_docs}")
-        doc_ids = [doc.document_id for doc in related_docs]
-        
-        # initialize conversation history if it does not exist
-        if conversation_history is None:
-            conversation_history = [
-                {
-                    "role": "system",
-                    "content": "You are a helpful knowledge retrieval agent. You are provided documents that you can use to answer user queries. You should answer the user queries only based on the provided documents, and inform the user if you either were not provided documents, or the documents do not seem to answer their question.",
-                }
-            ]
-        # retrieve documents similar to the user's query using document IDs as filters
-        metadata_filters = {"document_id": {"$in": doc_ids}}
-        retrieval_status, retrieval_error, similar_documents = self.embedding_handler.retrieve_documents(query, metadata_filters=metadata_filters)
-
+    def build_context(self, retrieval_status, retrieval_error, similar_documents):
         # construct context from the most similar documents
         context = "<$$ THIS SIGNIFIES THE BEGINNING OF RELEVANT CONTEXTUAL DOCUMENTS $$>\n\n"
         if retrieval_status == "success" and similar_documents:
@@ -53,27 +46,102 @@ class ModularChatbot:
             context += "NO RELEVANT DOCUMENTS FOUND, INFORM THE USER\n\n"
             print("No documents found\n\n")
         context += "<$$ THIS SIGNIFIES THE END OF ATTACHED DATA AND MARKS THE BEGINNING OF USER QUERY $$>\n\n"
+        return context
 
-        # append the user's query to the conversation history
-        if context:
-            query = context + query
+    def record_cancelled(self, conversation_id, generated_tokens, max_tokens):
+        print(f"Generation cancelled for conversation ID: {conversation_id} after {generated_tokens} tokens")
+        metrics.increment("chat_cancelled_total")
+        metrics.increment("chat_cancelled_generated_tokens_total", generated_tokens)
+        # max_tokens caps the completion upstream, so what is left of it bounds the tokens the cancel saved
+        metrics.increment("chat_cancelled_saved_tokens_estimate_total", max(max_tokens - generated_tokens, 0))
 
-        conversation_history.append({"role": "user", "content": query})
+    def cached_answer(self, collection_id, query, model, first_turn, retrieval_status):
+        # whole answers are only reused for opening questions, later ones depend on the conversation so far
+        semantic_cache = self.embedding_handler.semantic_cache
+        if not first_turn or retrieval_status != "success" or not semantic_cache.cache_answers:
+            return None
+        answer = semantic_cache.get_answer(collection_id, query, model)
+        metrics.increment("semantic_cache_answer_hits_total" if answer is not None else "semantic_cache_answer_misses_total")
+        return answer
 
-        # generate responses from the LLM based on the query and context
-        for response in self.llm_interaction.generate_response(query, context, conversation=conversation_history):
-            full_response += response
-            yield response, similar_documents
+    def remember_answer(self, collection_id, query, model, first_turn, retrieval_status, answer, cache_generation):
+        if first_turn and retrieval_status == "success":
+            self.embedding_handler.semantic_cache.store_answer(collection_id, query, model, answer, cache_generation)
 
-        # append the assistant's response to the conversation history
-        conversation_history.append({"role": "assistant", "content": full_response})
+    def resolve_model(self, model, user_model):
+        # the request's model wins over the user's saved choice, which wins over the server default
+        return model or user_model or self.llm_interaction.model
 
-        # update the raw conversation history in the database
-        self.database.update_conversation_raw(conversation_id, conversation_history)
-        
-        # check if the conversation title is "New chat" and update if necessary
-        if self.database.get_conversation_title(conversation_id) == "New chat":
-            # call the LLM to generate a title based on the current conversation history
-            new_title = self.llm_interaction.generate_title(conversation_history)
-            # update the conversation title in the database
-            self.database.update_conversation_title(conversation_id, new_title)
+    async def handle_query_async(self, query, userid, conversation_id, cancel_event=None, model=None):
+        # database calls go through the async wrapper, chroma runs on a worker thread and the model is
+        # streamed with the async clients, so no thread is held while tokens arrive
+        full_response = ""
+        model = self.resolve_model(model, await self.async_database.get_user_model(userid))
+        notice = self.llm_interaction.model_unavailable_message(model)
+        if notice:
+            yield notice, []
+            return
+        with metrics.span("chat_history"):
+            conversation_history = await self.async_database.get_conversation_raw(conversation_id)
+            conversation = await self.async_database.get_conversation(conversation_id)
+            collection_id = conversation.collection_id if conversation else None
+            summary, summarized_messages = await self.async_database.get_conversation_summary(conversation_id)
+
+        new_turns = []
+        if conversation_history is None:
+            conversation_history = self.start_conversation()
+            new_turns.append(conversation_history[0])
+        first_turn = len(conversation_history) == 1
+        cache_generation = self.embedding_handler.semantic_cache.generation(collection_id)
+        with metrics.span("chat_retrieval"):
+            if collection_id is not None:
+                # chroma 0.4 only has a blocking client
+                retrieval_status, retrieval_error, similar_documents = await asyncio.to_thread(self.embedding_handler.retrieve_documents, query, collection_id)
+            else:
+                retrieval_status, retrieval_error, similar_documents = "error", f"No conversation found with ID: {conversation_id}", []
+        with metrics.span("chat_prompt"):
+            context = self.build_context(retrieval_status, retrieval_error, similar_documents)
+
+            prompt = context + query
+            prompt_messages = self.history_manager.build_prompt(conversation_history, summary, summarized_messages, prompt, model)
+
+        generated_tokens = 0
+        # sent to the model as its completion limit
+        max_tokens = 2048
+        cached_answer = self.cached_answer(collection_id, query, model, first_turn, retrieval_status)
+        if cached_answer is not None:
+            full_response = cached_answer
+            yield cached_answer, similar_documents
+        else:
+            started = time.perf_counter()
+            async for response in self.llm_interaction.generate_response_async(prompt, context, conversation=prompt_messages, model=model, max_tokens=max_tokens, cancel_event=cancel_event):
+                if generated_tokens == 0:
+                    metrics.record("chat_llm_first_token", time.perf_counter() - started)
+                full_response += response
+                generated_tokens += 1
+                yield response, similar_documents
+            metrics.record("chat_llm_stream", time.perf_counter() - started)
+
+        if cancel_event is not None and cancel_event.is_set():
+            self.record_cancelled(conversation_id, generated_tokens, max_tokens)
+            new_turns.append({"role": "user", "content": query})
+            new_turns.append({"role": "assistant", "content": full_response})
+            await self.async_database.append_conversation_turns(conversation_id, new_turns)
+            await self.async_database.add_message(conversation_id, full_response, is_user=False, is_complete=False)
+            return
+
+        new_turns.append({"role": "user", "content": query})
+        new_turns.append(self.history_manager.strip_turn({"role": "assistant", "content": full_response}))
+        conversation_history.extend(new_turns[-2:])
+        with metrics.span("chat_save"):
+            await self.async_database.append_conversation_turns(conversation_id, new_turns)
+        if cached_answer is None:
+            self.remember_answer(collection_id, query, model, first_turn, retrieval_status, full_response, cache_generation)
+
+        # messages that left the recent window are folded into the rolling summary in the background, the
+        # stream closes now and the next turn uses the summary if it is ready and the unfolded turns otherwise
+        if self.history_manager.messages_to_fold(conversation_history, summarized_messages):
+            self.summary_queue.submit(conversation_id, model)
+
+        if await self.async_database.get_conversation_title(conversation_id) == "New chat":
+            self.title_queue.submit(conversation_id, *self.title_queue.first_exchange([self.history_manager.strip_turn(message) for message in conversation_history[1:3]]), model)
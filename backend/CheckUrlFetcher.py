@@ -0,0 +1,109 @@
+"""
+checks UrlFetcher and url list uploads against a local stand-in http server
+
+python CheckUrlFetcher.py
+
+the stand-in server answers with an ETag and 304 to a matching If-None-Match, fails /flaky with 503 twice
+before it succeeds, answers /missing with 404 and records when every request arrived. The checks cover
+conditional requests, retries, client errors, the per-host interval of one fetcher, and the per-host interval
+across url lists parsed by several parse workers at once, where all fetching has to go through the server
+process's fetcher. Prints one line per check and exits with 1 if any failed; pages are cached in a
+temporary directory that is removed again
+
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from Embeddings import EmbeddingHandler
+from UrlFetcher import UrlFetcher
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # path -> arrival times, shared by all handler threads
+    arrivals = {}
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        with self.lock:
+            self.arrivals.setdefault(self.path, []).append(time.monotonic())
+            count = len(self.arrivals[self.path])
+        if self.path == "/missing":
+            self.send_response(404)
+            self.end_headers()
+            return
+        if self.path == "/flaky" and count < 3:
+            self.send_response(503)
+            self.end_headers()
+            return
+        if self.headers.get("If-None-Match") == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = f"<html><body><p>page {self.path}</p></body></html>".encode()
+        self.send_response(200)
+        self.send_header("ETag", '"v1"')
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def arrivals(prefix):
+    with StandInHandler.lock:
+        return sorted(moment for path, moments in StandInHandler.arrivals.items() if path.startswith(prefix) for moment in moments)
+
+def smallest_gap(moments):
+    return min(later - earlier for earlier, later in zip(moments, moments[1:]))
+
+def check(name, passed, detail=""):
+    print(f"{'ok' if passed else 'FAILED':6}  {name}  {detail}")
+    return passed
+
+def run(base, workdir):
+    results = []
+    fetcher = UrlFetcher(None, cache_dir=os.path.join(workdir, "pagecache"), host_interval=0.0, backoff=0.05)
+
+    first, second = fetcher.fetch_all([f"{base}/etag"]), fetcher.fetch_all([f"{base}/etag"])
+    results.append(check("etag", first[0].status == "fetched" and second[0].status == "unchanged" and second[0].message == "Not modified",
+                         f"first {first[0].status}, then {second[0].status} ({second[0].message})"))
+
+    flaky = fetcher.fetch(f"{base}/flaky")
+    results.append(check("flaky 503", flaky.status == "fetched" and flaky.attempts == 3, f"{flaky.status} after {flaky.attempts} attempts"))
+
+    missing = fetcher.fetch(f"{base}/missing")
+    results.append(check("404", missing.status == "error" and missing.attempts == 1, f"{missing.status} after {missing.attempts} attempt: {missing.message}"))
+
+    fetcher.host_interval = 0.1
+    fetcher.fetch_all([f"{base}/rate/{index}" for index in range(10)])
+    gap = smallest_gap(arrivals("/rate/"))
+    results.append(check("host interval", gap >= 0.08, f"smallest gap {gap * 1000:.0f}ms, interval 100ms"))
+
+    # url lists in a zip are parsed by the pool, the pages of all of them share the server's host schedule
+    embedding_handler = EmbeddingHandler(None, persist_directory=os.path.join(workdir, "chromadb"), reranker="none", parse_workers=2)
+    embedding_handler.upload_handler.url_fetcher = UrlFetcher(None, cache_dir=os.path.join(workdir, "pagecache"), host_interval=0.1)
+    lists = [(f"list-{number}.txt", "\n".join(f"{base}/pool/{number}/{index}" for index in range(5)).encode(), True, 0, True) for number in range(4)]
+    try:
+        statuses = [result[0] for _, result in embedding_handler.parse_files(lists)]
+    finally:
+        embedding_handler.parse_pool.shutdown()
+    gap = smallest_gap(arrivals("/pool/"))
+    results.append(check("host interval across parse workers", statuses == ["success"] * 4 and gap >= 0.08,
+                         f"{len(arrivals('/pool/'))} requests from 2 workers, smallest gap {gap * 1000:.0f}ms, interval 100ms"))
+    return all(results)
+
+if __name__ == '__main__':
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    workdir = tempfile.mkdtemp(prefix="url-fetcher-check-")
+    try:
+        passed = run(f"http://127.0.0.1:{server.server_port}", workdir)
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+    sys.exit(0 if passed else 1)
@@ -1,7 +1,12 @@
 import json
+import base64
 import pytz
-from sqlalchemy import create_engine, Column, String, ForeignKey, DateTime, Boolean
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event, inspect, text, Column, String, Integer, ForeignKey, DateTime, Boolean, Index, insert, func, literal_column, null, or_, and_
+from sqlalchemy.orm import declarative_base, relationship, sessionmaker, scoped_session
 from sqlalchemy.types import JSON
 import uuid
 from datetime import datetime
@@ -14,6 +19,8 @@ class User(Base):
     __tablename__ = 'users'
 
     user_id = Column(String, primary_key=True)
+    # model the user picked, None means the server default
+    model = Column(String)
 
     # define relationships with Conversation and Collection classes
     conversations = relationship('Conversation', back_populates='user', cascade='all, delete-orphan')
@@ -30,7 +37,7 @@ class Message(Base):
     text = Column(String)
     is_user = Column(Boolean)
     is_complete = Column(Boolean)
-    conversation_id = Column(String, ForeignKey('conversations.conversation_id'))
+    conversation_id = Column(String, ForeignKey('conversations.conversation_id'), index=True)
 
     conversation = relationship('Conversation', back_populates='messages')
 
@@ -42,39 +49,78 @@ class Conversation(Base):
     __tablename__ = 'conversations'
 
     conversation_id = Column(String, primary_key=True)
-    collection_id = Column(String, ForeignKey('collections.collection_id'))
-    user_id = Column(String, ForeignKey('users.user_id'))
+    collection_id = Column(String, ForeignKey('collections.collection_id'), index=True)
+    user_id = Column(String, ForeignKey('users.user_id'), index=True)
+    # legacy JSON copy of the whole conversation, moved into conversation_turns on first read
     raw_conversation = Column(JSON)
-    last_updated = Column(DateTime, default=lambda: datetime.now(eastern), onupdate=lambda: datetime.now(eastern))
+    last_updated = Column(DateTime, default=lambda: datetime.now(eastern), onupdate=lambda: datetime.now(eastern), index=True)
     title = Column(String)
+    # rolling summary of the oldest messages, and how many messages of raw_conversation it covers
+    summary = Column(String)
+    summarized_messages = Column(Integer, default=0)
 
     # Define relationships with User, Collection, and Message classes
     user = relationship('User', back_populates='conversations')
     collection = relationship('Collection', back_populates='conversations')
     messages = relationship('Message', back_populates='conversation', cascade='all, delete-orphan')
 
+    # the conversation listings filter by user or collection and walk the keyset (last_updated, conversation_id),
+    # with these a page is read straight off the index instead of sorting every matching conversation
+    __table_args__ = (
+        Index('ix_conversations_user_updated', 'user_id', 'last_updated', 'conversation_id'),
+        Index('ix_conversations_collection_updated', 'collection_id', 'last_updated', 'conversation_id'),
+    )
+
     def __repr__(self):
         return f"<Conversation(conversation_id='{self.conversation_id}')>"
 
+# define the ConversationTurn class, one LLM-facing message of a conversation, written once and never rewritten
+class ConversationTurn(Base):
+    __tablename__ = 'conversation_turns'
+
+    conversation_id = Column(String, ForeignKey('conversations.conversation_id'), primary_key=True)
+    position = Column(Integer, primary_key=True)
+    role = Column(String)
+    content = Column(String)
+
+    def __repr__(self):
+        return f"<ConversationTurn(conversation_id='{self.conversation_id}', position={self.position})>"
+
 class Document(Base):
     __tablename__ = 'documents'
 
     document_id = Column(String, primary_key=True)
     title = Column(String)
     content = Column(String)
-    collection_id = Column(String, ForeignKey('collections.collection_id'))
+    collection_id = Column(String, ForeignKey('collections.collection_id'), index=True)
     collection = relationship('Collection', back_populates='documents')
 
+    # the document listing of a collection walks the keyset (title, document_id)
+    __table_args__ = (
+        Index('ix_documents_collection_title', 'collection_id', 'title', 'document_id'),
+    )
+
     def __repr__(self):
         return f"<Document(id='{self.document_id}', title='{self.title}')>"
 
+# define the ChunkReference class, which records that a document contains a content-hashed chunk
+class ChunkReference(Base):
+    __tablename__ = 'chunk_references'
+
+    collection_id = Column(String, primary_key=True)
+    chunk_hash = Column(String, primary_key=True)
+    document_id = Column(String, primary_key=True, index=True)
+
+    def __repr__(self):
+        return f"<ChunkReference(chunk_hash='{self.chunk_hash}', document_id='{self.document_id}')>"
+
 # define the Collection class, which represents a collection in the database
 class Collection(Base):
     __tablename__ = 'collections'
 
     collection_id = Column(String, primary_key=True)
     name = Column(String)
-    user_id = Column(String, ForeignKey('users.user_id'))
+    user_id = Column(String, ForeignKey('users.user_id'), index=True)
 
     # define relationships with User, Conversation, and Document classes
     user = relationship('User', back_populates='collections')
@@ -84,20 +130,83 @@ class Collection(Base):
     def __repr__(self):
         return f"<Collection(collection_id='{self.collection_id}')>"
 
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers run alongside the single writer, busy_timeout makes writers wait instead of failing
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.execute("PRAGMA cache_size=-64000")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+def unit_of_work(method):
+    # run a Database method in its own session that is closed when it returns,
+    # nested calls (e.g. add_document -> get_collection) share the outer unit of work
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.session_scope():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+def encode_cursor(*values):
+    # opaque keyset cursor handed to clients, holds the sort key of the last row of a page
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor):
+    return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+
 # define the Database class, which provides methods for interacting with the database
 class Database:
-    def __init__(self):
-        # Create an engine for connecting to the SQLite database
-        self.engine = create_engine('sqlite:///database.db')
+    def __init__(self, url='sqlite:///database.db'):
+        # Create an engine for connecting to the SQLite database, connections are shared by the threads of the server
+        self.engine = create_engine(url, connect_args={"check_same_thread": False}, pool_size=10, max_overflow=20)
+        event.listen(self.engine, "connect", set_sqlite_pragmas)
         # Create all tables defined in the declarative base
         Base.metadata.create_all(self.engine)
-        # Create a session factory bound to the engine
-        self.Session = sessionmaker(bind=self.engine)
-        # Create a new session
-        self.session = self.Session()
+        # create_all skips tables that already exist, so add any column or index they are missing
+        self.add_missing_columns()
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(self.engine, checkfirst=True)
+        # Create a thread-local session registry bound to the engine, objects stay readable after their session closes
+        self.Session = scoped_session(sessionmaker(bind=self.engine, expire_on_commit=False))
+
+    def add_missing_columns(self):
+        inspector = inspect(self.engine)
+        with self.engine.begin() as connection:
+            for table in Base.metadata.sorted_tables:
+                existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name not in existing_columns:
+                        connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(self.engine.dialect)}"))
+
+    @property
+    def session(self):
+        # the session of the current thread's unit of work
+        return self.Session()
+
+    @contextmanager
+    def session_scope(self):
+        session = self.Session()
+        depth = session.info.get("depth", 0)
+        session.info["depth"] = depth + 1
+        try:
+            yield session
+            if depth == 0:
+                session.commit()
+        except Exception:
+            if depth == 0:
+                session.rollback()
+            raise
+        finally:
+            session.info["depth"] = depth
+            if depth == 0:
+                self.Session.remove()
 
     ### USER ###
 
+    @unit_of_work
     def add_user(self, user_id):
         # Check if the user already exists in the database
         existing_user = self.session.query(User).filter_by(user_id=user_id).first()
@@ -110,28 +219,50 @@ class Database:
         self.session.commit()
         return True  # User added successfully
     
+    @unit_of_work
     def remove_user(self, user_id):
         # query the User object by user_id
         user = self.session.query(User).filter_by(user_id=user_id).first()
         if user:
-            # delete all collections associated with the user using the remove_collection function
-            collections = self.session.query(Collection).filter_by(user_id=user_id).all()
-            for collection in collections:
-                self.remove_collection(collection.collection_id)
+            # set-based deletes of everything the user owns, one statement per table
+            collection_ids = self.session.query(Collection.collection_id).filter_by(user_id=user_id)
+            conversation_ids = self.session.query(Conversation.conversation_id).filter(
+                (Conversation.user_id == user_id) | Conversation.collection_id.in_(collection_ids))
+            self.session.query(Message).filter(Message.conversation_id.in_(conversation_ids)).delete(synchronize_session=False)
+            self.session.query(ConversationTurn).filter(ConversationTurn.conversation_id.in_(conversation_ids)).delete(synchronize_session=False)
+            self.session.query(Conversation).filter(
+                (Conversation.user_id == user_id) | Conversation.collection_id.in_(collection_ids)).delete(synchronize_session=False)
+            self.session.query(Document).filter(Document.collection_id.in_(collection_ids)).delete(synchronize_session=False)
+            self.session.query(ChunkReference).filter(ChunkReference.collection_id.in_(collection_ids)).delete(synchronize_session=False)
+            self.session.query(Collection).filter_by(user_id=user_id).delete(synchronize_session=False)
             # finally, delete the user itself
-            self.session.delete(user)
+            self.session.query(User).filter_by(user_id=user_id).delete(synchronize_session=False)
             self.session.commit()
+            self.session.expire_all()
             
+    @unit_of_work
     def get_user(self, user_id):
         # Query the User object by user_id and return it
         return self.session.query(User).filter_by(user_id=user_id).first()
             
+    @unit_of_work
+    def get_user_model(self, user_id):
+        return self.session.query(User.model).filter_by(user_id=user_id).scalar()
+
+    @unit_of_work
+    def set_user_model(self, user_id, model):
+        updated = self.session.query(User).filter_by(user_id=user_id).update({User.model: model}, synchronize_session=False)
+        self.session.commit()
+        return bool(updated)
+
+    @unit_of_work
     def get_all_users(self):
         # Query all User objects and return them as a list
         return self.session.query(User).all()
             
     ### CONVERSATIONS ###
 
+    @unit_of_work
     def add_conversation(self, conversation_id, user_id, collection_id):
         # create a new conversation object and add it to the session
         conversation = Conversation(conversation_id=conversation_id, title="New chat",
@@ -140,57 +271,109 @@ class Database:
         self.session.commit()
         return conversation_id
 
+    @unit_of_work
     def conversation_exists(self, conversation_id, user_id):
         # check if a conversation with the given conversation_id exists for the specified user
         return bool(self.session.query(Conversation).filter_by(conversation_id=conversation_id, user_id=user_id).first())
 
+    @unit_of_work
     def get_conversations_sorted_by_last_updated(self):
         return self.session.query(Conversation).order_by(Conversation.last_updated.desc()).all()
 
+    @unit_of_work
     def get_conversations_by_user_sorted_by_last_updated(self, user_id):
         user = self.session.query(User).filter_by(user_id=user_id).first()
         if user:
             return self.session.query(Conversation).filter_by(user_id=user_id).order_by(Conversation.last_updated.desc()).all()
         return []
     
+    @unit_of_work
     def get_conversation(self, conversation_id):
         # Query the Conversation object by conversation_id and return it
         return self.session.query(Conversation).filter_by(conversation_id=conversation_id).first()
             
-    def update_conversation_raw(self, conversation_id, raw_conversation):
-        # query the conversation by conversation_id
+    @unit_of_work
+    def append_conversation_turns(self, conversation_id, turns):
+        # insert only the new turns after the existing ones, earlier turns are never rewritten
         conversation = self.session.query(Conversation).filter_by(conversation_id=conversation_id).first()
         if conversation:
-            # update the raw_conversation field
-            conversation.raw_conversation = raw_conversation
+            last_position = self.session.query(func.max(ConversationTurn.position)).filter_by(conversation_id=conversation_id).scalar()
+            start = -1 if last_position is None else last_position
+            self.session.add_all([ConversationTurn(conversation_id=conversation_id, position=start + offset, role=turn["role"], content=turn["content"])
+                                  for offset, turn in enumerate(turns, start=1)])
+            conversation.last_updated = datetime.now(eastern)
             self.session.commit()
 
+    @unit_of_work
     def get_conversation_raw(self, conversation_id):
-        # query the conversation by conversation_id
+        # rebuild the LLM-facing history from its turns, None if the conversation has none yet
         conversation = self.session.query(Conversation).filter_by(conversation_id=conversation_id).first()
         if conversation:
-            # return the raw_conversation field
-            return conversation.raw_conversation
+            if conversation.raw_conversation:
+                self.migrate_conversation_raw(conversation)
+            turns = self.session.query(ConversationTurn.role, ConversationTurn.content).filter_by(
+                conversation_id=conversation_id).order_by(ConversationTurn.position).all()
+            if turns:
+                return [{"role": role, "content": content} for role, content in turns]
         return None
 
+    def migrate_conversation_raw(self, conversation):
+        # move a legacy JSON history into turn rows, only if no turns were written for it yet
+        has_turns = self.session.query(ConversationTurn.position).filter_by(conversation_id=conversation.conversation_id).first()
+        if not has_turns:
+            self.session.add_all([ConversationTurn(conversation_id=conversation.conversation_id, position=position, role=turn["role"], content=turn["content"])
+                                  for position, turn in enumerate(conversation.raw_conversation)])
+        conversation.raw_conversation = null()
+        self.session.commit()
+
+    @unit_of_work
+    def migrate_raw_conversations(self):
+        # migrate every conversation that still has a legacy JSON history, returns how many were moved
+        conversations = self.session.query(Conversation).filter(Conversation.raw_conversation.isnot(None)).all()
+        migrated = 0
+        for conversation in conversations:
+            if conversation.raw_conversation:
+                self.migrate_conversation_raw(conversation)
+                migrated += 1
+        return migrated
+
+    @unit_of_work
+    def get_conversation_summary(self, conversation_id):
+        conversation = self.session.query(Conversation).filter_by(conversation_id=conversation_id).first()
+        if conversation:
+            return conversation.summary, conversation.summarized_messages or 0
+        return None, 0
+
+    @unit_of_work
+    def update_conversation_summary(self, conversation_id, summary, summarized_messages):
+        conversation = self.session.query(Conversation).filter_by(conversation_id=conversation_id).first()
+        if conversation:
+            conversation.summary = summary
+            conversation.summarized_messages = summarized_messages
+            self.session.commit()
+
+    @unit_of_work
     def get_conversation_messages(self, conversation_id):
         conversation = self.session.query(Conversation).filter_by(conversation_id=conversation_id).first()
         if conversation:
             return conversation.messages
         return []
     
+    @unit_of_work
     def get_conversation_title(self, conversation_id):
         conversation = self.session.query(Conversation).filter_by(conversation_id=conversation_id).first()
         if conversation:
             return conversation.title
         return "New chat"
     
+    @unit_of_work
     def update_conversation_title(self, conversation_id, title):
         conversation = self.session.query(Conversation).filter_by(conversation_id=conversation_id).first()
         if conversation:
             conversation.title = title
             self.session.commit()
             
+    @unit_of_work
     def get_conversations_by_user(self, user_id):
         # Query the User object by user_id and return its associated conversation
         user = self.session.query(User).filter_by(user_id=user_id).first()
@@ -198,6 +381,7 @@ class Database:
             return user.conversations
         return []
     
+    @unit_of_work
     def get_conversations_by_collection(self, collection_id):
         # Query the collection object by collection_id and return its associated conversations
         collection = self.session.query(Collection).filter_by(collection_id=collection_id).first()
@@ -205,34 +389,60 @@ class Database:
             return collection.conversations
         return []
     
+    @unit_of_work
     def get_empty_conversation_by_collection(self, collection_id):
         # query the collection object by collection_id and check for conversations with empty messages
-        collection = self.session.query(Collection).filter_by(collection_id=collection_id).first()
-        if collection:
-            for conversation in collection.conversations:
-                if not conversation.raw_conversation:  # check if the conversation has no messages
-                    print(f"Found empty conversation with ID: {conversation.conversation_id}")
-                    return [conversation]
+        has_turns = self.session.query(ConversationTurn.position).filter(ConversationTurn.conversation_id == Conversation.conversation_id).exists()
+        conversation = self.session.query(Conversation).filter(
+            Conversation.collection_id == collection_id, ~has_turns,
+            or_(Conversation.raw_conversation.is_(None), func.json_array_length(Conversation.raw_conversation) == 0)).first()
+        if conversation:
+            print(f"Found empty conversation with ID: {conversation.conversation_id}")
+            return [conversation]
         return []
     
+    @unit_of_work
+    def get_conversations_page(self, user_id=None, collection_id=None, cursor=None, limit=50):
+        # newest first, keyset on (last_updated, conversation_id), raw conversations are never loaded
+        filters = []
+        if user_id is not None:
+            filters.append(Conversation.user_id == user_id)
+        if collection_id is not None:
+            filters.append(Conversation.collection_id == collection_id)
+        query = self.session.query(Conversation.conversation_id, Conversation.title, Conversation.collection_id,
+                                   Conversation.user_id, Conversation.last_updated).filter(*filters)
+        # the total is counted on the index, it never reads the table rows but still grows with the number of matches
+        total = self.session.query(func.count(Conversation.conversation_id)).filter(*filters).scalar()
+        if cursor:
+            last_updated, conversation_id = decode_cursor(cursor)
+            last_updated = datetime.fromisoformat(last_updated)
+            query = query.filter(or_(Conversation.last_updated < last_updated,
+                                     and_(Conversation.last_updated == last_updated, Conversation.conversation_id < conversation_id)))
+        rows = query.order_by(Conversation.last_updated.desc(), Conversation.conversation_id.desc()).limit(limit + 1).all()
+        items = [row._asdict() for row in rows[:limit]]
+        next_cursor = encode_cursor(items[-1]["last_updated"].isoformat(), items[-1]["conversation_id"]) if len(rows) > limit else None
+        return {"items": items, "next_cursor": next_cursor, "total": total}
+
+    @unit_of_work
     def get_all_conversations(self):
         # Query all Conversation objects and return them as a list
         return self.session.query(Conversation).all()
 
+    @unit_of_work
     def remove_conversation(self, conversation_id):
         # query the Conversation object by conversation_id
         conversation = self.session.query(Conversation).filter_by(conversation_id=conversation_id).first()
         if conversation:
-            # delete all messages associated with the conversation
-            messages = self.session.query(Message).filter_by(conversation_id=conversation_id).all()
-            for message in messages:
-                self.session.delete(message)
+            # delete all messages associated with the conversation in a single statement
+            self.session.query(Message).filter_by(conversation_id=conversation_id).delete(synchronize_session=False)
+            self.session.query(ConversationTurn).filter_by(conversation_id=conversation_id).delete(synchronize_session=False)
             # delete the conversation itself
             self.session.delete(conversation)
             self.session.commit()
           
     ### MESSAGES ###
             
+    @unit_of_work
     def add_message(self, conversation_id, text, is_user, is_complete):
         print(f"Attempting to add message to conversation ID: {conversation_id}")
         conversation = self.session.query(Conversation).filter_by(conversation_id=conversation_id).first()
@@ -250,6 +460,22 @@ class Database:
             print(f"No conversation found with ID: {conversation_id}")
         return None
     
+    @unit_of_work
+    def get_conversation_messages_page(self, conversation_id, cursor=None, limit=50):
+        # oldest first, keyset on the sqlite rowid which follows insertion order
+        rowid = literal_column("messages.rowid")
+        query = self.session.query(rowid.label("position"), Message.message_id, Message.text, Message.is_user, Message.is_complete).filter(
+            Message.conversation_id == conversation_id)
+        total = self.session.query(func.count(Message.message_id)).filter(Message.conversation_id == conversation_id).scalar()
+        if cursor:
+            (position,) = decode_cursor(cursor)
+            query = query.filter(rowid > position)
+        rows = query.order_by(rowid).limit(limit + 1).all()
+        items = [{key: value for key, value in row._asdict().items() if key != "position"} for row in rows[:limit]]
+        next_cursor = encode_cursor(rows[limit - 1].position) if len(rows) > limit else None
+        return {"items": items, "next_cursor": next_cursor, "total": total}
+
+    @unit_of_work
     def remove_message(self, message_id):
         # query the Message object by message_id
         message = self.session.query(Message).filter_by(message_id=message_id).first()
@@ -261,6 +487,7 @@ class Database:
     
     ### COLLECTIONS ###
 
+    @unit_of_work
     def collection_exists(self, user_id, name=None, collection_id=None):
         # check if any collection with the given name or id exists for the specified user
         if name:
@@ -269,6 +496,7 @@ class Database:
             return self.session.query(Collection).filter_by(user_id=user_id, collection_id=collection_id).first() is not None
         return False
 
+    @unit_of_work
     def add_collection(self, user_id, name, collection_id):
         # check if a collection with the same name already exists for the user
         if self.collection_exists(user_id, name):
@@ -279,37 +507,35 @@ class Database:
         self.session.commit()
         return collection_id
 
+    @unit_of_work
     def remove_collection(self, collection_id):
-        # query the Collection object by collection_id
-        collection = self.session.query(Collection).filter_by(collection_id=collection_id).first()
-        if collection:
-            print(f"Collection found with ID: {collection_id}, proceeding with deletion.")
-            # delete all documents associated with the collection
-            documents = self.session.query(Document).filter_by(collection_id=collection_id).all()
-            for document in documents:
-                print(f"Deleting document with ID: {document.document_id}")
-                self.session.delete(document)
-            # delete all conversations associated with the collection
-            conversations = self.session.query(Conversation).filter_by(collection_id=collection_id).all()
-            for conversation in conversations:
-                print(f"Deleting conversation with ID: {conversation.conversation_id}")
-                self.remove_conversation(conversation.conversation_id)
-            # delete the collection itself
-            print(f"Deleting collection with ID: {collection_id}")
-            self.session.delete(collection)
+        # delete the collection and everything under it with a fixed number of set-based deletes, whatever its size
+        collection_exists = self.session.query(Collection.collection_id).filter_by(collection_id=collection_id).first()
+        if collection_exists:
+            conversation_ids = self.session.query(Conversation.conversation_id).filter_by(collection_id=collection_id)
+            self.session.query(Message).filter(Message.conversation_id.in_(conversation_ids)).delete(synchronize_session=False)
+            self.session.query(ConversationTurn).filter(ConversationTurn.conversation_id.in_(conversation_ids)).delete(synchronize_session=False)
+            self.session.query(Conversation).filter_by(collection_id=collection_id).delete(synchronize_session=False)
+            self.session.query(Document).filter_by(collection_id=collection_id).delete(synchronize_session=False)
+            self.session.query(ChunkReference).filter_by(collection_id=collection_id).delete(synchronize_session=False)
+            self.session.query(Collection).filter_by(collection_id=collection_id).delete(synchronize_session=False)
             self.session.commit()
-            print("Deletion of collection and associated items committed.")
+            # objects of the deleted rows may still be cached in the identity map
+            self.session.expire_all()
         else:
             print(f"No collection found with ID: {collection_id}")
 
+    @unit_of_work
     def get_collection(self, collection_id):
         # Query the Collection object by collection_id and return it
         return self.session.query(Collection).filter_by(collection_id=collection_id).first()
 
+    @unit_of_work
     def get_all_collections(self):
         # Query all Collection objects and return them as a list
         return self.session.query(Collection).all()
 
+    @unit_of_work
     def get_collections_by_user(self, user_id):
         # query the User object by user_id and return its associated collections
         print(f"Debug: Fetching user with user_id={user_id}")
@@ -322,6 +548,7 @@ class Database:
     
     ### DOCUMENTS ###
 
+    @unit_of_work
     def add_document(self, document_id, collection_id, title, content):
         collection = self.get_collection(collection_id)
         if collection:
@@ -332,27 +559,137 @@ class Database:
         else:
             return {"message": "Collection not found.", "status": "error"}
 
+    @unit_of_work
     def get_documents_by_collection(self, collection_id):
         collection = self.get_collection(collection_id)
         if collection:
             return collection.documents
         return []
 
+    @unit_of_work
+    def add_documents(self, collection_id, documents):
+        # bulk insert of (document_id, title, content) tuples into one collection
+        collection = self.get_collection(collection_id)
+        if collection:
+            self.session.add_all([Document(document_id=document_id, title=title, content=content, collection_id=collection_id)
+                                  for document_id, title, content in documents])
+            self.session.commit()
+            return {"message": "Documents added successfully.", "status": "success"}
+        else:
+            return {"message": "Collection not found.", "status": "error"}
+
+    @unit_of_work
+    def get_document(self, document_id):
+        return self.session.query(Document).filter_by(document_id=document_id).first()
+
+    @unit_of_work
+    def get_document_collections(self):
+        # map every document_id to the collection it belongs to, without loading document contents
+        return dict(self.session.query(Document.document_id, Document.collection_id).all())
+
+    @unit_of_work
+    def get_documents_page(self, collection_id, cursor=None, limit=50):
+        # ordered by title, keyset on (title, document_id), the content column is never read
+        query = self.session.query(Document.document_id, Document.title, Document.collection_id).filter(Document.collection_id == collection_id)
+        total = self.session.query(func.count(Document.document_id)).filter(Document.collection_id == collection_id).scalar()
+        if cursor:
+            title, document_id = decode_cursor(cursor)
+            query = query.filter(or_(Document.title > title, and_(Document.title == title, Document.document_id > document_id)))
+        rows = query.order_by(Document.title, Document.document_id).limit(limit + 1).all()
+        items = [row._asdict() for row in rows[:limit]]
+        next_cursor = encode_cursor(items[-1]["title"], items[-1]["document_id"]) if len(rows) > limit else None
+        return {"items": items, "next_cursor": next_cursor, "total": total}
+
+    @unit_of_work
     def get_documents_by_conversation(self, conversation_id):
         conversation = self.get_conversation(conversation_id)
         if conversation:
             return self.get_documents_by_collection(conversation.collection_id)
         return []
 
-    def remove_document(self, document_id):
-        document = self.session.query(Document).filter_by(id=document_id).first()
+    @unit_of_work
+    def update_document(self, document_id, title, content):
+        # the document_id stays the same, conversations and chunk references keep pointing at it
+        document = self.session.query(Document).filter_by(document_id=document_id).first()
         if document:
-            self.session.delete(document)
+            document.title = title
+            document.content = content
             self.session.commit()
+            return {"message": "Document updated successfully.", "status": "success"}
+        else:
+            return {"message": "Document not found.", "status": "error"}
+
+    @unit_of_work
+    def delete_document(self, document_id):
+        return self.delete_documents([document_id])
+
+    @unit_of_work
+    def delete_documents(self, document_ids):
+        # remove any number of documents with a single delete statement
+        deleted = self.session.query(Document).filter(Document.document_id.in_(document_ids)).delete(synchronize_session=False)
+        self.session.commit()
+        if deleted:
             return {"message": "Document removed successfully.", "status": "success"}
         else:
             return {"message": "Document not found.", "status": "error"}
 
+    ### CHUNK REFERENCES ###
+
+    @unit_of_work
+    def add_chunk_references(self, collection_id, references):
+        # record (chunk_hash, document_id) pairs, pairs that already exist are ignored
+        rows = [{"collection_id": collection_id, "chunk_hash": chunk_hash, "document_id": document_id} for chunk_hash, document_id in references]
+        if rows:
+            self.session.execute(insert(ChunkReference).prefix_with("OR IGNORE"), rows)
+            self.session.commit()
+
+    @unit_of_work
+    def get_chunk_hashes(self, collection_id, document_id):
+        # content hashes of every chunk the document references
+        rows = self.session.query(ChunkReference.chunk_hash).filter(
+            ChunkReference.collection_id == collection_id, ChunkReference.document_id == document_id)
+        return [chunk_hash for (chunk_hash,) in rows]
+
+    @unit_of_work
+    def remove_chunk_references(self, collection_id, document_ids, chunk_hashes=None):
+        # drop the references held by the given documents (only those to chunk_hashes, if given) and report which
+        # chunks are now unreferenced, and for the chunks that are still referenced, which (document_id, title) should own them
+        reference_filter = [ChunkReference.collection_id == collection_id, ChunkReference.document_id.in_(document_ids)]
+        if chunk_hashes is not None:
+            reference_filter.append(ChunkReference.chunk_hash.in_(chunk_hashes))
+        document_hashes = self.session.query(ChunkReference.chunk_hash).filter(*reference_filter)
+        chunk_hashes = [chunk_hash for (chunk_hash,) in document_hashes.distinct()]
+        surviving_owners = {}
+        # outer join, a document that is still being ingested has references before its row exists
+        surviving_references = self.session.query(ChunkReference.chunk_hash, ChunkReference.document_id, Document.title).outerjoin(
+            Document, Document.document_id == ChunkReference.document_id).filter(
+            ChunkReference.collection_id == collection_id, ChunkReference.chunk_hash.in_(document_hashes),
+            ChunkReference.document_id.notin_(document_ids))
+        for chunk_hash, document_id, title in surviving_references:
+            surviving_owners.setdefault(chunk_hash, (document_id, title))
+        self.session.query(ChunkReference).filter(*reference_filter).delete(synchronize_session=False)
+        self.session.commit()
+        orphaned_hashes = [chunk_hash for chunk_hash in chunk_hashes if chunk_hash not in surviving_owners]
+        return orphaned_hashes, surviving_owners
+
+# define the AsyncDatabase class, which exposes the Database methods as coroutines for the async endpoints
+class AsyncDatabase:
+    def __init__(self, database, max_workers=8):
+        self.database = database
+        # queries run on a bounded pool so they never block the event loop and cannot pile up unbounded threads
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="database")
+
+    def __getattr__(self, name):
+        method = getattr(self.database, name)
+        if not callable(method):
+            return method
+
+        @functools.wraps(method)
+        async def run(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(method, *args, **kwargs))
+        return run
+
 if __name__ == '__main__':
     # Create a new instance of the Database class
     db = Database()
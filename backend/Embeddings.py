@@ -1,109 +1,514 @@
 import chromadb
-from typing import List, Dict, Tuple
-from UploadHandler import UploadHandler
-import uuid
-import cohere
+from chromadb.config import Settings
+from chromadb.telemetry.product import ProductTelemetryClient, ProductTelemetryEvent
+from chromadb.utils import embedding_functions
+from overrides import override
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterable, Iterator, List, Dict, Tuple
+from collections import deque
+from functools import cached_property
+from UploadHandler import UploadHandler, init_parse_worker, parse_file
+from Reranker import get_reranker
+from SemanticCache import SemanticCache
+from LexicalIndex import LexicalIndex, reciprocal_rank_fusion
+from MicroBatcher import MicroBatcher
+from Metrics import metrics
+import multiprocessing
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import time
+
+# bytes ingest holds per byte of a segment or buffered chunk, measured with BenchmarkIngestMemory. The server process
+# keeps every segment in flight as read, pickled to its worker and returned as chunks, and reading and decompressing
+# take about as much as ten segments more; a parse worker holds the decoded text and the splitter's pieces, up to 24x
+# its segment for text without line breaks, where the splitter falls back to single words. A buffered chunk is held
+# twice as text and, on its way through the embedding cache and chroma, about three times as a vector of python floats
+SEGMENT_COPIES = 10
+WINDOW_SEGMENT_COPIES = 2.5
+WORKER_SEGMENT_COPIES = 24
+CHUNK_TEXT_COPIES = 2
+CHUNK_VECTOR_COPIES = 3
+PYTHON_FLOAT_BYTES = 32
+
+def embedding_cache_name(factory) -> str:
+    # vectors of another model live in another vector space, so every model gets its own cache collection
+    model = getattr(factory, "MODEL_NAME", None) or f"{factory.__module__}.{getattr(factory, '__qualname__', type(factory).__name__)}"
+    name = "embedding-cache-" + re.sub(r"[^A-Za-z0-9_-]+", "-", model).strip("-_")
+    # chroma takes names of up to 63 characters
+    return name if len(name) <= 63 else f"embedding-cache-{hashlib.md5(model.encode()).hexdigest()}"
+
+class NoTelemetry(ProductTelemetryClient):
+    # chroma's default client batches events in a dict without a lock and raises KeyError when
+    # concurrent queries race on it, and even disabled it still batches, so events are dropped here
+    @override
+    def capture(self, event: ProductTelemetryEvent) -> None:
+        pass
+
+class ThreadLimitedMiniLM(embedding_functions.ONNXMiniLM_L6_V2):
+    # chroma's default model; onnxruntime sizes its intra-op pool from the core count and ignores OMP_NUM_THREADS,
+    # so a thread limit has to be set on the session options the model is loaded with
+    def __init__(self, threads: int = None):
+        super().__init__()
+        self.threads = threads
+
+    @cached_property
+    def model(self):
+        session_options = self.ort.SessionOptions()
+        session_options.log_severity_level = 3
+        if self.threads:
+            session_options.intra_op_num_threads = self.threads
+        return self.ort.InferenceSession(os.path.join(self.DOWNLOAD_PATH, self.EXTRACTED_FOLDER_NAME, "model.onnx"),
+                                         providers=self._preferred_providers or self.ort.get_available_providers(), sess_options=session_options)
+
+# per-process embedding function used by the embedding pool, created once in each worker process
+worker_embedding_function = None
+
+def init_embed_worker(embedding_factory: Callable[[int], any], threads: int):
+    # the workers share the cores, so each one builds its model limited to its own share of them
+    global worker_embedding_function
+    worker_embedding_function = embedding_factory(threads)
+
+def embed_batch(documents: List[str]) -> List[List[float]]:
+    # runs in a pool worker: embed one batch of chunk texts
+    return [list(map(float, embedding)) for embedding in worker_embedding_function(documents)]
 
 class EmbeddingHandler:
-    def __init__(self, persist_directory: str = "./chromadb", similarity_score: float = 0.01, collection: str = "crisischatbot", chunk_size: int = 1000, chunk_overlap: int = 0):
-        self.db = chromadb.PersistentClient(path=persist_directory)
-        self.collection = self.db.get_or_create_collection(collection)
-        with open("cohere.txt", "r") as file:
-            self.cohere_key = file.read().strip()
-        self.upload_handler = UploadHandler()
-        self.co = cohere.Client(self.cohere_key)
+    def __init__(self, database, persist_directory: str = "./chromadb", similarity_score: float = 0.01, collection: str = "crisischatbot", chunk_size: int = 1000, chunk_overlap: int = 0, reranker: str = "cohere", num_candidates: int = 100, reranker_options: Dict[str, any] = None, parse_workers: int = None, write_batch_size: int = 5000, memory_limit: int = 512 * 1024 * 1024, cache_options: Dict[str, any] = None, lexical_options: Dict[str, any] = None, hybrid: bool = True, rerank_candidates: int = 30, fusion_k: int = 60, decisive_gap: float = 0.15, distance_band: float = 0.5, embed_batch_size: int = 256, embed_workers: int = None, embedding_factory: Callable[[int], any] = None, embedding_cache_size: int = 200000, query_batch_wait: float = 0.005, query_batch_size: int = 32):
+        self.db = chromadb.PersistentClient(path=persist_directory, settings=Settings(anonymized_telemetry=False, chroma_product_telemetry_impl="Embeddings.NoTelemetry"))
+        # the database keeps track of which documents reference which content-hashed chunk
+        self.database = database
+        # the factory has to be importable by name, the embedding pool workers build their own copy of the model with it;
+        # it is called with the number of threads the model may use, None for no limit
+        self.embedding_factory = embedding_factory or ThreadLimitedMiniLM
+        self.embedding_function = self.embedding_factory(None)
+        # new chunks are embedded embed_batch_size at a time on a process pool of embed_workers, created on first use;
+        # with one worker they are embedded in the calling thread. At most embed_window batches are in flight, the
+        # writer waits for the oldest one, and while it waits the parser stage (see parse_files) stops reading ahead
+        self.embed_batch_size = embed_batch_size
+        self.embed_workers = embed_workers or os.cpu_count() or 1
+        self.embed_window = self.embed_workers * 2
+        self.embed_pool = None
+        # concurrent chat queries are embedded together and looked up in one multi-query call per partition and filter;
+        # a query waits at most query_batch_wait seconds for others, and only when other queries are in flight (0 turns it off)
+        self.query_embedder = MicroBatcher("query_embedding", self.embed_queries, query_batch_wait, query_batch_size)
+        self.vector_lookup = MicroBatcher("vector_lookup", self.query_partition, query_batch_wait, query_batch_size)
+        # vectors keyed by chunk content hash, shared by all collections so identical text is embedded once; one cache
+        # per embedding model, holding at most embedding_cache_size vectors, the ones cached longest ago are dropped first
+        self.embedding_cache = self.open_embedding_cache()
+        self.embedding_cache_size = embedding_cache_size
+        self.prune_lock = threading.Lock()
+        # name of the old single global collection, only read by the partition migration
+        self.legacy_collection_name = collection
+        self.upload_handler = UploadHandler(chunk_size=chunk_size)
+        self.chunk_size = chunk_size
+        # process pool for parsing and chunking many files at once, created on first use
+        self.parse_workers = parse_workers or os.cpu_count() or 1
+        self.parse_pool = None
+        # guards the lazy creation of parse_pool and embed_pool
+        self.pool_lock = threading.Lock()
+        # largest number of chunks sent to chroma in one add call
+        self.write_batch_size = write_batch_size
+        # uploads are read in segments and written in bounded batches so ingest stays within memory_limit whatever the
+        # upload size: a quarter goes to the write buffer, the rest to the parse_window segments in flight with their
+        # copies in the server and the workers (see SEGMENT_COPIES). Not counted are what the workers hold before any
+        # segment arrives (the parsing libraries) and chroma's in-memory vector index, which grows with the partition
+        self.memory_limit = memory_limit
+        self.parse_window = self.parse_workers * 2
+        self.write_buffer_bytes = memory_limit // 4
+        segment_copies = SEGMENT_COPIES + self.parse_window * WINDOW_SEGMENT_COPIES + self.parse_workers * WORKER_SEGMENT_COPIES
+        # a segment holds at least a few chunks, below that the limit is not kept
+        self.segment_bytes = max(chunk_size * 16, int((memory_limit - self.write_buffer_bytes) // segment_copies))
+        # memory of one vector as python floats, sized from the model's dimensions on the first embedding
+        self.vector_bytes = 384 * PYTHON_FLOAT_BYTES
+        # reranker backend ("cohere" or "cross-encoder") and how many vector candidates are sent to it
+        self.reranker = get_reranker(reranker, **(reranker_options or {}))
+        self.num_candidates = num_candidates
         self.similarity_score = similarity_score
+        # reranked results (and answers, see ModularChatbot) of recent queries per collection, dropped when the collection changes
+        self.semantic_cache = SemanticCache(**(cache_options or {}))
+        # hybrid retrieval fuses bm25 and vector rankings, which puts the relevant chunks near the top often enough
+        # that only the first rerank_candidates of the fused list are sent to the reranker
+        self.lexical_index = LexicalIndex(self.load_lexical_index, **(lexical_options or {}))
+        self.hybrid = hybrid
+        self.rerank_candidates = rerank_candidates
+        self.fusion_k = fusion_k
+        # the reranker is skipped when the vector distance right after the top num_docs is at least this much (relative) larger
+        self.decisive_gap = decisive_gap
+        # vector-only candidates further than this (relative) from the best distance are not worth reranking
+        self.distance_band = distance_band
+        # running average of rerank latency, used to estimate what a skipped rerank saved
+        self.rerank_seconds = None
+
+    def open_embedding_cache(self):
+        name = embedding_cache_name(self.embedding_factory)
+        # the cache from before there was one per model only ever held vectors of chroma's default model
+        if getattr(self.embedding_factory, "MODEL_NAME", None) == embedding_functions.ONNXMiniLM_L6_V2.MODEL_NAME:
+            existing = {collection.name for collection in self.db.list_collections()}
+            if "embedding-cache" in existing and name not in existing:
+                self.db.get_collection("embedding-cache", embedding_function=None).modify(name=name)
+        return self.db.get_or_create_collection(name, embedding_function=None)
+
+    def partition_name(self, collection_id: str) -> str:
+        # every user collection gets its own chroma collection, hashed to satisfy chroma's naming rules
+        return f"collection-{hashlib.md5(collection_id.encode()).hexdigest()}"
+
+    def get_partition(self, collection_id: str):
+        return self.db.get_or_create_collection(self.partition_name(collection_id), embedding_function=self.embedding_function)
 
-    def fully_process_file(self, file_content: bytes, filename: str, document_id: str) -> Tuple[str, str]:
+    def chunk_hash(self, chunk: str) -> str:
+        return hashlib.sha256(chunk.encode()).hexdigest()
+
+    def fully_process_file(self, file_content: bytes, filename: str, document_id: str, collection_id: str) -> Tuple[str, str, int]:
         result = self.upload_handler.handle_file(file_content, filename)
         if result[0] == "error":
-            return ["error", result[1]]
-        documents, ids, metadatas = [], [], []
-        for chunk in result[1]:
-            documents.append(chunk)
-            unique_id = str(uuid.uuid4())
-            ids.append(unique_id)
-            metadatas.append({'document_id': document_id, 'filename': filename})
-        return self.add_processed_documents(documents, ids, metadatas)
+            return ["error", result[1], 0]
+        documents, ids, metadatas = self.prepare_chunks(result[1], filename, document_id, collection_id)
+        return self.add_processed_documents(documents, ids, metadatas, collection_id)
             
-    def fully_process_url(self, url: str, document_id: str) -> Tuple[str, str]:
+    def fully_process_url(self, url: str, document_id: str, collection_id: str) -> Tuple[str, str, int]:
         result = self.upload_handler.handle_urls([url], "url")
         if result[0] != "success":
-            return ["error", result[1]]
+            return ["error", result[1], 0]
 
+        documents, ids, metadatas = self.prepare_chunks(result[1], url, document_id, collection_id)
+        return self.add_processed_documents(documents, ids, metadatas, collection_id)
+
+    def prepare_chunks(self, chunks: List[str], filename: str, document_id: str, collection_id: str) -> Tuple[List[str], List[str], List[Dict[str, str]]]:
         documents, ids, metadatas = [], [], []
-        for chunk in result[1]:
+        for chunk in chunks:
             documents.append(chunk)
-            unique_id = str(uuid.uuid4())
-            ids.append(unique_id)
-            metadatas.append({'document_id': document_id, 'filename': url})
+            # chunks are keyed by their content, so the same text is stored once per collection
+            ids.append(self.chunk_hash(chunk))
+            metadatas.append({'document_id': document_id, 'collection_id': collection_id, 'filename': filename})
+        return documents, ids, metadatas
+
+    def get_parse_pool(self) -> ProcessPoolExecutor:
+        # ingestion jobs run on several threads, the lock keeps two first uploads from each starting a pool
+        with self.pool_lock:
+            if self.parse_pool is None:
+                # spawn instead of fork, the server process already runs threads
+                self.parse_pool = ProcessPoolExecutor(max_workers=self.parse_workers, mp_context=multiprocessing.get_context("spawn"),
+                                                      initializer=init_parse_worker, initargs=(self.chunk_size,))
+            return self.parse_pool
+
+    def get_embed_pool(self) -> ProcessPoolExecutor:
+        with self.pool_lock:
+            if self.embed_pool is None:
+                # spawn instead of fork, the server process already runs threads
+                threads = max(1, (os.cpu_count() or 1) // self.embed_workers)
+                self.embed_pool = ProcessPoolExecutor(max_workers=self.embed_workers, mp_context=multiprocessing.get_context("spawn"),
+                                                      initializer=init_embed_worker, initargs=(self.embedding_factory, threads))
+            return self.embed_pool
+
+    def parse_files(self, files: Iterable[Tuple]) -> Iterator[Tuple[Tuple, Tuple[str, any]]]:
+        # parse and chunk (filename, data, is last, size, is url list, ...) tuples across the process pool, yielding (file, result) in input order;
+        # only a fixed window of files is in flight, so a slow consumer holds back reading further input
+        parse_pool = self.get_parse_pool()
+        pending = deque()
+        for file in files:
+            pending.append((file, parse_pool.submit(parse_file, file[0], file[1], file[4])))
+            if len(pending) >= self.parse_window:
+                file, future = pending.popleft()
+                yield file, self.parse_result(file, future)
+        while pending:
+            file, future = pending.popleft()
+            yield file, self.parse_result(file, future)
+
+    def parse_result(self, file: Tuple, future) -> Tuple[str, any]:
+        with metrics.span("ingest_parse_wait"):
+            result = future.result()
+        # url lists are fetched here rather than in the workers, every worker would otherwise keep its own
+        # per-host schedule and a host would get requests parse_workers times as often as host_interval allows
+        if result[0] == "urls":
+            with metrics.span("ingest_fetch_urls"):
+                result = self.upload_handler.handle_urls(result[1], file[0])
+        return result
+
+    def buffered_bytes(self, chunks: List[str]) -> int:
+        # what the write buffer holds for chunks until they are stored, counted against write_buffer_bytes
+        return sum(len(chunk) for chunk in chunks) * CHUNK_TEXT_COPIES + len(chunks) * self.vector_bytes * CHUNK_VECTOR_COPIES
+
+    def get_embeddings(self, ids: List[str], documents: List[str]) -> List[List[float]]:
+        # reuse cached vectors for known content hashes and only embed the rest
+        cached = {}
+        for start in range(0, len(ids), self.write_batch_size):
+            batch = self.embedding_cache.get(ids=ids[start:start + self.write_batch_size], include=["embeddings"])
+            cached.update(zip(batch["ids"], batch["embeddings"]))
+        missing = [(chunk_id, document) for chunk_id, document in zip(ids, documents) if chunk_id not in cached]
+        print(f"embedding cache hits: {len(ids) - len(missing)}, misses: {len(missing)}")
+        start = 0
+        for batch_embeddings in self.embed([document for _, document in missing]):
+            batch_ids = [chunk_id for chunk_id, _ in missing[start:start + len(batch_embeddings)]]
+            self.embedding_cache.upsert(ids=batch_ids, embeddings=batch_embeddings, metadatas=[{"cached_at": time.time()}] * len(batch_ids))
+            cached.update(zip(batch_ids, batch_embeddings))
+            start += len(batch_embeddings)
+        if missing:
+            self.prune_embedding_cache()
+        if cached:
+            self.vector_bytes = len(next(iter(cached.values()))) * PYTHON_FLOAT_BYTES
+        return [cached[chunk_id] for chunk_id in ids]
 
-        return self.add_processed_documents(documents, ids, metadatas)
-    
-    def read_zip_contents(self, file_content: bytes, filename: str) -> Tuple[str, List[Tuple[str, str]]]:
+    def prune_embedding_cache(self):
+        # once the cache is over its size the oldest vectors are dropped down to nine tenths of it, so every entry's
+        # timestamp is only read again after another tenth of the size was cached; entries from before timestamps go first
+        if not self.prune_lock.acquire(blocking=False):
+            return
         try:
-            extracted_contents = self.upload_handler.extract_zip_contents(file_content)
-            return ["zip", extracted_contents]
-        except Exception as e:
-            return ["error", f"Failed to read zip contents for {filename}: {str(e)}"]
+            count = self.embedding_cache.count()
+            if count <= self.embedding_cache_size:
+                return
+            entries = []
+            for offset in range(0, count, self.write_batch_size):
+                batch = self.embedding_cache.get(include=["metadatas"], limit=self.write_batch_size, offset=offset)
+                entries.extend(((metadata or {}).get("cached_at", 0), chunk_id) for chunk_id, metadata in zip(batch["ids"], batch["metadatas"]))
+            entries.sort()
+            expired = [chunk_id for _, chunk_id in entries[:len(entries) - self.embedding_cache_size * 9 // 10]]
+            for start in range(0, len(expired), self.write_batch_size):
+                self.embedding_cache.delete(ids=expired[start:start + self.write_batch_size])
+            metrics.increment("embedding_cache_evicted_total", len(expired))
+        finally:
+            self.prune_lock.release()
+
+    def embed(self, documents: List[str]) -> Iterator[List[List[float]]]:
+        # embed chunk texts in batches of embed_batch_size, yielding each batch's embeddings in input order;
+        # the ingest_embed stage is the time the writer spends waiting for embeddings
+        batches = (documents[start:start + self.embed_batch_size] for start in range(0, len(documents), self.embed_batch_size))
+        if self.embed_workers <= 1:
+            for batch in batches:
+                with metrics.span("ingest_embed"):
+                    embeddings = self.embedding_function(batch)
+                yield embeddings
+        else:
+            embed_pool = self.get_embed_pool()
+            pending = deque()
+            try:
+                for batch in batches:
+                    pending.append(embed_pool.submit(embed_batch, batch))
+                    if len(pending) >= self.embed_window:
+                        with metrics.span("ingest_embed"):
+                            embeddings = pending.popleft().result()
+                        yield embeddings
+                while pending:
+                    with metrics.span("ingest_embed"):
+                        embeddings = pending.popleft().result()
+                    yield embeddings
+            finally:
+                # the writer failed or stopped early, batches that have not started are not needed any more
+                for future in pending:
+                    future.cancel()
+        metrics.increment("ingest_chunks_embedded_total", len(documents))
 
-    def add_processed_documents(self, documents: List[str], ids: List[str], metadatas: List[Dict[str, str]]) -> Tuple[str, str]:
+    def add_processed_documents(self, documents: List[str], ids: List[str], metadatas: List[Dict[str, str]], collection_id: str) -> Tuple[str, str, int]:
+        # the third element is the number of chunks embedded
+        new_ids = []
         try:
-            self.collection.add(documents=documents, metadatas=metadatas, ids=ids)
-            return ["success", ""]
+            partition = self.get_partition(collection_id)
+            # collapse repeated chunks and remember every (chunk, document) reference
+            unique_chunks = {}
+            references = set()
+            for document, chunk_id, metadata in zip(documents, ids, metadatas):
+                unique_chunks.setdefault(chunk_id, (document, metadata))
+                references.add((chunk_id, metadata['document_id']))
+            # chunks already in this collection only gain a reference, their vectors are left alone
+            chunk_ids = list(unique_chunks)
+            existing_ids = set()
+            for start in range(0, len(chunk_ids), self.write_batch_size):
+                existing_ids.update(partition.get(ids=chunk_ids[start:start + self.write_batch_size], include=[])["ids"])
+            pending_ids = [chunk_id for chunk_id in chunk_ids if chunk_id not in existing_ids]
+            for start in range(0, len(pending_ids), self.write_batch_size):
+                batch_ids = pending_ids[start:start + self.write_batch_size]
+                batch_documents = [unique_chunks[chunk_id][0] for chunk_id in batch_ids]
+                batch_metadatas = [unique_chunks[chunk_id][1] for chunk_id in batch_ids]
+                batch_embeddings = self.get_embeddings(batch_ids, batch_documents)
+                with metrics.span("ingest_write"):
+                    partition.add(documents=batch_documents, metadatas=batch_metadatas, embeddings=batch_embeddings, ids=batch_ids)
+                new_ids.extend(batch_ids)
+                self.lexical_index.add(collection_id, batch_ids, batch_documents)
+            self.database.add_chunk_references(collection_id, references)
+            self.semantic_cache.invalidate(collection_id)
+            return ["success", "", len(ids)]
         except Exception as e:
+            # do not leave the batches that were already written behind
+            if new_ids:
+                partition.delete(ids=new_ids)
+                self.lexical_index.remove(collection_id, new_ids)
             filename = metadatas[0]['filename'] if metadatas else "Unknown"
-            return ["error", f"An error occurred while embedding {filename}: {str(e)}"]
+            return ["error", f"An error occurred while embedding {filename}: {str(e)}", 0]
         
-    def remove_documents(self, document_ids: List[str]) -> Tuple[str, str]:
+    def remove_documents(self, document_ids: List[str], collection_id: str) -> Tuple[str, str]:
         try:
-            for doc_id in document_ids:
-                self.collection.remove(where={"document_id": doc_id})
+            if not document_ids:
+                return ["success", ""]
+            partition = self.get_partition(collection_id)
+            orphaned_ids, surviving_owners = self.database.remove_chunk_references(collection_id, document_ids)
+            self.release_chunks(partition, collection_id, orphaned_ids, surviving_owners)
+            # chunks stored before content hashing have no references and are removed by document id
+            legacy_ids = partition.get(where={"document_id": {"$in": list(document_ids)}}, include=[])["ids"]
+            if legacy_ids:
+                partition.delete(ids=legacy_ids)
+                self.lexical_index.remove(collection_id, legacy_ids)
+            self.semantic_cache.invalidate(collection_id)
             return ["success", ""]
         except Exception as e:
             return ["error", f"An error occurred while removing documents: {str(e)}"]
 
-    def retrieve_documents(self, query: str, num_docs: int = 5, metadata_filters: Dict[str, str] = None) -> Tuple[str, str, List[Dict[str, any]]]:
+    def release_chunks(self, partition, collection_id: str, orphaned_ids: List[str], surviving_owners: Dict[str, Tuple[str, str]]):
+        # shared chunks stay in the index, their metadata moves over to a document that still references them
+        if surviving_owners:
+            surviving = partition.get(ids=list(surviving_owners), include=["metadatas"])
+            metadatas = []
+            for chunk_id, metadata in zip(surviving["ids"], surviving["metadatas"]):
+                document_id, title = surviving_owners[chunk_id]
+                metadatas.append({**metadata, 'document_id': document_id, 'filename': title or metadata['filename']})
+            partition.update(ids=surviving["ids"], metadatas=metadatas)
+        # chunks no longer referenced by any document are deleted
+        for start in range(0, len(orphaned_ids), self.write_batch_size):
+            partition.delete(ids=orphaned_ids[start:start + self.write_batch_size])
+        self.lexical_index.remove(collection_id, list(orphaned_ids))
+
+    def replace_document(self, document_id: str, collection_id: str, filename: str, chunk_batches: Iterable[List[str]]) -> Tuple[str, str, Dict[str, int]]:
+        # bring a stored document in line with its new content by chunk hash: only chunks the document did not
+        # reference before are embedded, only chunks it no longer contains are released, the document_id stays;
+        # chunk_batches yields lists of chunk texts so large uploads can be diffed while they are parsed
+        old_ids = set(self.database.get_chunk_hashes(collection_id, document_id))
+        seen_ids, added_ids = set(), []
+        try:
+            partition = self.get_partition(collection_id)
+            for chunks in chunk_batches:
+                documents, ids, metadatas = self.prepare_chunks(chunks, filename, document_id, collection_id)
+                fresh = [(document, chunk_id, metadata) for document, chunk_id, metadata in zip(documents, ids, metadatas)
+                         if chunk_id not in old_ids and chunk_id not in seen_ids]
+                seen_ids.update(ids)
+                if not fresh:
+                    continue
+                fresh_documents, fresh_ids, fresh_metadatas = (list(column) for column in zip(*fresh))
+                processing_result = self.add_processed_documents(fresh_documents, fresh_ids, fresh_metadatas, collection_id)
+                if processing_result[0] != "success":
+                    raise RuntimeError(processing_result[1])
+                added_ids.extend(fresh_ids)
+        except Exception as e:
+            # the old chunk set is still complete, dropping what the new content added restores the document
+            if added_ids:
+                orphaned_ids, surviving_owners = self.database.remove_chunk_references(collection_id, [document_id], added_ids)
+                self.release_chunks(partition, collection_id, orphaned_ids, surviving_owners)
+                self.semantic_cache.invalidate(collection_id)
+            return ["error", f"An error occurred while replacing {filename}: {str(e)}", {}]
+
+        try:
+            vanished_ids = list(old_ids - seen_ids)
+            if vanished_ids:
+                orphaned_ids, surviving_owners = self.database.remove_chunk_references(collection_id, [document_id], vanished_ids)
+                self.release_chunks(partition, collection_id, orphaned_ids, surviving_owners)
+            # chunks stored before content hashing are dropped, unchanged chunks pick up a new title
+            owned = partition.get(where={"document_id": document_id}, include=["metadatas"])
+            legacy_ids, renamed_ids, renamed_metadatas = [], [], []
+            for chunk_id, metadata in zip(owned["ids"], owned["metadatas"]):
+                if chunk_id not in old_ids and chunk_id not in seen_ids:
+                    legacy_ids.append(chunk_id)
+                elif metadata.get('filename') != filename:
+                    renamed_ids.append(chunk_id)
+                    renamed_metadatas.append({**metadata, 'filename': filename})
+            if legacy_ids:
+                partition.delete(ids=legacy_ids)
+                self.lexical_index.remove(collection_id, legacy_ids)
+            if renamed_ids:
+                partition.update(ids=renamed_ids, metadatas=renamed_metadatas)
+            self.semantic_cache.invalidate(collection_id)
+            counts = {"added": len(added_ids), "removed": len(vanished_ids) + len(legacy_ids), "unchanged": len(seen_ids & old_ids)}
+            print(f"replaced {filename}: {counts['added']} new chunks, {counts['removed']} removed, {counts['unchanged']} unchanged")
+            return ["success", "", counts]
+        except Exception as e:
+            return ["error", f"An error occurred while removing old chunks of {filename}: {str(e)}", {}]
+
+    def remove_collection(self, collection_id: str) -> Tuple[str, str]:
+        # dropping the partition removes every chunk of the collection at once
+        self.semantic_cache.invalidate(collection_id)
+        self.lexical_index.drop(collection_id)
+        try:
+            self.db.delete_collection(self.partition_name(collection_id))
+            return ["success", ""]
+        except ValueError:
+            # nothing was ever embedded for this collection
+            return ["success", ""]
+        except Exception as e:
+            return ["error", f"An error occurred while removing collection {collection_id}: {str(e)}"]
+
+    def retrieve_documents(self, query: str, collection_id: str, num_docs: int = 5, metadata_filters: Dict[str, str] = None, num_candidates: int = None) -> Tuple[str, str, List[Dict[str, any]]]:
         try:
             print(f"query received: {query}")
             print(f"number of documents requested: {num_docs}")
             print(f"metadata filters: {metadata_filters}")
 
-            if metadata_filters is None:
-                query_result = self.collection.query(query_texts=[query], n_results=100)
-                print("querying without metadata filters.")
-            else:
-                query_result = self.collection.query(query_texts=[query], n_results=100, where=metadata_filters)
-                print("querying with metadata filters.")
+            # only the partition of the conversation's collection is searched
+            partition = self.get_partition(collection_id)
+            partition_size = partition.count()
+            if partition_size == 0:
+                print("collection has no embedded documents.")
+                return ["success", "", []]
+            num_candidates = min(num_candidates or self.candidate_count(partition_size, num_docs), partition_size)
+            metrics.increment("retrieval_queries_total")
+            metrics.increment("retrieval_candidates_total", num_candidates)
+
+            # filtered queries bypass the cache, entries are only keyed by collection and query
+            use_cache = metadata_filters is None
+            if use_cache:
+                generation = self.semantic_cache.generation(collection_id)
+                cached = self.semantic_cache.lookup_exact(collection_id, query, num_docs)
+                if cached is not None:
+                    metrics.increment("semantic_cache_retrieval_hits_total")
+                    return ["success", "", cached.documents]
 
-            documents = query_result["documents"][0]
-            distances = query_result["distances"][0]
-            metadatas = query_result["metadatas"][0]
+            # the query is embedded once here, for both the cache lookup and the chroma query
+            with metrics.span("retrieval_embed"):
+                query_embedding = self.query_embedder.submit(None, query)
+            if use_cache:
+                cached = self.semantic_cache.lookup(collection_id, query, query_embedding, num_docs)
+                if cached is not None:
+                    metrics.increment("semantic_cache_retrieval_hits_total")
+                    return ["success", "", cached.documents]
+                metrics.increment("semantic_cache_retrieval_misses_total")
 
-            # sort documents by distance in ascending order
-            sorted_docs = sorted(zip(documents, distances, metadatas), key=lambda x: x[1])
-            sorted_docs = [{"text": doc, "metadata": meta} for doc, _, meta in sorted_docs]
+            with metrics.span("retrieval_lookup"):
+                sorted_docs = self.find_candidates(query, query_embedding, partition, collection_id, num_candidates, metadata_filters)
+            if self.hybrid and metadata_filters is None:
+                sorted_docs = sorted_docs[:self.rerank_candidates]
+            else:
+                sorted_docs = self.trim_candidates(sorted_docs, num_docs)
+
+            # when everything fits or the vector ranking is decisive the reranker could not change the answer much
+            skip_reason = self.skip_rerank_reason(sorted_docs, num_docs)
+            if skip_reason is not None:
+                metrics.increment(f"retrieval_rerank_skipped_{skip_reason}_total")
+                if self.rerank_seconds is not None:
+                    metrics.increment("retrieval_rerank_saved_seconds_total", self.rerank_seconds)
+                print(f"skipping rerank: {skip_reason}")
+                reranked_docs = [{"text": doc["text"], "metadata": doc["metadata"]} for doc in sorted_docs[:num_docs]]
+                if use_cache:
+                    self.semantic_cache.store(collection_id, query, query_embedding, num_docs, reranked_docs, generation)
+                return ["success", "", reranked_docs]
 
-            # rerank all retrieved documents using Cohere's rerank model
+            # rerank the candidates using the configured reranker backend
             if sorted_docs:
                 print(f"top N documents to rerank: {num_docs}")
                 to_rank = [doc["text"] for doc in sorted_docs]
-                rerank_response = self.co.rerank(
-                    model="rerank-english-v3.0",
-                    query=query,
-                    documents=to_rank,
-                    top_n=num_docs
-                )
+                rerank_started = time.perf_counter()
+                ranking = self.reranker.rerank(query, to_rank, num_docs)
+                self.record_rerank(time.perf_counter() - rerank_started)
                 
                 reranked_docs = []
-                for rank in rerank_response.results:
-                    print(rank.relevance_score, rank.index)
-                    if rank.relevance_score >= self.similarity_score:
-                        doc_index = rank.index
+                for doc_index, relevance_score in ranking:
+                    print(relevance_score, doc_index)
+                    if relevance_score >= self.similarity_score:
                         doc_text = sorted_docs[doc_index]["text"]
                         metadata = sorted_docs[doc_index]["metadata"]
                         reranked_docs.append({"text": doc_text, "metadata": metadata})
                 
+                if use_cache:
+                    self.semantic_cache.store(collection_id, query, query_embedding, num_docs, reranked_docs, generation)
                 return ["success", "", reranked_docs]
             else:
                 print("no documents to rerank.")
@@ -111,3 +516,126 @@ class EmbeddingHandler:
         except Exception as e:
             print(f"an error occurred: {str(e)}")
             return ["error", f"an error occurred retrieving documents for query {query}: {str(e)}", []]
+
+    def candidate_count(self, partition_size: int, num_docs: int) -> int:
+        # small collections need few candidates, the pool grows with the log of the collection size up to num_candidates
+        base = max(num_docs * 4, 20)
+        scale = 1 + max(0.0, math.log10(max(partition_size, 1) / 1000))
+        return min(self.num_candidates, int(base * scale))
+
+    def trim_candidates(self, candidates: List[Dict[str, any]], num_docs: int) -> List[Dict[str, any]]:
+        # vector candidates come sorted by distance, the tail far behind the best one is dropped
+        if len(candidates) <= num_docs or candidates[0]["distance"] is None:
+            return candidates
+        limit = candidates[0]["distance"] * (1 + self.distance_band)
+        kept = [candidate for candidate in candidates if candidate["distance"] is not None and candidate["distance"] <= limit]
+        return kept if len(kept) >= num_docs else candidates[:num_docs]
+
+    def skip_rerank_reason(self, candidates: List[Dict[str, any]], num_docs: int) -> str:
+        # None means rerank; otherwise the name of the rule that made reranking unnecessary
+        if not candidates:
+            return None
+        if len(candidates) <= num_docs:
+            return "small"
+        top, following = candidates[:num_docs], candidates[num_docs]
+        if any(candidate["distance"] is None for candidate in top) or following["distance"] is None:
+            # bm25-only candidates have no distance to compare
+            return None
+        if top != sorted(top, key=lambda candidate: candidate["distance"]):
+            # fusion reordered the top, the rankings disagree
+            return None
+        last_kept = max(candidate["distance"] for candidate in top)
+        if following["distance"] > 0 and (following["distance"] - last_kept) / following["distance"] >= self.decisive_gap:
+            return "decisive"
+        return None
+
+    def record_rerank(self, seconds: float):
+        metrics.record("retrieval_rerank", seconds)
+        self.rerank_seconds = seconds if self.rerank_seconds is None else 0.9 * self.rerank_seconds + 0.1 * seconds
+
+    def load_lexical_index(self, collection_id: str):
+        # every chunk text of a collection's partition in batches, used to build its bm25 index
+        partition = self.get_partition(collection_id)
+        offset = 0
+        while True:
+            batch = partition.get(include=["documents"], limit=self.write_batch_size, offset=offset)
+            if not batch["ids"]:
+                break
+            offset += len(batch["ids"])
+            yield batch["ids"], batch["documents"]
+
+    def find_candidates(self, query: str, query_embedding: List[float], partition, collection_id: str, num_candidates: int, metadata_filters: Dict[str, str] = None, hybrid: bool = None) -> List[Dict[str, any]]:
+        # vector candidates by distance, fused with bm25 candidates by reciprocal rank when hybrid;
+        # bm25 knows nothing about metadata, so filtered queries are vector only
+        hybrid = self.hybrid if hybrid is None else hybrid
+        if metadata_filters is None:
+            print("querying without metadata filters.")
+        else:
+            print("querying with metadata filters.")
+        filters_key = None if metadata_filters is None else json.dumps(metadata_filters, sort_keys=True)
+        query_result = self.vector_lookup.submit((collection_id, filters_key), (query_embedding, num_candidates))
+
+        # sort documents by distance in ascending order
+        dense = sorted(zip(query_result["ids"], query_result["documents"], query_result["distances"], query_result["metadatas"]), key=lambda x: x[2])
+        candidates = {chunk_id: {"text": doc, "metadata": meta, "distance": distance} for chunk_id, doc, distance, meta in dense}
+        if not hybrid or metadata_filters is not None:
+            return list(candidates.values())
+
+        lexical = self.lexical_index.search(collection_id, query, num_candidates)
+        if lexical is None:
+            # the collection's bm25 index is still being built
+            metrics.increment("retrieval_lexical_not_ready_total")
+            return list(candidates.values())
+        fused = reciprocal_rank_fusion([[chunk_id for chunk_id, _, _, _ in dense], [chunk_id for chunk_id, _ in lexical]], self.fusion_k)[:num_candidates]
+        # chunks only bm25 found still need their text and metadata
+        missing = [chunk_id for chunk_id, _ in fused if chunk_id not in candidates]
+        if missing:
+            fetched = partition.get(ids=missing, include=["documents", "metadatas"])
+            for chunk_id, doc, meta in zip(fetched["ids"], fetched["documents"], fetched["metadatas"]):
+                candidates[chunk_id] = {"text": doc, "metadata": meta, "distance": None}
+        return [candidates[chunk_id] for chunk_id, _ in fused if chunk_id in candidates]
+
+    def embed_queries(self, key: None, queries: List[str]) -> List[List[float]]:
+        return self.embedding_function(queries)
+
+    def query_partition(self, key: Tuple[str, str], items: List[Tuple[List[float], int]]) -> List[Dict[str, List[any]]]:
+        # one chroma query for a batch of (embedding, n_results), asked for the largest n_results and cut per query
+        collection_id, filters_key = key
+        n_results = max(num_results for _, num_results in items)
+        where = None if filters_key is None else json.loads(filters_key)
+        query_result = self.get_partition(collection_id).query(query_embeddings=[embedding for embedding, _ in items], n_results=n_results, where=where)
+        fields = ("ids", "documents", "distances", "metadatas")
+        return [{field: query_result[field][index][:num_results] for field in fields} for index, (_, num_results) in enumerate(items)]
+
+    def migrate_legacy_collection(self, document_collections: Dict[str, str], batch_size: int = 1000, delete_legacy: bool = False) -> Tuple[str, str]:
+        # copy chunks (with their stored embeddings) from the old global collection into per-collection partitions
+        try:
+            legacy = self.db.get_or_create_collection(self.legacy_collection_name)
+            migrated, skipped, offset = 0, 0, 0
+            while True:
+                batch = legacy.get(include=["documents", "metadatas", "embeddings"], limit=batch_size, offset=offset)
+                if not batch["ids"]:
+                    break
+                offset += len(batch["ids"])
+                grouped = {}
+                for chunk_id, document, metadata, embedding in zip(batch["ids"], batch["documents"], batch["metadatas"], batch["embeddings"]):
+                    collection_id = document_collections.get(metadata.get("document_id"))
+                    if collection_id is None:
+                        # chunk belongs to a document that no longer exists in the database
+                        skipped += 1
+                        continue
+                    group = grouped.setdefault(collection_id, {"ids": [], "documents": [], "metadatas": [], "embeddings": []})
+                    group["ids"].append(chunk_id)
+                    group["documents"].append(document)
+                    group["metadatas"].append({**metadata, "collection_id": collection_id})
+                    group["embeddings"].append(embedding)
+                for collection_id, group in grouped.items():
+                    self.get_partition(collection_id).upsert(**group)
+                    # rebuilt from the partition in the background on its next search
+                    self.lexical_index.drop(collection_id)
+                    migrated += len(group["ids"])
+            if delete_legacy:
+                self.db.delete_collection(self.legacy_collection_name)
+            return ["success", f"Migrated {migrated} chunks, skipped {skipped} orphaned chunks"]
+        except Exception as e:
+            return ["error", f"An error occurred while migrating the legacy collection: {str(e)}"]
@@ -6,21 +6,23 @@ uvicorn FastAPI:app --port 8000 --reload
 
 """
 
-from fastapi import FastAPI, HTTPException, File, UploadFile, Form
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, HTTPException, File, UploadFile, Form, Query
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
+import asyncio
+import tempfile
 import time
 import os
 import uuid
 
 # import ModularChatbot from wherever it is defined
 from ChatBot import ModularChatbot
-from LLM import LLMInteraction
-from Database import Database
-
-iso_LLM = LLMInteraction()
+from Database import Database, AsyncDatabase
+from IngestionJobs import IngestionQueue, IngestionPipeline
+from Metrics import metrics, server_timing
 
 app = FastAPI()
 
@@ -32,32 +34,119 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# initialize Database here
+# initialize Database here, endpoints use the async wrapper so queries run off the event loop
 db = Database()
+adb = AsyncDatabase(db)
 
 # initialize ModularChatbot here
-chatbot = ModularChatbot(database=db)
+chatbot = ModularChatbot(database=db, async_database=adb)
+
+# chat generations still running, some of them for clients that already disconnected
+chat_tasks = set()
+metrics.register_collector(lambda: {"chat_generations_in_flight": len(chat_tasks)})
+
+# initialize the background ingestion workers here
+ingestion_queue = IngestionQueue(max_workers=2)
+ingestion_pipeline = IngestionPipeline(chatbot.embedding_handler, db)
 
 class ChatRequest(BaseModel):
     user_id: str
     message: str
     conversation_id: str
+    # overrides the user's saved model for this request only
+    model: Optional[str] = None
+    # return the time spent in each stage up to the first chunk as a Server-Timing header
+    timing: bool = False
 
 @app.post("/chat/")
 async def chat(request: ChatRequest):
     print(request.conversation_id)
-    def response_stream():
-        for response, similar_documents in chatbot.handle_query(request.message, request.user_id, request.conversation_id):
-            yield response
-    return StreamingResponse(response_stream())
+    chunks = asyncio.Queue()
+    cancel_event = asyncio.Event()
+    finished = object()
+
+    timings = {}
+
+    async def produce():
+        # the generation runs as its own task, so starlette cancelling the response on disconnect never
+        # interrupts it mid-await; it sees cancel_event on the next chunk, closes the model stream and saves
+        if request.timing:
+            metrics.collect_request_timings(timings)
+        try:
+            async for response, similar_documents in chatbot.handle_query_async(request.message, request.user_id, request.conversation_id, cancel_event=cancel_event, model=request.model):
+                chunks.put_nowait(response)
+        finally:
+            chunks.put_nowait(finished)
+
+    def start_producer():
+        producer = asyncio.create_task(produce())
+        # the event loop only keeps weak references to tasks, hold on to it until the generation is done
+        chat_tasks.add(producer)
+        producer.add_done_callback(chat_tasks.discard)
+        return producer
+
+    async def response_stream(producer=None, first=None):
+        producer = producer or start_producer()
+        try:
+            response = first if first is not None else await chunks.get()
+            while response is not finished:
+                yield response
+                response = await chunks.get()
+        finally:
+            # starlette cancels this generator when the client disconnects, tell the generation to stop
+            cancel_event.set()
+        await producer
+
+    if not request.timing:
+        return StreamingResponse(response_stream())
+    # headers go out before the body and starlette cannot send trailers, so the response waits for the first
+    # chunk and the header carries the stages up to it; the stages after it are only in /metrics
+    started = time.perf_counter()
+    producer = start_producer()
+    first = await chunks.get()
+    first_chunk = time.perf_counter() - started
+    return StreamingResponse(response_stream(producer, first), headers={"Server-Timing": server_timing({**timings, "first_chunk": first_chunk})})
+
+@app.get("/get_metrics/")
+async def get_metrics():
+    return metrics.snapshot()
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 class ModelUpdateRequest(BaseModel):
     name_of_model: str
+    user_id: str
+
+class DefaultModelRequest(BaseModel):
+    name_of_model: str
 
 @app.post("/update_model/")
 async def update_model(request: ModelUpdateRequest):
-    chatbot.llm_interaction.switch_model(request.name_of_model)
-    return {"message": f"Model updated to {request.name_of_model}"}
+    # local models are pulled in the background, poll /get_model_status/ until the pull is ready
+    if not await adb.set_user_model(request.user_id, request.name_of_model):
+        raise HTTPException(status_code=404, detail=f"User {request.user_id} not found")
+    pull_status = chatbot.llm_interaction.prepare_model(request.name_of_model)
+    return {"message": f"Model updated to {request.name_of_model}", "pull": pull_status}
+
+@app.post("/admin/update_default_model/")
+async def update_default_model(request: DefaultModelRequest):
+    # the server default applies to every user without a saved model; the frontend does not proxy this path
+    pull_status = chatbot.llm_interaction.switch_model(request.name_of_model)
+    return {"message": f"Default model updated to {request.name_of_model}", "pull": pull_status}
+
+@app.get("/get_model_status/")
+async def get_model_status(name_of_model: Optional[str] = None):
+    # without a model name, the status of every pull this process started
+    if name_of_model is None:
+        return {"models": [pull.to_dict() for pull in chatbot.llm_interaction.pulls.all()]}
+    return chatbot.llm_interaction.model_status(name_of_model)
+
+@app.get("/get_user_model/")
+async def get_user_model(user_id: str):
+    model = await adb.get_user_model(user_id)
+    return {"model": model or chatbot.llm_interaction.model}
 
 @app.get("/get_paid_status/")
 async def get_paid_status():
@@ -72,7 +161,7 @@ class User(BaseModel):
 @app.post("/add_user/")
 async def add_user(user: User):
     user_id = user.user_id
-    user_added = db.add_user(user_id)
+    user_added = await adb.add_user(user_id)
     if user_added:
         return {"message": f"User {user_id} added successfully"}
     else:
@@ -90,37 +179,37 @@ class ConversationId(BaseModel):
 
 @app.post("/add_conversation/")
 async def add_conversation(conversation: Conversation):
-    conversation_id = db.add_conversation(collection_id=conversation.collection_id, user_id=conversation.user_id, conversation_id=conversation.conversation_id)
+    conversation_id = await adb.add_conversation(collection_id=conversation.collection_id, user_id=conversation.user_id, conversation_id=conversation.conversation_id)
     return {"conversation_id": conversation_id}
 
 @app.post("/delete_conversation/")
 async def delete_conversation(conversation_id: ConversationId):
-    db.remove_conversation(conversation_id.conversation_id)
+    await adb.remove_conversation(conversation_id.conversation_id)
     return {"message": f"Conversation deleted: {conversation_id.conversation_id}"}
 
 @app.get("/get_conversations_by_user/")
 async def get_conversations_by_user(user_id: str):
-    conversations = db.get_conversations_by_user(user_id)
+    conversations = await adb.get_conversations_by_user(user_id)
     return {"conversations": conversations}
 
 @app.get("/get_conversations_by_collection/")
 async def get_conversations_by_collection(collection_id: str):
-    conversations = db.get_conversations_by_collection(collection_id)
+    conversations = await adb.get_conversations_by_collection(collection_id)
     return {"conversations": conversations}
 
 @app.get("/get_empty_conversation_by_collection/")
 async def get_empty_conversation_by_collection(collection_id: str):
-    conversations = db.get_empty_conversation_by_collection(collection_id)
+    conversations = await adb.get_empty_conversation_by_collection(collection_id)
     return {"conversations": conversations}
 
 @app.get("/get_conversation_messages/")
 async def get_conversation_messages(conversation_id: str):
-    conversation_messages = db.get_conversation_messages(conversation_id)
+    conversation_messages = await adb.get_conversation_messages(conversation_id)
     return {"conversation_messages": conversation_messages}
 
 @app.get("/get_conversation_exists/")
 async def get_conversation_exists(conversation_id: str, user_id: str):
-    conversation_exists = db.conversation_exists(conversation_id, user_id)
+    conversation_exists = await adb.conversation_exists(conversation_id, user_id)
     return {"message": conversation_exists}
 
 class MessageRequest(BaseModel):
@@ -132,7 +221,7 @@ class MessageRequest(BaseModel):
 @app.post("/add_message/")
 async def add_message(request: MessageRequest):
     # add a message to a conversation
-    message_id = db.add_message(conversation_id=request.conversation_id, text=request.text, 
+    message_id = await adb.add_message(conversation_id=request.conversation_id, text=request.text, 
                     is_user=request.is_user, is_complete=request.is_complete)
     return {"message_id": message_id}
     
@@ -143,12 +232,12 @@ class Collection(BaseModel):
     
 @app.get("/get_collection_exists/")
 async def get_collection_exists(collection_id: str, user_id: str):
-    collection_exists = db.collection_exists(collection_id=collection_id, user_id=user_id)
+    collection_exists = await adb.collection_exists(collection_id=collection_id, user_id=user_id)
     return {"message": collection_exists}
     
 @app.post("/add_collection/")
 async def add_collection(collection: Collection):
-    collection_id = db.add_collection(user_id=collection.user_id, name=collection.name, collection_id=collection.collection_id)
+    collection_id = await adb.add_collection(user_id=collection.user_id, name=collection.name, collection_id=collection.collection_id)
     if collection_id is None:
         collection_id = "exists"
     return {"collection_id": collection_id}
@@ -158,42 +247,54 @@ class CollectionId(BaseModel):
 
 @app.post("/delete_collection/")
 async def delete_collection(collection_id: CollectionId):
-    print(f"Starting deletion of collection with ID: {collection_id.collection_id}")
-    # retrieve all document IDs associated with the collection
-    documents = db.get_documents_by_collection(collection_id.collection_id)
-    print(f"Retrieved documents: {documents}")
-    # attempt to remove documents from the embedding handler
-    doc_ids = [doc.document_id for doc in documents]
-    print(f"Document IDs to remove: {doc_ids}")
-    try:
-        chatbot.embedding_handler.remove_documents(doc_ids)
-        print("Documents successfully removed from embedding handler.")
-    except Exception as e:
-        print(f"Failed to delete documents: {str(e)}")
-        return {"status": "error", "message": f"Failed to delete documents: {str(e)}"}
+    # drop the collection's vector partition in one call
+    removal_status, removal_error = await run_in_threadpool(chatbot.embedding_handler.remove_collection, collection_id.collection_id)
+    if removal_status == "error":
+        print(f"Failed to delete documents: {removal_error}")
+        return {"status": "error", "message": f"Failed to delete documents: {removal_error}"}
     # remove the collection itself
-    db.remove_collection(collection_id.collection_id)
+    await adb.remove_collection(collection_id.collection_id)
     print(f"Collection {collection_id.collection_id} removed from database.")
     return {"message": f"Collection deleted: {collection_id.collection_id}"}
 
 @app.get("/get_collections_by_user/")
 async def get_collections_by_user(user_id: str):
-    collections = db.get_collections_by_user(user_id)
+    collections = await adb.get_collections_by_user(user_id)
     return {"collections": collections}
 
 @app.get("/get_documents_by_collection/")
 async def get_documents_by_collection(collection_id: str):
-    documents = db.get_documents_by_collection(collection_id)
+    documents = await adb.get_documents_by_collection(collection_id)
     return {"documents": documents}
 
+### PAGINATED LISTINGS ###
+
+@app.get("/get_documents_page/")
+async def get_documents_page(collection_id: str, cursor: str = None, limit: int = Query(50, ge=1, le=200)):
+    return await adb.get_documents_page(collection_id, cursor=cursor, limit=limit)
+
+@app.get("/get_conversations_page/")
+async def get_conversations_page(user_id: str = None, collection_id: str = None, cursor: str = None, limit: int = Query(50, ge=1, le=200)):
+    if user_id is None and collection_id is None:
+        raise HTTPException(status_code=400, detail="Either user_id or collection_id is required")
+    return await adb.get_conversations_page(user_id=user_id, collection_id=collection_id, cursor=cursor, limit=limit)
+
+@app.get("/get_conversation_messages_page/")
+async def get_conversation_messages_page(conversation_id: str, cursor: str = None, limit: int = Query(50, ge=1, le=200)):
+    return await adb.get_conversation_messages_page(conversation_id, cursor=cursor, limit=limit)
+
 class DocumentId(BaseModel):
     document_id: str
     
 @app.post("/delete_document/")
 async def delete_document(document_id: DocumentId):
     try:
-        db.delete_document(document_id.document_id)
-        chatbot.embedding_handler.remove_documents([document_id.document_id])
+        document = await adb.get_document(document_id.document_id)
+        if document is None:
+            return {"status": "error", "message": f"Document not found: {document_id.document_id}"}
+        collection_id = document.collection_id
+        await adb.delete_document(document_id.document_id)
+        await run_in_threadpool(chatbot.embedding_handler.remove_documents, [document_id.document_id], collection_id)
         return {"status": "success", "message": f"Document deleted: {document_id.document_id}"}
     except Exception as e:
         return {"status": "error", "message": str(e)}
@@ -208,65 +309,53 @@ async def process_file(collection_id: str = Form(...), file: UploadFile = File(.
     filename = file.filename
     file_extension = os.path.splitext(filename)[1]
     print(f"Processing file: {filename} with extension: {file_extension}")
+    # spool the upload to disk block by block instead of reading it into memory, the job removes the file when done
+    with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as spool:
+        while block := await file.read(1024 * 1024):
+            spool.write(block)
     
+    # parsing, chunking and embedding run as a background job, the client polls /get_job_status/
     if file_extension == '.zip':
-        contents = await file.read()
-        print("Reading zip file contents")
-        zip_contents = chatbot.embedding_handler.read_zip_contents(contents, filename)
-        if zip_contents[0] == "error":
-            print(f"Error reading zip contents: {zip_contents[1]}")
-            return {"status": "error", "message": f"Error reading zip contents: {zip_contents[1]}"}
-        
-        processing_results = []
-        document_ids = []
-        for file_name, file_content in zip_contents[1]:
-            document_id = str(uuid.uuid4())
-            print(f"Processing file: {file_name} with generated document ID: {document_id}")
-            processing_result = chatbot.embedding_handler.fully_process_file(file_content.encode(), file_name, document_id)
-            if processing_result[0] == "success":
-                db.add_document(document_id, collection_id, file_name, file_content.encode())
-                processing_results.append({"document_id": document_id, "status": "success", "filename": file_name})
-                document_ids.append(document_id)
-            else:
-                processing_results.append({"document_id": document_id, "status": "error", "filename": file_name, "message": processing_result[1]})
-                print(f"Error processing file: {file_name}, aborting and cleaning up")
-                # if any file fails, abort and clean up all processed documents
-                if document_ids:
-                    chatbot.embedding_handler.remove_documents(document_ids)
-                    for doc_id in document_ids:
-                        db.delete_document(doc_id)
-                return {"status": "error", "message": "Not all files in zip could be processed successfully, aborted and cleaned up partial data", "documents": processing_results}
-        
-        print("All files in zip processed successfully")
-        return {"status": "success", "message": "All files in zip processed successfully", "documents": processing_results}
+        job = ingestion_queue.submit("zip", filename, collection_id, ingestion_pipeline.process_zip, spool.name, filename, collection_id)
     else:
         document_id = str(uuid.uuid4())
-        contents = await file.read()
-        print(f"Processing single file: {filename} with document ID: {document_id}")
-        processing_result = chatbot.embedding_handler.fully_process_file(contents, filename, document_id)
-        if processing_result[0] == "success":
-            # add the document to the database if processing was successful
-            db.add_document(document_id, collection_id, filename, contents)
-            print(f"File processed and added to collection ID: {collection_id}")
-            return {"status": "success", "message": "File processed successfully", "document_id": document_id}
-        else:
-            print(f"Error processing file: {filename}")
-            return {"status": "error", "message": f"Error processing file: {processing_result[1]}", "document_id": document_id}
+        job = ingestion_queue.submit("file", filename, collection_id, ingestion_pipeline.process_file, spool.name, filename, collection_id, document_id)
+    return {"status": "queued", "message": f"Processing of {filename} queued", "job_id": job.job_id}
 
 @app.post("/process_url/")
 async def process_url(collection_id: str = Form(...), url: str = Form(...)):
-    document_id = str(uuid.uuid4())
     if not url:
         raise HTTPException(status_code=400, detail="No URL provided")
-    try:
-        print(f"Processing URL for collection ID: {collection_id}")
-        # process the URL using the embedding handler
-        processing_result = chatbot.embedding_handler.fully_process_url(url, document_id)
-        if processing_result[0] == "success":
-            # add the document to the database if processing was successful
-            db.add_document(document_id, collection_id, url, "URL content processed")
-            return {"status": "success", "message": "URL processed successfully", "document_id": document_id}
-        else:
-            return {"status": "error", "message": f"Error processing URL: {processing_result[1]}", "document_id": document_id}
-    except Exception as e:
-        return {"status": "error", "message": f"Error processing URL: {str(e)}", "document_id": document_id}
+    document_id = str(uuid.uuid4())
+    job = ingestion_queue.submit("url", url, collection_id, ingestion_pipeline.process_url, url, collection_id, document_id)
+    return {"status": "queued", "message": f"Processing of {url} queued", "job_id": job.job_id, "document_id": document_id}
+
+@app.post("/replace_document/")
+async def replace_document(document_id: str = Form(...), file: Optional[UploadFile] = File(None), url: Optional[str] = Form(None)):
+    # new content for an existing document, only the chunks that changed are embedded and the document_id is kept
+    if not file and not url:
+        raise HTTPException(status_code=400, detail="No file or URL provided")
+    document = await adb.get_document(document_id)
+    if document is None:
+        raise HTTPException(status_code=404, detail=f"Document not found: {document_id}")
+    collection_id = document.collection_id
+    if url:
+        job = ingestion_queue.submit("replace", url, collection_id, ingestion_pipeline.replace_url, url, collection_id, document_id)
+        return {"status": "queued", "message": f"Replacement of {document_id} with {url} queued", "job_id": job.job_id, "document_id": document_id}
+
+    filename = file.filename
+    file_extension = os.path.splitext(filename)[1]
+    if file_extension == '.zip':
+        raise HTTPException(status_code=400, detail="A document can only be replaced by a single file")
+    with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as spool:
+        while block := await file.read(1024 * 1024):
+            spool.write(block)
+    job = ingestion_queue.submit("replace", filename, collection_id, ingestion_pipeline.replace_file, spool.name, filename, collection_id, document_id)
+    return {"status": "queued", "message": f"Replacement of {document_id} with {filename} queued", "job_id": job.job_id, "document_id": document_id}
+
+@app.get("/get_job_status/")
+async def get_job_status(job_id: str):
+    job = ingestion_queue.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No job found with ID: {job_id}")
+    return job.to_dict()
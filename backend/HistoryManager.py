@@ -0,0 +1,73 @@
+from typing import Dict, List
+
+CONTEXT_START = "<$$ THIS SIGNIFIES THE BEGINNING OF RELEVANT CONTEXTUAL DOCUMENTS $$>"
+CONTEXT_END = "<$$ THIS SIGNIFIES THE END OF ATTACHED DATA AND MARKS THE BEGINNING OF USER QUERY $$>\n\n"
+CITATIONS_START = "\n\n---\n\n### Document Citations:"
+
+class HistoryManager:
+    def __init__(self, llm_interaction, default_budget: int = 6000, model_budgets: Dict[str, int] = None, recent_messages: int = 6, summary_batch: int = 4):
+        self.llm_interaction = llm_interaction
+        # prompt token budget per model, the rest of the model's window is left for the response
+        self.default_budget = default_budget
+        self.model_budgets = model_budgets or {
+            "llama3:instruct": 6000,
+            "openai/gpt-4-turbo-preview": 12000,
+            "anthropic/claude-3-opus:beta": 12000,
+            "anthropic/claude-3-haiku:beta": 12000,
+            "anthropic/claude-3-sonnet:beta": 12000,
+        }
+        # number of newest messages kept verbatim, older ones are folded into the rolling summary
+        self.recent_messages = recent_messages
+        # fold older messages in groups so the summary is not regenerated on every turn
+        self.summary_batch = summary_batch
+
+    def estimate_tokens(self, text: str) -> int:
+        # rough count of about four characters per token, good enough for packing
+        return len(text) // 4 + 1
+
+    def strip_turn(self, message: Dict[str, str]) -> Dict[str, str]:
+        # stored turns never need the retrieved documents or the citations again
+        content = message["content"]
+        if CONTEXT_START in content and CONTEXT_END in content:
+            content = content.split(CONTEXT_END, 1)[1]
+        if CITATIONS_START in content:
+            content = content.split(CITATIONS_START, 1)[0]
+        return {"role": message["role"], "content": content}
+
+    def build_prompt(self, conversation_history: List[Dict[str, str]], summary: str, summarized_messages: int, prompt: str, model: str) -> List[Dict[str, str]]:
+        # system message, rolling summary, as many recent turns as fit the budget, then the current prompt
+        system_message = conversation_history[0]
+        turns = [self.strip_turn(message) for message in conversation_history[1:]][summarized_messages:]
+        budget = self.model_budgets.get(model, self.default_budget)
+        messages_head = [system_message]
+        if summary:
+            messages_head.append({"role": "system", "content": f"Summary of the earlier conversation: {summary}"})
+        used = sum(self.estimate_tokens(message["content"]) for message in messages_head) + self.estimate_tokens(prompt)
+        packed = []
+        # walk back from the newest turn, keeping user/assistant pairs together
+        for index in range(len(turns) - 1, -1, -2):
+            pair = turns[max(index - 1, 0):index + 1]
+            cost = sum(self.estimate_tokens(message["content"]) for message in pair)
+            if used + cost > budget:
+                break
+            packed = pair + packed
+            used += cost
+        return messages_head + packed + [{"role": "user", "content": prompt}]
+
+    def messages_to_fold(self, conversation_history: List[Dict[str, str]], summarized_messages: int) -> List[Dict[str, str]]:
+        # older messages that are due to be folded, empty until enough of them have piled up
+        turns = conversation_history[1:]
+        foldable = len(turns) - self.recent_messages - summarized_messages
+        # fold whole user/assistant pairs only
+        foldable -= foldable % 2
+        if foldable < self.summary_batch:
+            return []
+        return [self.strip_turn(message) for message in turns[summarized_messages:summarized_messages + foldable]]
+
+    def update_summary(self, conversation_history: List[Dict[str, str]], summary: str, summarized_messages: int, model: str = None):
+        # returns the new (summary, summarized_messages), unchanged until enough older messages have piled up
+        to_fold = self.messages_to_fold(conversation_history, summarized_messages)
+        if not to_fold:
+            return summary, summarized_messages
+        new_summary = self.llm_interaction.generate_summary(summary, to_fold, model)
+        return new_summary, summarized_messages + len(to_fold)
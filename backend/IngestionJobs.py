@@ -0,0 +1,305 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Tuple
+import threading
+import os
+import time
+import uuid
+
+from Metrics import metrics
+
+class IngestionJob:
+    def __init__(self, kind: str, name: str, collection_id: str):
+        self.job_id = str(uuid.uuid4())
+        self.kind = kind
+        self.name = name
+        self.collection_id = collection_id
+        # queued -> running -> success | error
+        self.status = "queued"
+        self.message = ""
+        self.files_total = 0
+        self.files_done = 0
+        self.chunks_embedded = 0
+        self.errors: List[Dict[str, str]] = []
+        self.documents: List[Dict[str, str]] = []
+        self.document_id = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.lock = threading.Lock()
+
+    def file_done(self, document: Dict[str, str], chunks: int):
+        with self.lock:
+            self.files_done += 1
+            self.chunks_embedded += chunks
+            self.documents.append(document)
+
+    def add_chunks(self, chunks: int):
+        with self.lock:
+            self.chunks_embedded += chunks
+
+    def file_failed(self, document: Dict[str, str]):
+        with self.lock:
+            self.errors.append({"filename": document["filename"], "message": document.get("message", "")})
+            self.documents.append(document)
+
+    def url_results(self, results: List[Dict[str, any]]):
+        # pages of a url list that could not be fetched, the rest of the list is still ingested
+        with self.lock:
+            for result in results:
+                if result["status"] == "error":
+                    self.errors.append({"filename": result["url"], "message": result["message"]})
+
+    def finish(self, status: str, message: str, document_id: str = None):
+        with self.lock:
+            self.status = status
+            self.message = message
+            if document_id is not None:
+                self.document_id = document_id
+            self.finished_at = time.time()
+
+    def is_finished(self) -> bool:
+        return self.status in ("success", "error")
+
+    def to_dict(self) -> Dict[str, any]:
+        with self.lock:
+            return {
+                "job_id": self.job_id,
+                "kind": self.kind,
+                "name": self.name,
+                "collection_id": self.collection_id,
+                "status": self.status,
+                "message": self.message,
+                "files_total": self.files_total,
+                "files_done": self.files_done,
+                "chunks_embedded": self.chunks_embedded,
+                "errors": list(self.errors),
+                "documents": list(self.documents),
+                "document_id": self.document_id,
+            }
+
+class IngestionQueue:
+    def __init__(self, max_workers: int = 2, retention_seconds: int = 3600):
+        # bounded pool, extra jobs wait in the executor's queue
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ingest")
+        self.retention_seconds = retention_seconds
+        self.jobs: Dict[str, IngestionJob] = {}
+        self.lock = threading.Lock()
+        metrics.register_collector(self.stats)
+
+    def submit(self, kind: str, name: str, collection_id: str, func, *args) -> IngestionJob:
+        # func is called as func(job, *args) on a worker thread
+        job = IngestionJob(kind, name, collection_id)
+        with self.lock:
+            self.evict_finished_jobs()
+            self.jobs[job.job_id] = job
+        self.executor.submit(self.run, job, func, *args)
+        return job
+
+    def run(self, job: IngestionJob, func, *args):
+        job.status = "running"
+        metrics.record("ingest_queue_wait", time.time() - job.created_at)
+        try:
+            with metrics.span(f"ingest_{job.kind}_job"):
+                func(job, *args)
+        except Exception as e:
+            print(f"Ingestion job {job.job_id} failed: {str(e)}")
+            job.finish("error", f"Error processing {job.name}: {str(e)}")
+        if not job.is_finished():
+            job.finish("success", f"{job.name} processed successfully")
+        metrics.increment(f"ingest_jobs_{job.status}_total")
+
+    def get_job(self, job_id: str) -> IngestionJob:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            statuses = [job.status for job in self.jobs.values()]
+        return {"ingest_jobs_queued": statuses.count("queued"), "ingest_jobs_running": statuses.count("running")}
+
+    def evict_finished_jobs(self):
+        # finished jobs are kept around for a while so clients can still poll the outcome
+        cutoff = time.time() - self.retention_seconds
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.finished_at and job.finished_at < cutoff]:
+            del self.jobs[job_id]
+
+class IngestionPipeline:
+    def __init__(self, embedding_handler, database):
+        self.embedding_handler = embedding_handler
+        self.database = database
+
+    def tag_segments(self, segments: Iterator[Tuple[str, bytes, bool, int, bool]], document_id: str = None):
+        # attach a document_id to every segment, each file becomes one document
+        current_id = None
+        for name, data, is_last, size, url_list in segments:
+            if current_id is None:
+                current_id = document_id or str(uuid.uuid4())
+            yield name, data, is_last, size, url_list, current_id
+            if is_last:
+                current_id = None
+
+    def ingest_segments(self, job: IngestionJob, segments: Iterator[Tuple[str, bytes, bool, int, bool]], collection_id: str, document_id: str = None) -> Tuple[str, str]:
+        # parse segments on the process pool and write chunks and document rows in bounded batches;
+        # on any failure everything stored so far is removed again, so the upload is all-or-nothing
+        started_ids = []
+        documents, ids, metadatas, rows = [], [], [], []
+        buffered_bytes = 0
+
+        def flush():
+            nonlocal buffered_bytes
+            if ids:
+                processing_result = self.embedding_handler.add_processed_documents(documents, ids, metadatas, collection_id)
+                if processing_result[0] != "success":
+                    return processing_result[1]
+                job.add_chunks(processing_result[2])
+            if rows:
+                with metrics.span("ingest_store_documents"):
+                    storage_result = self.database.add_documents(collection_id, rows)
+                if storage_result["status"] != "success":
+                    return storage_result["message"]
+            documents.clear()
+            ids.clear()
+            metadatas.clear()
+            rows.clear()
+            buffered_bytes = 0
+            return None
+
+        def is_full():
+            return len(ids) >= self.embedding_handler.write_batch_size or buffered_bytes >= self.embedding_handler.write_buffer_bytes
+
+        def abort(message):
+            print(f"{message}, aborting and cleaning up")
+            if started_ids:
+                self.embedding_handler.remove_documents(started_ids, collection_id)
+                self.database.delete_documents(started_ids)
+            return ["error", message]
+
+        try:
+            for (name, data, is_last, size, _, segment_document_id), result in self.embedding_handler.parse_files(self.tag_segments(segments, document_id)):
+                if not started_ids or started_ids[-1] != segment_document_id:
+                    started_ids.append(segment_document_id)
+                if result[0] != "success":
+                    job.file_failed({"document_id": segment_document_id, "status": "error", "filename": name, "message": result[1]})
+                    return abort(f"Error processing file: {name}")
+                if len(result) > 2:
+                    job.url_results(result[2])
+                chunk_documents, chunk_ids, chunk_metadatas = self.embedding_handler.prepare_chunks(result[1], name, segment_document_id, collection_id)
+                # the chunks of one segment can be more than the write buffer takes, it is flushed as it fills up
+                for chunk, chunk_id, metadata in zip(chunk_documents, chunk_ids, chunk_metadatas):
+                    documents.append(chunk)
+                    ids.append(chunk_id)
+                    metadatas.append(metadata)
+                    buffered_bytes += self.embedding_handler.buffered_bytes([chunk])
+                    if is_full():
+                        error = flush()
+                        if error:
+                            return abort(error)
+                if is_last:
+                    # the raw content is only kept for files that fit in a single segment
+                    content = data if len(data) >= size else f"Streamed file of {size} bytes, content not stored"
+                    rows.append((segment_document_id, name, content))
+                    buffered_bytes += len(content)
+                    job.file_done({"document_id": segment_document_id, "status": "success", "filename": name}, 0)
+                if is_full():
+                    error = flush()
+                    if error:
+                        return abort(error)
+            error = flush()
+            if error:
+                return abort(error)
+            return ["success", ""]
+        except Exception as e:
+            return abort(str(e))
+
+    def process_zip(self, job: IngestionJob, path: str, filename: str, collection_id: str):
+        try:
+            print("Reading zip file contents")
+            try:
+                job.files_total = len(self.embedding_handler.upload_handler.list_zip_members(path))
+            except Exception as e:
+                print(f"Error reading zip contents: {str(e)}")
+                job.finish("error", f"Error reading zip contents: Failed to read zip contents for {filename}: {str(e)}")
+                return
+
+            segments = self.embedding_handler.upload_handler.iter_segments(path, filename, self.embedding_handler.segment_bytes)
+            result = self.ingest_segments(job, segments, collection_id)
+            if result[0] != "success":
+                job.finish("error", f"Not all files in zip could be processed successfully, aborted and cleaned up partial data: {result[1]}")
+                return
+
+            print("All files in zip processed successfully")
+            job.finish("success", "All files in zip processed successfully")
+        finally:
+            os.remove(path)
+
+    def process_file(self, job: IngestionJob, path: str, filename: str, collection_id: str, document_id: str):
+        try:
+            job.files_total = 1
+            print(f"Processing single file: {filename} with document ID: {document_id}")
+            segments = self.embedding_handler.upload_handler.iter_segments(path, filename, self.embedding_handler.segment_bytes)
+            result = self.ingest_segments(job, segments, collection_id, document_id)
+            if result[0] == "success":
+                print(f"File processed and added to collection ID: {collection_id}")
+                job.finish("success", "File processed successfully", document_id)
+            else:
+                print(f"Error processing file: {filename}")
+                job.finish("error", f"Error processing file: {result[1]}", document_id)
+        finally:
+            os.remove(path)
+
+    def process_url(self, job: IngestionJob, url: str, collection_id: str, document_id: str):
+        job.files_total = 1
+        print(f"Processing URL for collection ID: {collection_id}")
+        processing_result = self.embedding_handler.fully_process_url(url, document_id, collection_id)
+        if processing_result[0] == "success":
+            # add the document to the database if processing was successful
+            self.database.add_document(document_id, collection_id, url, "URL content processed")
+            job.file_done({"document_id": document_id, "status": "success", "filename": url}, processing_result[2])
+            job.finish("success", "URL processed successfully", document_id)
+        else:
+            job.file_failed({"document_id": document_id, "status": "error", "filename": url, "message": processing_result[1]})
+            job.finish("error", f"Error processing URL: {processing_result[1]}", document_id)
+
+    def replace_document(self, job: IngestionJob, document_id: str, collection_id: str, name: str, chunk_batches: Iterator[List[str]], content):
+        # content is called once the chunks are stored, parsing may only know it at the end
+        result = self.embedding_handler.replace_document(document_id, collection_id, name, chunk_batches)
+        if result[0] != "success":
+            job.file_failed({"document_id": document_id, "status": "error", "filename": name, "message": result[1]})
+            job.finish("error", f"Error replacing document: {result[1]}", document_id)
+            return
+        storage_result = self.database.update_document(document_id, name, content())
+        if storage_result["status"] != "success":
+            job.finish("error", f"Error replacing document: {storage_result['message']}", document_id)
+            return
+        counts = result[2]
+        job.file_done({"document_id": document_id, "status": "success", "filename": name}, counts["added"])
+        job.finish("success", f"Document replaced: {counts['added']} new chunks, {counts['removed']} removed, {counts['unchanged']} unchanged", document_id)
+
+    def replace_file(self, job: IngestionJob, path: str, filename: str, collection_id: str, document_id: str):
+        try:
+            job.files_total = 1
+            print(f"Replacing document {document_id} with file: {filename}")
+            stored = []
+
+            def chunk_batches():
+                segments = self.embedding_handler.upload_handler.iter_segments(path, filename, self.embedding_handler.segment_bytes)
+                for (name, data, is_last, size, _), result in self.embedding_handler.parse_files(segments):
+                    if result[0] != "success":
+                        raise RuntimeError(result[1])
+                    if is_last:
+                        # the raw content is only kept for files that fit in a single segment
+                        stored.append(data if len(data) >= size else f"Streamed file of {size} bytes, content not stored")
+                    yield result[1]
+
+            self.replace_document(job, document_id, collection_id, filename, chunk_batches(), lambda: stored[-1] if stored else "")
+        finally:
+            os.remove(path)
+
+    def replace_url(self, job: IngestionJob, url: str, collection_id: str, document_id: str):
+        job.files_total = 1
+        print(f"Replacing document {document_id} with URL: {url}")
+        result = self.embedding_handler.upload_handler.handle_urls([url], "url")
+        if result[0] != "success":
+            job.file_failed({"document_id": document_id, "status": "error", "filename": url, "message": result[1]})
+            job.finish("error", f"Error processing URL: {result[1]}", document_id)
+            return
+        self.replace_document(job, document_id, collection_id, url, iter([result[1]]), lambda: "URL content processed")
@@ -1,107 +1,318 @@
 import ollama
 import requests
 import json
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
+from concurrent.futures import ThreadPoolExecutor
 import os
+import re
+import threading
+import time
+
+from Metrics import metrics
+
+PAID_MODELS = ["openai/gpt-4-turbo-preview", "anthropic/claude-3-opus:beta", "anthropic/claude-3-haiku:beta", "anthropic/claude-3-sonnet:beta"]
+
+def is_local_model(model):
+    return model.lower() not in PAID_MODELS
+
+def parse_numbered_titles(text, count):
+    # "1: title" lines from a batched title response, numbers the model skipped come back empty
+    titles = [""] * count
+    for line in text.splitlines():
+        match = re.match(r"\s*(\d+)\s*[:.)-]\s*(.+)", line)
+        if match and 1 <= int(match.group(1)) <= count:
+            titles[int(match.group(1)) - 1] = match.group(2).strip().strip('"')
+    return titles
+
+class ModelClient:
+    def __init__(self, model, api_key=None, keep_alive=None):
+        # clients for a single model, each model gets its own connection pools so a busy model cannot starve another
+        self.model = model
+        self.local_model = is_local_model(model)
+        # how long ollama keeps the model loaded after a request, None leaves ollama's default
+        self.keep_alive = keep_alive
+        if self.local_model:
+            # ollama clients read OLLAMA_HOST like the module level functions
+            self.client = ollama.Client()
+            self.async_client = ollama.AsyncClient()
+        else:
+            if not api_key:
+                raise ValueError(f"Model {model} needs an openrouter api key")
+            self.client = OpenAI(base_url="https://openrouter.ai/api/v1", api_key=api_key)
+            self.async_client = AsyncOpenAI(base_url="https://openrouter.ai/api/v1", api_key=api_key)
+
+    def count_tokens(self, prompt_tokens, completion_tokens):
+        metrics.increment("llm_requests_total")
+        metrics.increment("llm_prompt_tokens_total", prompt_tokens or 0)
+        metrics.increment("llm_completion_tokens_total", completion_tokens or 0)
+
+    def count_completion(self, response):
+        if self.local_model:
+            self.count_tokens(response.get('prompt_eval_count'), response.get('eval_count'))
+        elif response.usage is not None:
+            self.count_tokens(response.usage.prompt_tokens, response.usage.completion_tokens)
+        else:
+            self.count_tokens(0, 0)
+
+    def complete(self, messages):
+        if self.local_model:
+            response = self.client.chat(model=self.model, messages=messages, stream=False, keep_alive=self.keep_alive)
+            self.count_completion(response)
+            return response['message']['content']
+        response = self.client.chat.completions.create(model=self.model, messages=messages)
+        self.count_completion(response)
+        return response.choices[0].message.content
+
+    def limits(self, max_tokens=None):
+        # the completion length cap in the form each backend takes it, no cap leaves the model's default
+        if max_tokens is None:
+            return {}
+        if self.local_model:
+            return {"options": {"num_predict": max_tokens}}
+        return {"max_tokens": max_tokens}
+
+    async def stream_async(self, messages, cancel_event=None, max_tokens=None):
+        # once cancel_event is set the upstream stream is closed right away
+        # streamed chunks are counted as completion tokens, ollama reports the prompt tokens with its last chunk
+        prompt_tokens, completion_tokens = 0, 0
+        if self.local_model:
+            response = await self.async_client.chat(model=self.model, messages=messages, stream=True, keep_alive=self.keep_alive, **self.limits(max_tokens))
+            try:
+                async for chunk in response:
+                    if cancel_event is not None and cancel_event.is_set():
+                        return
+                    prompt_tokens = chunk.get('prompt_eval_count', prompt_tokens)
+                    completion_tokens += 1
+                    yield chunk['message']['content']
+            finally:
+                # closing the stream closes the http response, which makes ollama stop generating
+                await response.aclose()
+                self.count_tokens(prompt_tokens, completion_tokens)
+        else:
+            # send a request to openrouter.ai for response generation
+            stream = await self.async_client.chat.completions.create(model=self.model, messages=messages, stream=True, **self.limits(max_tokens))
+            try:
+                async for chunk in stream:
+                    if cancel_event is not None and cancel_event.is_set():
+                        return
+                    completion_tokens += 1
+                    yield chunk.choices[0].delta.content or ''
+            finally:
+                await stream.response.aclose()
+                self.count_tokens(prompt_tokens, completion_tokens)
+
+class ModelPull:
+    def __init__(self, model):
+        self.model = model
+        # queued -> pulling -> warming -> ready | error
+        self.status = "queued"
+        self.message = ""
+        self.completed = 0
+        self.total = 0
+        self.updated_at = time.time()
+        self.lock = threading.Lock()
+
+    def update(self, **fields):
+        with self.lock:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.updated_at = time.time()
+
+    def is_finished(self) -> bool:
+        return self.status in ("ready", "error")
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "model": self.model,
+                "status": self.status,
+                "message": self.message,
+                "completed": self.completed,
+                "total": self.total,
+            }
+
+class ModelPulls:
+    def __init__(self, max_workers=1, warm_up=True, keep_alive="30m"):
+        # pulls and warm-ups run on a small pool so requests never wait on a download
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="model-pull")
+        self.client = ollama.Client()
+        self.warm_up = warm_up
+        self.keep_alive = keep_alive
+        self.pulls = {}
+        self.lock = threading.Lock()
+
+    def submit(self, model) -> ModelPull:
+        # one pull per model at a time, asking again while it runs returns the running pull
+        with self.lock:
+            pull = self.pulls.get(model)
+            if pull is not None and not pull.is_finished():
+                return pull
+            pull = ModelPull(model)
+            self.pulls[model] = pull
+        self.executor.submit(self.run, pull)
+        return pull
+
+    def run(self, pull: ModelPull):
+        try:
+            pull.update(status="pulling", message="Downloading model")
+            # progress comes as a stream of status updates, layer downloads report completed and total bytes
+            for progress in self.client.pull(pull.model, stream=True):
+                pull.update(message=progress.get("status", ""), completed=progress.get("completed", pull.completed), total=progress.get("total", pull.total))
+            if self.warm_up:
+                # an empty prompt only loads the model, keep_alive keeps it in memory for the first real request
+                pull.update(status="warming", message="Loading model")
+                self.client.generate(model=pull.model, prompt="", keep_alive=self.keep_alive)
+            pull.update(status="ready", message="Model ready")
+        except Exception as e:
+            print(f"Pulling model {pull.model} failed: {str(e)}")
+            pull.update(status="error", message=f"Error pulling {pull.model}: {str(e)}")
+
+    def get(self, model) -> ModelPull:
+        with self.lock:
+            return self.pulls.get(model)
+
+    def all(self):
+        with self.lock:
+            return list(self.pulls.values())
 
 class LLMInteraction:
-    def __init__(self, model="llama3:instruct"):
+    def __init__(self, model="llama3:instruct", warm_up=True, keep_alive="30m"):
+        # model is only the default, every call can name its own model and no per-call state is kept on the object
         self.model = model
-        self.local_model = True  # default to true, assuming most models are local
-        self.conversation_history = []
+        self.keep_alive = keep_alive
         self.api_key = None
         # read the api key from the openrouter.txt file if it exists and is not empty
         if os.path.exists('openrouter.txt') and os.path.getsize('openrouter.txt') > 0:
             with open('openrouter.txt', 'r') as file:
                 self.api_key = file.read().strip()
-        if self.api_key:
-            self.client = OpenAI(base_url="https://openrouter.ai/api/v1", api_key=self.api_key)
-        # determine if the model is local or paid and initialize accordingly
-        if model.lower() in ["openai/gpt-4-turbo-preview", "anthropic/claude-3-opus:beta", "anthropic/claude-3-haiku:beta", "anthropic/claude-3-sonnet:beta"]:
-            self.local_model = False
-        else:
-            # ensure the model is synchronized before any loadings is attempted
-            ollama.pull(self.model)
+        # one ModelClient per model name, created on first use and shared by all requests for that model
+        self.clients = {}
+        self.clients_lock = threading.Lock()
+        # local models are pulled and loaded in the background, startup does not wait for them
+        self.pulls = ModelPulls(warm_up=warm_up, keep_alive=keep_alive)
+        self.prepare_model(model)
+
+    @property
+    def local_model(self):
+        return is_local_model(self.model)
+
+    def get_client(self, model=None):
+        model = model or self.model
+        with self.clients_lock:
+            if model not in self.clients:
+                self.clients[model] = ModelClient(model, self.api_key, self.keep_alive)
+            return self.clients[model]
 
     def switch_model(self, new_model):
-        # switch the model and reinitialize the pipeline
+        # change the default model, used for requests that do not name one
         self.model = new_model
-        if new_model.lower() in ["openai/gpt-4-turbo-preview", "anthropic/claude-3-opus:beta", "anthropic/claude-3-haiku:beta", "anthropic/claude-3-sonnet:beta"]:
-            self.local_model = False
-        else:
-            self.local_model = True
-            # ensure the model is synchronized before any loadings is attempted
-            ollama.pull(self.model)
-            
+        return self.prepare_model(new_model)
+
+    def prepare_model(self, model):
+        # starts a background pull for local models and returns its status right away
+        if not is_local_model(model):
+            return {"model": model, "status": "ready", "message": "Hosted model", "completed": 0, "total": 0}
+        return self.pulls.submit(model).to_dict()
+
+    def model_status(self, model=None):
+        model = model or self.model
+        if not is_local_model(model):
+            return {"model": model, "status": "ready", "message": "Hosted model", "completed": 0, "total": 0}
+        pull = self.pulls.get(model)
+        if pull is None:
+            # never pulled by this process, ollama may still have it from an earlier run
+            return {"model": model, "status": "unknown", "message": "", "completed": 0, "total": 0}
+        return pull.to_dict()
+
+    def model_unavailable_message(self, model=None):
+        # a notice for the user while the model is still downloading, None once it can answer
+        status = self.model_status(model)
+        if status["status"] in ("queued", "pulling"):
+            progress = f" ({100 * status['completed'] // status['total']}%)" if status["total"] else ""
+            return f"The model {status['model']} is still being downloaded{progress}, please try again in a moment."
+        return None
+
     def get_paid_status(self):
         # check if there is an api key and return true if it exists
         return bool(self.api_key)
 
-    def generate_title(self, past_conversation):
+    def title_messages(self, question, answer):
         title_generator_template = [
             {
                 "role": "system",
                 "content": "You are an expert at taking a user query and model response and generating a concise title for the intent. Your generated title should be between 3 and 5 words. Do not include any specific names, dates, or other superfluous information. Do not include the words 'Title:' ahead of your answer. The generated title should be standalone without any additional labeling.",
             }
         ]
-        
-        #print(f"Past conversation: {past_conversation}")
-        
-        title_generator_template.append({"role": "user", "content": str(past_conversation)})
-        
+        title_generator_template.append({"role": "user", "content": f"User query: {question}\n\nModel response: {answer}"})
+        return title_generator_template
+
+    def batch_title_messages(self, exchanges):
+        title_generator_template = [
+            {
+                "role": "system",
+                "content": "You are an expert at taking a user query and model response and generating a concise title for the intent. You are given several numbered conversations. For each one, write a title between 3 and 5 words on its own line, formatted as the number, a colon and the title, for example '1: Flood Evacuation Routes'. Do not include any specific names, dates, or other superfluous information, and do not add any other text.",
+            }
+        ]
+        conversations = "\n\n".join(f"{index}. User query: {question}\nModel response: {answer}" for index, (question, answer) in enumerate(exchanges, start=1))
+        title_generator_template.append({"role": "user", "content": conversations})
+        return title_generator_template
+
+    def summary_messages(self, previous_summary, turns):
+        summary_template = [
+            {
+                "role": "system",
+                "content": "You are an expert at condensing conversations. You are given an existing summary of a conversation between a user and a knowledge retrieval assistant, followed by newer messages. Write an updated summary in at most 150 words that keeps the user's questions, the key facts and answers given, and any open issues. Do not include any labeling ahead of the summary.",
+            }
+        ]
+        transcript = "\n".join(f"{message['role']}: {message['content']}" for message in turns)
+        summary_template.append({"role": "user", "content": f"Existing summary: {previous_summary or 'None'}\n\nNewer messages:\n{transcript}"})
+        return summary_template
+
+    def helper_model(self, model=None):
+        # short non-streamed completions use haiku if there is an api key, and the conversation's local model otherwise
         if self.api_key:
-            # send a request to openrouter.ai for response generation
-            response = self.client.chat.completions.create(
-                model="anthropic/claude-3-haiku:beta",
-                messages=title_generator_template,
-            )
-            return response.choices[0].message.content
-        else:
-            # use local model for title generation
-            response = ollama.chat(
-                model=self.model,
-                messages=title_generator_template,
-                stream=False
-            )
-            return response['message']['content']
+            return "anthropic/claude-3-haiku:beta"
+        model = model or self.model
+        return model if is_local_model(model) else self.model
+
+    def generate_titles(self, exchanges, model):
+        # one title per (question, answer) pair, several pairs share a single llm call; model is used as given
+        client = self.get_client(model)
+        if len(exchanges) == 1:
+            return [client.complete(self.title_messages(*exchanges[0])).strip()]
+        return parse_numbered_titles(client.complete(self.batch_title_messages(exchanges)), len(exchanges))
 
-    def generate_response(self, query, similar_documents=None, conversation=None, switch_model_to=None, max_tokens=2048):        
-        # if a model switch is requested, perform the switch before generating the response
-        if switch_model_to is not None:
-            self.switch_model(switch_model_to)
+    def generate_summary(self, previous_summary, turns, model=None):
+        return self.get_client(self.helper_model(model)).complete(self.summary_messages(previous_summary, turns))
 
+    def start_conversation(self, conversation=None):
         # if a conversation history is provided, use it; otherwise, start a new conversation
         if conversation is not None:
-            self.conversation_history = conversation
-        else:
-            self.conversation_history = [
-                {
-                    "role": "system",
-                    "content": "You are a helpful knowledge retrieval agent. You are provided documents that you can use to answer user queries. You should answer the user queries only based on the provided documents, and inform the user if you either were not provided documents, or the documents do not seem to answer their question.",
-                }
-            ]
-        
-        if self.local_model:
-            response = ollama.chat(
-                model=self.model, 
-                messages=self.conversation_history,
-                stream=True,
-            )
-            
-            for chunk in response:
-                yield (chunk['message']['content'])
-        else:
-            
-            # send a request to openrouter.ai for response generation
-            stream = self.client.chat.completions.create(
-                model=self.model,
-                messages=self.conversation_history,
-                stream=True,
-            )
-            for chunk in stream:
-                # print(chunk)
-                yield (chunk.choices[0].delta.content or '')
+            return conversation
+        return [
+            {
+                "role": "system",
+                "content": "You are a helpful knowledge retrieval agent. You are provided documents that you can use to answer user queries. You should answer the user queries only based on the provided documents, and inform the user if you either were not provided documents, or the documents do not seem to answer their question.",
+            }
+        ]
+
+    async def generate_response_async(self, query, similar_documents=None, conversation=None, model=None, max_tokens=2048, cancel_event=None):
+        # stateless, everything the call needs is passed in; a cancelled response gets no citations.
+        # runs on the async clients, so a streaming chat holds no thread while it waits on the model
+        conversation_history = self.start_conversation(conversation)
+        async for chunk in self.get_client(model).stream_async(conversation_history, cancel_event, max_tokens):
+            yield chunk
+        if cancel_event is not None and cancel_event.is_set():
+            return
+
+        citations = self.build_citations(similar_documents)
+        if citations:
+            yield "\n\n---\n\n### Document Citations:\n\n"
+            yield citations
 
+    def build_citations(self, similar_documents):
+        if not similar_documents:
+            return ""
         if similar_documents:
             # print("Similar documents found: ", similar_documents)
             # print()
@@ -134,6 +345,4 @@ class LLMInteraction:
             # print("Structured documents: ", structured_documents)
             structured_documents = structured_documents.strip()
             # print("Stripped Structured documents: ", structured_documents)
-            if structured_documents:
-                yield "\n\n---\n\n### Document Citations:\n\n"
-                yield structured_documents
+            return structured_documents
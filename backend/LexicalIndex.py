@@ -0,0 +1,199 @@
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import math
+import re
+import threading
+
+from Metrics import metrics
+
+STOPWORDS = {"a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "has", "in", "is", "it", "of", "on", "or", "that", "the", "this", "to", "was", "were", "what", "when", "where", "which", "who", "will", "with", "how", "do", "does"}
+
+def tokenize(text: str) -> List[str]:
+    return [token for token in re.findall(r"\w+", text.lower()) if token not in STOPWORDS]
+
+class BM25Index:
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        # term -> chunk id -> term frequency
+        self.postings: Dict[str, Dict[str, int]] = {}
+        # chunk id -> (token count, distinct terms), the terms are needed to take a chunk out again
+        self.documents: Dict[str, Tuple[int, List[str]]] = {}
+        self.total_length = 0
+
+    def add(self, ids: Iterable[str], texts: Iterable[str]):
+        for chunk_id, text in zip(ids, texts):
+            if chunk_id in self.documents:
+                # chunk ids are content hashes, the same id always has the same text
+                continue
+            counts = Counter(tokenize(text))
+            length = sum(counts.values())
+            for term, frequency in counts.items():
+                self.postings.setdefault(term, {})[chunk_id] = frequency
+            self.documents[chunk_id] = (length, list(counts))
+            self.total_length += length
+
+    def remove(self, ids: Iterable[str]):
+        for chunk_id in ids:
+            document = self.documents.pop(chunk_id, None)
+            if document is None:
+                continue
+            length, terms = document
+            for term in terms:
+                posting = self.postings.get(term)
+                if posting is not None:
+                    posting.pop(chunk_id, None)
+                    if not posting:
+                        del self.postings[term]
+            self.total_length -= length
+
+    def search(self, query: str, limit: int) -> List[Tuple[str, float]]:
+        if not self.documents:
+            return []
+        count = len(self.documents)
+        average_length = self.total_length / count or 1
+        scores: Dict[str, float] = {}
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (count - len(posting) + 0.5) / (len(posting) + 0.5))
+            for chunk_id, frequency in posting.items():
+                length = self.documents[chunk_id][0]
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + self.k1 * (1 - self.b + self.b * length / average_length))
+        return sorted(scores.items(), key=lambda x: x[1], reverse=True)[:limit]
+
+class LexicalIndex:
+    def __init__(self, load: Callable[[str], Iterable[Tuple[List[str], List[str]]]], k1: float = 1.5, b: float = 0.75, max_chunks: int = 200000):
+        # one BM25 index per collection, built in the background from what load yields, (ids, texts) batches of
+        # everything stored for the collection, and kept in step with ingest and delete. Until a collection's index
+        # is built, search returns None and retrieval goes on with the vector ranking alone
+        self.load = load
+        self.k1 = k1
+        self.b = b
+        # least recently used collections are dropped once all indexes together hold more than max_chunks chunks,
+        # they are built again on their next ingest or search
+        self.max_chunks = max_chunks
+        self.indexes: "OrderedDict[str, BM25Index]" = OrderedDict()
+        # collection_id -> adds and removes that arrived while its index was being built, replayed onto it when done
+        self.journals: Dict[str, List[Tuple[str, List[str], List[str]]]] = {}
+        self.builds: Dict[str, Future] = {}
+        self.builder = ThreadPoolExecutor(max_workers=1, thread_name_prefix="lexical-index")
+        self.locks: Dict[str, threading.Lock] = {}
+        self.lock = threading.Lock()
+        metrics.register_collector(self.stats)
+
+    def collection_lock(self, collection_id: str) -> threading.Lock:
+        with self.lock:
+            return self.locks.setdefault(collection_id, threading.Lock())
+
+    def build(self, collection_id: str) -> Future:
+        # starts building the collection's index unless it is loaded or already being built
+        with self.lock:
+            if collection_id in self.indexes:
+                built = Future()
+                built.set_result(None)
+                return built
+            future = self.builds.get(collection_id)
+            if future is None:
+                journal = self.journals[collection_id] = []
+                future = self.builds[collection_id] = self.builder.submit(self.run_build, collection_id, journal)
+            return future
+
+    def run_build(self, collection_id: str, journal: List[Tuple[str, List[str], List[str]]]):
+        index = BM25Index(self.k1, self.b)
+        try:
+            with metrics.span("lexical_index_build"):
+                for ids, texts in self.load(collection_id):
+                    index.add(ids, texts)
+        except Exception as e:
+            print(f"Failed to build the lexical index of {collection_id}: {str(e)}")
+            metrics.increment("lexical_index_builds_failed_total")
+            with self.lock:
+                if self.journals.get(collection_id) is journal:
+                    del self.journals[collection_id]
+                    del self.builds[collection_id]
+            raise
+        with self.lock:
+            # a drop while building leaves the journal of a newer build, or none, and this index is thrown away
+            if self.journals.get(collection_id) is not journal:
+                return
+            for operation, ids, texts in journal:
+                if operation == "add":
+                    index.add(ids, texts)
+                else:
+                    index.remove(ids)
+            del self.journals[collection_id]
+            del self.builds[collection_id]
+            self.indexes[collection_id] = index
+            self.evict()
+        metrics.increment("lexical_index_builds_total")
+
+    def evict(self):
+        # called with self.lock held; the index just used is kept even when it alone is over the limit
+        total = sum(len(index.documents) for index in self.indexes.values())
+        while total > self.max_chunks and len(self.indexes) > 1:
+            _, index = self.indexes.popitem(last=False)
+            total -= len(index.documents)
+            metrics.increment("lexical_index_evictions_total")
+
+    def search(self, collection_id: str, query: str, limit: int) -> Optional[List[Tuple[str, float]]]:
+        # None while the collection's index is not built, the first search starts the build
+        with self.lock:
+            index = self.indexes.get(collection_id)
+            if index is not None:
+                self.indexes.move_to_end(collection_id)
+        if index is None:
+            self.build(collection_id)
+            return None
+        with self.collection_lock(collection_id):
+            return index.search(query, limit)
+
+    def add(self, collection_id: str, ids: List[str], texts: List[str]):
+        # ingest into a collection without an index starts the build, which reads these chunks from the partition
+        if not self.change(collection_id, "add", ids, texts):
+            self.build(collection_id)
+
+    def remove(self, collection_id: str, ids: List[str]):
+        # an index that is not loaded leaves the chunks out when it is built
+        self.change(collection_id, "remove", ids, [])
+
+    def change(self, collection_id: str, operation: str, ids: List[str], texts: List[str]) -> bool:
+        # applies an add or remove to the loaded index, or journals it for the one being built;
+        # False when the collection has neither
+        with self.lock:
+            journal = self.journals.get(collection_id)
+            if journal is not None:
+                journal.append((operation, ids, texts))
+                return True
+            index = self.indexes.get(collection_id)
+            if index is None:
+                return False
+            self.indexes.move_to_end(collection_id)
+        with self.collection_lock(collection_id):
+            if operation == "add":
+                index.add(ids, texts)
+            else:
+                index.remove(ids)
+        return True
+
+    def drop(self, collection_id: str):
+        with self.lock:
+            self.indexes.pop(collection_id, None)
+            self.journals.pop(collection_id, None)
+            self.builds.pop(collection_id, None)
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            return {"lexical_indexes_loaded": len(self.indexes),
+                    "lexical_indexes_building": len(self.builds),
+                    "lexical_index_chunks": sum(len(index.documents) for index in self.indexes.values())}
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = 60) -> List[Tuple[str, float]]:
+    # every ranking contributes 1 / (k + rank) to an id, ids found by several rankings rise to the top
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking, start=1):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda x: x[1], reverse=True)
@@ -0,0 +1,366 @@
+"""
+load test for the streaming /chat/ endpoint against a stub model server
+
+python LoadTestChat.py stub --port 11435 --tokens 200 --delay 0.02
+    serves ollama's /api/chat and /api/pull, streaming fake tokens at a fixed pace
+
+OLLAMA_HOST=http://localhost:11435 uvicorn FastAPI:app --port 8000
+    run the backend against the stub
+
+python LoadTestChat.py run --url http://localhost:8000 --chats 300
+    opens that many chats at once, each in its own conversation, and reports time to first
+    chunk and total stream time; with a fully async pipeline the wall time stays close to a
+    single stream's time instead of growing with chats / threadpool size
+
+python LoadTestChat.py crud --url http://localhost:8000 --clients 50 --operations 40
+    that many clients at once, each with its own conversation, adding messages and reading them back,
+    listing conversations and documents; reports requests per second and, per endpoint, failures
+    (e.g. "database is locked") and latency p50 and p99; needs no model, the stub is not used
+
+python LoadTestChat.py database --clients 100 --requests 50
+    the database path of the endpoints in process, on a generated database: the same message page reads and
+    writes served once with the queries run on the event loop, as the endpoints did before AsyncDatabase,
+    and once through AsyncDatabase; reports requests per second, latency p50 and p99 and how late a 10ms
+    timer on the server's event loop fired, which is what every other client (and every stream) waits
+
+python LoadTestChat.py retrieval --concurrency 32 --queries 600 --wait 0.005
+    the retrieval step of the chat pipeline in process, on a generated corpus, run once with query
+    micro-batching off and once with it on; reports queries per second, latency p50 and p99 and
+    the average batch sizes, the latency difference is what batching adds per query
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import time
+import uuid
+
+import httpx
+
+def build_stub(tokens, delay):
+    from starlette.applications import Starlette
+    from starlette.requests import Request
+    from starlette.responses import JSONResponse, StreamingResponse
+    from starlette.routing import Route
+
+    def part(content, done):
+        return {"model": "stub", "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ"), "message": {"role": "assistant", "content": content}, "done": done}
+
+    async def chat(request: Request):
+        body = await request.json()
+        if not body.get("stream", True):
+            return JSONResponse(part("Stub title", True))
+
+        async def stream():
+            for index in range(tokens):
+                await asyncio.sleep(delay)
+                yield json.dumps(part(f"token{index} ", False)) + "\n"
+            yield json.dumps(part("", True)) + "\n"
+        return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+    async def pull(request: Request):
+        return JSONResponse({"status": "success"})
+
+    return Starlette(routes=[Route("/api/chat", chat, methods=["POST"]), Route("/api/pull", pull, methods=["POST"])])
+
+async def one_chat(client, url, user_id, conversation_id):
+    started = time.perf_counter()
+    first_chunk = None
+    chunks = 0
+    async with client.stream("POST", f"{url}/chat/", json={"user_id": user_id, "message": "What is in the documents?", "conversation_id": conversation_id}) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_text():
+            if first_chunk is None:
+                first_chunk = time.perf_counter() - started
+            chunks += 1
+    return first_chunk or 0.0, time.perf_counter() - started, chunks
+
+async def run(url, chats):
+    user_id = f"loadtest-{uuid.uuid4()}"
+    collection_id = str(uuid.uuid4())
+    limits = httpx.Limits(max_connections=chats + 10, max_keepalive_connections=chats + 10)
+    async with httpx.AsyncClient(timeout=None, limits=limits) as client:
+        # one empty collection and one conversation per chat, retrieval then short-circuits on the empty partition
+        (await client.post(f"{url}/add_user/", json={"user_id": user_id})).raise_for_status()
+        (await client.post(f"{url}/add_collection/", json={"user_id": user_id, "name": "load test", "collection_id": collection_id})).raise_for_status()
+        conversation_ids = [str(uuid.uuid4()) for _ in range(chats)]
+        for conversation_id in conversation_ids:
+            (await client.post(f"{url}/add_conversation/", json={"collection_id": collection_id, "user_id": user_id, "conversation_id": conversation_id})).raise_for_status()
+
+        print(f"Starting {chats} concurrent chats against {url}")
+        started = time.perf_counter()
+        results = await asyncio.gather(*(one_chat(client, url, user_id, conversation_id) for conversation_id in conversation_ids), return_exceptions=True)
+        wall = time.perf_counter() - started
+
+        failures = [result for result in results if isinstance(result, Exception)]
+        successes = [result for result in results if not isinstance(result, Exception)]
+        print(f"Completed {len(successes)}/{chats} chats in {wall:.2f}s, {len(failures)} failed")
+        if failures:
+            print(f"First failure: {failures[0]!r}")
+        if successes:
+            first_chunks = sorted(result[0] for result in successes)
+            totals = sorted(result[1] for result in successes)
+            percentile = lambda values, p: values[min(len(values) - 1, int(len(values) * p))]
+            print(f"time to first chunk  p50 {statistics.median(first_chunks):.3f}s  p95 {percentile(first_chunks, 0.95):.3f}s  max {first_chunks[-1]:.3f}s")
+            print(f"stream duration      p50 {statistics.median(totals):.3f}s  p95 {percentile(totals, 0.95):.3f}s  max {totals[-1]:.3f}s")
+
+        (await client.post(f"{url}/delete_collection/", json={"collection_id": collection_id})).raise_for_status()
+
+async def crud_client(client, url, user_id, collection_id, operations, timings, failures):
+    # one user session: a conversation of its own, a mix of writes and the reads the sidebar and chat view make
+    async def call(method, endpoint, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, f"{url}/{endpoint}/", **kwargs)
+            response.raise_for_status()
+        except Exception as e:
+            failures.setdefault(endpoint, []).append(e)
+            return
+        timings.setdefault(endpoint, []).append(time.perf_counter() - started)
+
+    conversation_id = str(uuid.uuid4())
+    await call("POST", "add_conversation", json={"collection_id": collection_id, "user_id": user_id, "conversation_id": conversation_id})
+    for index in range(operations):
+        kind = index % 5
+        if kind in (0, 1):
+            await call("POST", "add_message", json={"conversation_id": conversation_id, "text": f"message {index} " * 20, "is_user": kind == 0, "is_complete": True})
+        elif kind == 2:
+            await call("GET", "get_conversation_messages", params={"conversation_id": conversation_id})
+        elif kind == 3:
+            await call("GET", "get_conversations_page", params={"user_id": user_id, "limit": 50})
+        else:
+            await call("GET", "get_documents_page", params={"collection_id": collection_id, "limit": 50})
+    await call("POST", "delete_conversation", json={"conversation_id": conversation_id})
+
+async def run_crud(url, clients, operations):
+    user_id = f"loadtest-{uuid.uuid4()}"
+    collection_id = str(uuid.uuid4())
+    limits = httpx.Limits(max_connections=clients + 10, max_keepalive_connections=clients + 10)
+    async with httpx.AsyncClient(timeout=None, limits=limits) as client:
+        (await client.post(f"{url}/add_user/", json={"user_id": user_id})).raise_for_status()
+        (await client.post(f"{url}/add_collection/", json={"user_id": user_id, "name": "load test", "collection_id": collection_id})).raise_for_status()
+
+        print(f"Starting {clients} concurrent clients of {operations} operations against {url}")
+        timings, failures = {}, {}
+        started = time.perf_counter()
+        await asyncio.gather(*(crud_client(client, url, user_id, collection_id, operations, timings, failures) for _ in range(clients)))
+        wall = time.perf_counter() - started
+
+        requests = sum(len(values) for values in timings.values()) + sum(len(values) for values in failures.values())
+        print(f"Completed {requests} requests in {wall:.2f}s, {requests / wall:.1f} requests/s, {sum(len(values) for values in failures.values())} failed")
+        percentile = lambda values, p: values[min(len(values) - 1, int(len(values) * p))]
+        for endpoint in sorted(set(timings) | set(failures)):
+            values = sorted(timings.get(endpoint, []))
+            latency = f"p50 {statistics.median(values) * 1000:7.1f}ms  p99 {percentile(values, 0.99) * 1000:7.1f}ms" if values else ""
+            print(f"{endpoint:28} {len(values):6} ok {len(failures.get(endpoint, [])):4} failed  {latency}")
+        for endpoint, errors in failures.items():
+            print(f"First failure of {endpoint}: {errors[0]!r}")
+
+        (await client.post(f"{url}/delete_collection/", json={"collection_id": collection_id})).raise_for_status()
+
+def serve_database(path, port, blocking, ready):
+    # runs in its own process, so the clients do not share the server's interpreter
+    import uvicorn
+    from starlette.applications import Starlette
+    from starlette.requests import Request
+    from starlette.responses import JSONResponse
+    from starlette.routing import Route
+    from Database import AsyncDatabase, Database
+
+    db = Database(f"sqlite:///{path}")
+    adb = AsyncDatabase(db)
+    # the loop lag probe: a timer that should fire every 10ms, stalls of the event loop show up as lateness
+    lags = []
+
+    async def probe():
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - started - 0.01)
+
+    async def messages(request: Request):
+        conversation_id = request.query_params["conversation_id"]
+        if request.method == "POST":
+            name, args = "add_message", (conversation_id, "load test message " * 20, True, True)
+        else:
+            name, args = "get_conversation_messages_page", (conversation_id,)
+        result = getattr(db, name)(*args) if blocking else await getattr(adb, name)(*args)
+        return JSONResponse({"items": len(result["items"])} if isinstance(result, dict) else {"message_id": result})
+
+    async def lag(request: Request):
+        values, lags[:] = sorted(lags), []
+        return JSONResponse({"p99": values[min(len(values) - 1, int(len(values) * 0.99))] if values else 0.0, "max": values[-1] if values else 0.0})
+
+    async def start_probe():
+        asyncio.get_running_loop().create_task(probe())
+        ready.set()
+
+    app = Starlette(routes=[Route("/messages", messages, methods=["GET", "POST"]), Route("/lag", lag)], on_startup=[start_probe])
+    # add_message prints every step
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        uvicorn.run(app, port=port, log_level="warning")
+
+def generate_database(path, conversations, messages):
+    from Database import Conversation, Database, Message
+    db = Database(f"sqlite:///{path}")
+    db.add_user("loadtest")
+    db.add_collection("loadtest", "loadtest", "loadtest")
+    with db.session_scope() as session:
+        for index in range(conversations):
+            session.add(Conversation(conversation_id=f"conversation-{index}", collection_id="loadtest", user_id="loadtest", title="New chat"))
+            session.add_all(Message(message_id=str(uuid.uuid4()), text="generated message " * 20, is_user=position % 2 == 0, is_complete=True, conversation_id=f"conversation-{index}")
+                            for position in range(messages))
+    db.engine.dispose()
+
+async def database_clients(url, clients, requests, conversations):
+    latencies = []
+    limits = httpx.Limits(max_connections=clients + 10, max_keepalive_connections=clients + 10)
+    async with httpx.AsyncClient(timeout=None, limits=limits) as client:
+        async def one_client(offset):
+            # one write for every four page reads, spread over the conversations
+            for index in range(requests):
+                conversation_id = f"conversation-{(offset * requests + index) % conversations}"
+                started = time.perf_counter()
+                if index % 5 == 4:
+                    response = await client.post(f"{url}/messages", params={"conversation_id": conversation_id})
+                else:
+                    response = await client.get(f"{url}/messages", params={"conversation_id": conversation_id})
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - started)
+
+        await client.get(f"{url}/lag")
+        started = time.perf_counter()
+        await asyncio.gather(*(one_client(offset) for offset in range(clients)))
+        wall = time.perf_counter() - started
+        lag = (await client.get(f"{url}/lag")).json()
+    return sorted(latencies), wall, lag
+
+def run_database(clients, requests, conversations, messages, port):
+    import multiprocessing
+
+    workdir = tempfile.mkdtemp(prefix="database-load-test-")
+    try:
+        path = os.path.join(workdir, "database.db")
+        generate_database(path, conversations, messages)
+        print(f"Generated {conversations} conversations of {messages} messages, {clients} clients of {requests} requests each")
+        baseline = None
+        context = multiprocessing.get_context("spawn")
+        for label, blocking in (("event loop", True), ("executor", False)):
+            ready = context.Event()
+            server = context.Process(target=serve_database, args=(path, port, blocking, ready), daemon=True)
+            server.start()
+            try:
+                ready.wait(60)
+                # the probe starts with the app, give uvicorn a moment to bind the port
+                time.sleep(0.5)
+                latencies, wall, lag = asyncio.run(database_clients(f"http://127.0.0.1:{port}", clients, requests, conversations))
+            finally:
+                server.terminate()
+                server.join()
+            throughput = len(latencies) / wall
+            gain = f"  ({throughput / baseline:.2f}x)" if baseline else ""
+            print(f"{label:10}  {throughput:7.1f} requests/s{gain}  p50 {statistics.median(latencies) * 1000:.1f}ms  "
+                  f"p99 {latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000:.1f}ms  "
+                  f"loop lag p99 {lag['p99'] * 1000:.1f}ms  max {lag['max'] * 1000:.1f}ms")
+            baseline = baseline or throughput
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def run_retrieval(chunks, queries, concurrency, wait, seed):
+    # imported here, the stub and run commands do not need the backend modules
+    from BenchmarkRetrieval import generate_corpus, generate_queries
+    from Database import Database
+    from Embeddings import EmbeddingHandler
+    from Metrics import metrics
+
+    workdir = tempfile.mkdtemp(prefix="retrieval-load-test-")
+    try:
+        db = Database(f"sqlite:///{os.path.join(workdir, 'database.db')}")
+        db.add_user("loadtest")
+        db.add_collection("loadtest", "loadtest", "loadtest")
+        # no reranker and no result cache, every query pays for its embedding and lookup
+        embedding_handler = EmbeddingHandler(db, persist_directory=os.path.join(workdir, "chromadb"), reranker="none", embed_workers=1, cache_options={"max_entries": 0})
+        corpus = generate_corpus(chunks, seed)
+        documents = [text for text, _, _ in corpus]
+        ids = [embedding_handler.chunk_hash(text) for text in documents]
+        metadatas = [{"document_id": "loadtest", "collection_id": "loadtest", "filename": "generated"} for _ in documents]
+        # retrieval prints every query, the report is all that is shown
+        with contextlib.redirect_stdout(io.StringIO()):
+            embedding_handler.add_processed_documents(documents, ids, metadatas, "loadtest")
+        embedding_handler.lexical_index.build("loadtest").result()
+        questions = [query for query, _ in generate_queries(corpus, queries, seed)]
+
+        def timed(query):
+            started = time.perf_counter()
+            status, message, _ = embedding_handler.retrieve_documents(query, "loadtest")
+            if status != "success":
+                raise RuntimeError(message)
+            return time.perf_counter() - started
+
+        baseline = None
+        for label, batch_wait in (("unbatched", 0), ("batched", wait)):
+            embedding_handler.query_embedder.max_wait = embedding_handler.vector_lookup.max_wait = batch_wait
+            before = metrics.snapshot(collectors=False)
+            with ThreadPoolExecutor(max_workers=concurrency) as executor, contextlib.redirect_stdout(io.StringIO()):
+                started = time.perf_counter()
+                latencies = sorted(executor.map(timed, questions))
+                wall = time.perf_counter() - started
+            after = metrics.snapshot(collectors=False)
+            delta = lambda name: after.get(name, 0) - before.get(name, 0)
+            throughput = len(latencies) / wall
+            sizes = "  ".join(f"{name} batch {delta(f'{name}_batched_items_total') / delta(f'{name}_batches_total'):.1f}"
+                              for name in ("query_embedding", "vector_lookup") if delta(f"{name}_batches_total"))
+            gain = f"  ({throughput / baseline:.2f}x)" if baseline else ""
+            print(f"{label:9}  {throughput:7.1f} queries/s{gain}  p50 {statistics.median(latencies) * 1000:.1f}ms  "
+                  f"p99 {latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000:.1f}ms  {sizes}")
+            baseline = baseline or throughput
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    stub_parser = subparsers.add_parser("stub")
+    stub_parser.add_argument("--port", type=int, default=11435)
+    stub_parser.add_argument("--tokens", type=int, default=200)
+    stub_parser.add_argument("--delay", type=float, default=0.02)
+    run_parser = subparsers.add_parser("run")
+    run_parser.add_argument("--url", default="http://localhost:8000")
+    run_parser.add_argument("--chats", type=int, default=300)
+    crud_parser = subparsers.add_parser("crud")
+    crud_parser.add_argument("--url", default="http://localhost:8000")
+    crud_parser.add_argument("--clients", type=int, default=50)
+    crud_parser.add_argument("--operations", type=int, default=40)
+    database_parser = subparsers.add_parser("database")
+    database_parser.add_argument("--clients", type=int, default=100)
+    database_parser.add_argument("--requests", type=int, default=50)
+    database_parser.add_argument("--conversations", type=int, default=200)
+    database_parser.add_argument("--messages", type=int, default=200)
+    database_parser.add_argument("--port", type=int, default=8765)
+    retrieval_parser = subparsers.add_parser("retrieval")
+    retrieval_parser.add_argument("--chunks", type=int, default=2000)
+    retrieval_parser.add_argument("--queries", type=int, default=600)
+    retrieval_parser.add_argument("--concurrency", type=int, default=32)
+    retrieval_parser.add_argument("--wait", type=float, default=0.005)
+    retrieval_parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    if args.command == "stub":
+        import uvicorn
+        uvicorn.run(build_stub(args.tokens, args.delay), port=args.port, log_level="warning")
+    elif args.command == "crud":
+        asyncio.run(run_crud(args.url, args.clients, args.operations))
+    elif args.command == "database":
+        run_database(args.clients, args.requests, args.conversations, args.messages, args.port)
+    elif args.command == "retrieval":
+        run_retrieval(args.chunks, args.queries, args.concurrency, args.wait, args.seed)
+    else:
+        asyncio.run(run(args.url, args.chats))
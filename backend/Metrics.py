@@ -0,0 +1,122 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Tuple
+import re
+import threading
+import time
+
+# upper bounds in seconds, from a cache lookup up to a long generation
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# stage -> seconds of the request being handled, set by the endpoint that wants a breakdown;
+# asyncio.to_thread copies the context, so stages that run on worker threads are counted too
+request_timings: ContextVar[Dict[str, float]] = ContextVar("request_timings", default=None)
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # observations per bucket, not cumulative, the +Inf bucket is count
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    def __init__(self):
+        # process-wide counters, safe to update from request handlers and worker threads
+        self.counters: Dict[str, float] = {}
+        # latency distributions by name, one per timed stage
+        self.histograms: Dict[str, Histogram] = {}
+        # callables returning current values (sizes, rates) that are computed when a snapshot is taken
+        self.collectors: List[Callable[[], Dict[str, float]]] = []
+        self.lock = threading.Lock()
+
+    def increment(self, name: str, value: float = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def record(self, stage: str, seconds: float):
+        # a timed stage goes into the {stage}_seconds histogram and, if one is collected, the request's breakdown
+        self.observe(f"{stage}_seconds", seconds)
+        timings = request_timings.get()
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def span(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started)
+
+    def collect_request_timings(self, timings: Dict[str, float] = None) -> Dict[str, float]:
+        # start a breakdown for the current context, stages recorded from here on are added to the returned dict
+        timings = {} if timings is None else timings
+        request_timings.set(timings)
+        return timings
+
+    def register_collector(self, collector: Callable[[], Dict[str, float]]):
+        with self.lock:
+            self.collectors.append(collector)
+
+    def snapshot(self, collectors: bool = True) -> Dict[str, float]:
+        with self.lock:
+            values = dict(self.counters)
+            for name, histogram in self.histograms.items():
+                values[f"{name}_count"] = histogram.count
+                values[f"{name}_sum"] = histogram.sum
+            registered = list(self.collectors) if collectors else []
+        for collector in registered:
+            values.update(collector())
+        return values
+
+    def render(self) -> str:
+        # prometheus text exposition format: *_total counters, histograms, and collector values as gauges
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {name: (histogram.buckets, list(histogram.counts), histogram.sum, histogram.count) for name, histogram in self.histograms.items()}
+            registered = list(self.collectors)
+        gauges = {}
+        for collector in registered:
+            gauges.update(collector())
+
+        lines = []
+        for name, value in sorted(counters.items()):
+            name = metric_name(name)
+            lines += [f"# TYPE {name} {'counter' if name.endswith('_total') else 'gauge'}", f"{name} {float(value)}"]
+        for name, (buckets, counts, total, count) in sorted(histograms.items()):
+            name = metric_name(name)
+            lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+            lines += [f'{name}_bucket{{le="+Inf"}} {count}', f"{name}_sum {total}", f"{name}_count {count}"]
+        for name, value in sorted(gauges.items()):
+            name = metric_name(name)
+            lines += [f"# TYPE {name} gauge", f"{name} {float(value)}"]
+        return "\n".join(lines) + "\n"
+
+def metric_name(name: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_:]", "_", name)
+
+def server_timing(timings: Dict[str, float]) -> str:
+    # Server-Timing header value, durations in milliseconds
+    return ", ".join(f"{metric_name(stage)};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
+
+metrics = Metrics()
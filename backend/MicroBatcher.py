@@ -0,0 +1,90 @@
+from typing import Callable, Dict, Hashable, List
+import threading
+import time
+
+from Metrics import metrics
+
+class PendingCall:
+    def __init__(self, item: any):
+        self.item = item
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+class MicroBatcher:
+    def __init__(self, name: str, run_batch: Callable[[Hashable, List[any]], List[any]], max_wait: float = 0.005, max_batch: int = 32):
+        # calls with the same key arriving within max_wait seconds of the first one are run as one batch:
+        # run_batch(key, items) returns one result per item, in order
+        self.name = name
+        self.run_batch = run_batch
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        # the open batch of each key, a full batch is taken out so later callers start the next one
+        self.pending: Dict[Hashable, List[PendingCall]] = {}
+        # callers per key whose batch has not started running yet, and batches per key inside run_batch
+        self.waiting: Dict[Hashable, int] = {}
+        self.running: Dict[Hashable, int] = {}
+        self.condition = threading.Condition()
+        metrics.register_collector(self.stats)
+
+    def submit(self, key: Hashable, item: any) -> any:
+        # blocks the calling thread until the batch holding item has run; the first caller of a batch runs it
+        if self.max_wait <= 0:
+            return self.run_batch(key, [item])[0]
+        call = PendingCall(item)
+        with self.condition:
+            self.waiting[key] = self.waiting.get(key, 0) + 1
+            batch = self.pending.setdefault(key, [])
+            batch.append(call)
+            leader = len(batch) == 1
+            if len(batch) >= self.max_batch:
+                del self.pending[key]
+                self.condition.notify_all()
+        if leader:
+            self.lead(key, batch)
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def lead(self, key: Hashable, batch: List[PendingCall]):
+        started = time.perf_counter()
+        with self.condition:
+            # a caller that is alone with its key runs right away; with other callers queued the batch waits up to
+            # max_wait for more, and while a batch of the same key is running it waits at most until that one is done,
+            # callers of other keys and callers already inside run_batch never join this batch
+            deadline = started + self.max_wait
+            while self.pending.get(key) is batch and (self.waiting[key] > 1 or self.running.get(key)):
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            if self.pending.get(key) is batch:
+                del self.pending[key]
+            self.waiting[key] -= len(batch)
+            if not self.waiting[key]:
+                del self.waiting[key]
+            self.running[key] = self.running.get(key, 0) + 1
+        waited = time.perf_counter() - started
+        try:
+            results = self.run_batch(key, [call.item for call in batch])
+            for call, result in zip(batch, results):
+                call.result = result
+        except Exception as e:
+            for call in batch:
+                call.error = e
+        finally:
+            with self.condition:
+                self.running[key] -= 1
+                if not self.running[key]:
+                    del self.running[key]
+                self.condition.notify_all()
+            for call in batch:
+                call.done.set()
+        metrics.increment(f"{self.name}_batches_total")
+        metrics.increment(f"{self.name}_batched_items_total", len(batch))
+        metrics.record(f"{self.name}_batch_wait", waited)
+
+    def stats(self) -> Dict[str, float]:
+        with self.condition:
+            return {f"{self.name}_waiting": sum(self.waiting.values())}
@@ -0,0 +1,15 @@
+"""
+one-off migration of conversation histories from the raw_conversation JSON column to conversation_turns rows
+
+python MigrateConversations.py
+
+conversations are also migrated lazily the first time they are read, this moves all of them at once
+
+"""
+
+from Database import Database
+
+if __name__ == '__main__':
+    db = Database()
+    migrated = db.migrate_raw_conversations()
+    print(f"Migrated {migrated} conversations")
@@ -0,0 +1,21 @@
+"""
+one-off migration from the single global chroma collection to per-collection partitions
+
+python MigratePartitions.py            copy chunks into their collection's partition
+python MigratePartitions.py --delete   copy, then drop the old global collection
+
+"""
+
+import sys
+
+from Database import Database
+from Embeddings import EmbeddingHandler
+
+if __name__ == '__main__':
+    db = Database()
+    embedding_handler = EmbeddingHandler(db)
+    # chunks only carry document_id, the database knows which collection each document belongs to
+    document_collections = db.get_document_collections()
+    print(f"Found {len(document_collections)} documents in the database")
+    status, message = embedding_handler.migrate_legacy_collection(document_collections, delete_legacy="--delete" in sys.argv)
+    print(f"{status}: {message}")
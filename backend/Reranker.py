@@ -0,0 +1,58 @@
+from typing import List, Tuple
+import cohere
+
+class CohereReranker:
+    def __init__(self, model: str = "rerank-english-v3.0"):
+        # hosted reranker, one network round trip per query
+        with open("cohere.txt", "r") as file:
+            self.cohere_key = file.read().strip()
+        self.co = cohere.Client(self.cohere_key)
+        self.model = model
+
+    def rerank(self, query: str, documents: List[str], top_n: int) -> List[Tuple[int, float]]:
+        if not documents:
+            return []
+        rerank_response = self.co.rerank(
+            model=self.model,
+            query=query,
+            documents=documents,
+            top_n=top_n
+        )
+        return [(rank.index, rank.relevance_score) for rank in rerank_response.results]
+
+class CrossEncoderReranker:
+    def __init__(self, model: str = "cross-encoder/ms-marco-MiniLM-L-6-v2", batch_size: int = 32, max_length: int = 512):
+        # imported here so the cohere-only setup does not pay the torch import cost
+        from sentence_transformers import CrossEncoder
+        # single-label cross encoders apply a sigmoid, so scores land in [0, 1] like cohere's relevance scores
+        self.model = CrossEncoder(model, max_length=max_length, device="cpu")
+        self.batch_size = batch_size
+
+    def rerank(self, query: str, documents: List[str], top_n: int) -> List[Tuple[int, float]]:
+        if not documents:
+            return []
+        # score all (query, candidate) pairs in fixed size batches, sequences are truncated to max_length tokens
+        pairs = [(query, document) for document in documents]
+        scores = self.model.predict(pairs, batch_size=self.batch_size, show_progress_bar=False)
+        ranked = sorted(enumerate(scores), key=lambda x: x[1], reverse=True)[:top_n]
+        return [(index, float(score)) for index, score in ranked]
+
+class NoReranker:
+    def __init__(self):
+        # keeps the order retrieval produced, for setups where the fused ranking is good enough on its own
+        pass
+
+    def rerank(self, query: str, documents: List[str], top_n: int) -> List[Tuple[int, float]]:
+        return [(index, 1.0) for index in range(min(top_n, len(documents)))]
+
+RERANKERS = {
+    "cohere": CohereReranker,
+    "cross-encoder": CrossEncoderReranker,
+    "none": NoReranker,
+}
+
+def get_reranker(name: str = "cohere", **kwargs):
+    # build a reranker backend by name, extra keyword arguments are passed to the backend
+    if name not in RERANKERS:
+        raise ValueError(f"Unknown reranker backend {name}, expected one of {list(RERANKERS)}")
+    return RERANKERS[name](**kwargs)
@@ -0,0 +1,142 @@
+from collections import OrderedDict
+from typing import Dict, List
+import re
+import threading
+import time
+
+import numpy as np
+
+from Metrics import metrics
+
+class CacheEntry:
+    def __init__(self, query: str, embedding: np.ndarray, num_docs: int, documents: List[Dict[str, any]]):
+        self.query = query
+        # unit length, so a dot product is the cosine similarity
+        self.embedding = embedding
+        self.num_docs = num_docs
+        self.documents = documents
+        # whole answers to the query by model, only filled for questions asked without earlier turns
+        self.answers: Dict[str, str] = {}
+        self.created_at = time.time()
+
+class SemanticCache:
+    def __init__(self, similarity_threshold: float = 0.95, max_entries: int = 256, ttl_seconds: int = 3600, cache_answers: bool = False):
+        # queries whose embeddings are at least this similar share one entry
+        self.similarity_threshold = similarity_threshold
+        # per collection, least recently used queries are dropped first
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # whole answers are only replayed for near-duplicate opening questions when a deployment turns this on
+        self.cache_answers = cache_answers
+        # collection_id -> normalized query -> entry; a query that matched another one semantically is kept as an alias
+        self.collections: Dict[str, "OrderedDict[str, CacheEntry]"] = {}
+        # bumped on every invalidation, results computed against an older generation are not stored
+        self.generations: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        metrics.register_collector(self.stats)
+
+    def normalize(self, query: str) -> str:
+        return re.sub(r"\s+", " ", query.lower()).strip().rstrip("?!. ")
+
+    def generation(self, collection_id: str) -> int:
+        with self.lock:
+            return self.generations.get(collection_id, 0)
+
+    def get_fresh(self, entries: "OrderedDict[str, CacheEntry]", key: str) -> CacheEntry:
+        entry = entries.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry.created_at > self.ttl_seconds:
+            del entries[key]
+            return None
+        entries.move_to_end(key)
+        return entry
+
+    def lookup_exact(self, collection_id: str, query: str, num_docs: int) -> CacheEntry:
+        # cheap check on the normalized text, before the query is embedded
+        with self.lock:
+            entries = self.collections.get(collection_id)
+            if not entries:
+                return None
+            entry = self.get_fresh(entries, self.normalize(query))
+            return entry if entry is not None and entry.num_docs == num_docs else None
+
+    def lookup(self, collection_id: str, query: str, embedding: List[float], num_docs: int) -> CacheEntry:
+        key = self.normalize(query)
+        with self.lock:
+            entries = self.collections.get(collection_id)
+            if not entries:
+                return None
+            entry = self.get_fresh(entries, key)
+            if entry is not None:
+                return entry if entry.num_docs == num_docs else None
+            now = time.time()
+            candidates = list({id(entry): entry for entry in entries.values()
+                               if entry.num_docs == num_docs and now - entry.created_at <= self.ttl_seconds}.values())
+            if not candidates:
+                return None
+            vector = self.unit(embedding)
+            similarities = np.stack([entry.embedding for entry in candidates]) @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.similarity_threshold:
+                return None
+            entry = candidates[best]
+            # later lookups of this wording, and answer lookups, find the entry without embedding again
+            entries[key] = entry
+            self.evict(entries)
+            return entry
+
+    def store(self, collection_id: str, query: str, embedding: List[float], num_docs: int, documents: List[Dict[str, any]], generation: int) -> CacheEntry:
+        entry = CacheEntry(query, self.unit(embedding), num_docs, documents)
+        with self.lock:
+            if self.generations.get(collection_id, 0) != generation:
+                # the collection changed while the query ran
+                return entry
+            entries = self.collections.setdefault(collection_id, OrderedDict())
+            entries[self.normalize(query)] = entry
+            self.evict(entries)
+        return entry
+
+    def get_answer(self, collection_id: str, query: str, model: str) -> str:
+        if not self.cache_answers:
+            return None
+        with self.lock:
+            entries = self.collections.get(collection_id)
+            entry = self.get_fresh(entries, self.normalize(query)) if entries else None
+            return entry.answers.get(model) if entry is not None else None
+
+    def store_answer(self, collection_id: str, query: str, model: str, answer: str, generation: int):
+        if not self.cache_answers:
+            return
+        with self.lock:
+            if self.generations.get(collection_id, 0) != generation:
+                return
+            entries = self.collections.get(collection_id)
+            entry = entries.get(self.normalize(query)) if entries else None
+            if entry is not None:
+                entry.answers[model] = answer
+
+    def invalidate(self, collection_id: str):
+        # documents were added to or removed from the collection, every cached result may be stale
+        with self.lock:
+            self.collections.pop(collection_id, None)
+            self.generations[collection_id] = self.generations.get(collection_id, 0) + 1
+
+    def evict(self, entries: "OrderedDict[str, CacheEntry]"):
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+    def unit(self, embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def stats(self) -> Dict[str, float]:
+        counters = metrics.snapshot(collectors=False)
+        with self.lock:
+            stats = {"semantic_cache_entries": sum(len(entries) for entries in self.collections.values())}
+        for kind in ("retrieval", "answer"):
+            hits = counters.get(f"semantic_cache_{kind}_hits_total", 0)
+            misses = counters.get(f"semantic_cache_{kind}_misses_total", 0)
+            stats[f"semantic_cache_{kind}_hit_rate"] = hits / (hits + misses) if hits + misses else 0.0
+        return stats
@@ -0,0 +1,62 @@
+from collections import OrderedDict
+from typing import Dict, Tuple
+import threading
+
+from Metrics import metrics
+
+class SummaryQueue:
+    def __init__(self, history_manager, database, max_pending: int = 64):
+        self.history_manager = history_manager
+        self.database = database
+        # beyond this many waiting conversations new requests are dropped, the messages stay unfolded and are retried on the next turn
+        self.max_pending = max_pending
+        # conversation id -> model of its latest turn, a conversation waits at most once
+        self.pending: "OrderedDict[str, str]" = OrderedDict()
+        self.condition = threading.Condition()
+        metrics.register_collector(self.stats)
+        self.worker = threading.Thread(target=self.run, name="summaries", daemon=True)
+        self.worker.start()
+
+    def submit(self, conversation_id: str, model: str = None) -> bool:
+        with self.condition:
+            if conversation_id in self.pending:
+                self.pending[conversation_id] = model
+                return True
+            if len(self.pending) >= self.max_pending:
+                metrics.increment("summary_skipped_total")
+                return False
+            self.pending[conversation_id] = model
+            self.condition.notify()
+        return True
+
+    def next_conversation(self) -> Tuple[str, str]:
+        with self.condition:
+            while not self.pending:
+                self.condition.wait()
+            return self.pending.popitem(last=False)
+
+    def run(self):
+        while True:
+            conversation_id, model = self.next_conversation()
+            try:
+                self.fold(conversation_id, model)
+            except Exception as e:
+                print(f"Summary update failed for conversation ID: {conversation_id}: {str(e)}")
+                metrics.increment("summary_failed_total")
+
+    def fold(self, conversation_id: str, model: str = None):
+        # the history is read again here, turns saved while the conversation was waiting are folded as well;
+        # this thread is the only writer of summaries, so the stored count cannot move under it
+        conversation_history = self.database.get_conversation_raw(conversation_id)
+        if conversation_history is None:
+            return
+        summary, summarized_messages = self.database.get_conversation_summary(conversation_id)
+        with metrics.span("chat_summary"):
+            new_summary, new_summarized_messages = self.history_manager.update_summary(conversation_history, summary, summarized_messages, model)
+        if new_summarized_messages != summarized_messages:
+            self.database.update_conversation_summary(conversation_id, new_summary, new_summarized_messages)
+            metrics.increment("summary_generated_total")
+
+    def stats(self) -> Dict[str, float]:
+        with self.condition:
+            return {"summary_queue_pending": len(self.pending)}
@@ -0,0 +1,79 @@
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+import threading
+
+from Metrics import metrics
+
+class TitleQueue:
+    def __init__(self, llm_interaction, database, model: str = None, max_pending: int = 32, batch_size: int = 8, answer_chars: int = 500):
+        self.llm_interaction = llm_interaction
+        self.database = database
+        # model used for every title, None picks the same helper model as the summaries use for the conversation
+        self.model = model
+        # beyond this many waiting titles new requests are dropped, the conversation keeps "New chat" and is retried on its next turn
+        self.max_pending = max_pending
+        # waiting titles that share a model are generated with one llm call
+        self.batch_size = batch_size
+        self.answer_chars = answer_chars
+        self.pending: "OrderedDict[str, Tuple[str, str, str]]" = OrderedDict()
+        self.condition = threading.Condition()
+        metrics.register_collector(self.stats)
+        self.worker = threading.Thread(target=self.run, name="titles", daemon=True)
+        self.worker.start()
+
+    def first_exchange(self, conversation_history: List[Dict[str, str]]) -> Tuple[str, str]:
+        # the first user question and the answer to it, the rest of the conversation is not needed for a title
+        question, answer = "", ""
+        for index, message in enumerate(conversation_history):
+            if message["role"] == "user":
+                question = message["content"]
+                if index + 1 < len(conversation_history) and conversation_history[index + 1]["role"] == "assistant":
+                    answer = conversation_history[index + 1]["content"]
+                break
+        return question, answer[:self.answer_chars]
+
+    def submit(self, conversation_id: str, question: str, answer: str, model: str = None) -> bool:
+        with self.condition:
+            if conversation_id in self.pending:
+                return True
+            if len(self.pending) >= self.max_pending:
+                metrics.increment("title_skipped_total")
+                return False
+            self.pending[conversation_id] = (question, answer[:self.answer_chars], self.model or self.llm_interaction.helper_model(model))
+            self.condition.notify()
+        return True
+
+    def next_batch(self) -> List[Tuple[str, str, str, str]]:
+        # the oldest waiting title plus up to batch_size - 1 more for the same model
+        with self.condition:
+            while not self.pending:
+                self.condition.wait()
+            first_id, (question, answer, model) = self.pending.popitem(last=False)
+            batch = [(first_id, question, answer, model)]
+            for conversation_id, (other_question, other_answer, other_model) in list(self.pending.items()):
+                if len(batch) >= self.batch_size:
+                    break
+                if other_model == model:
+                    del self.pending[conversation_id]
+                    batch.append((conversation_id, other_question, other_answer, other_model))
+            return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                with metrics.span("title_generation"):
+                    titles = self.llm_interaction.generate_titles([(question, answer) for _, question, answer, _ in batch], batch[0][3])
+                metrics.increment("title_batches_total")
+                for (conversation_id, _, _, _), title in zip(batch, titles):
+                    # the user may have renamed the conversation in the meantime
+                    if title and self.database.get_conversation_title(conversation_id) == "New chat":
+                        self.database.update_conversation_title(conversation_id, title)
+                        metrics.increment("title_generated_total")
+            except Exception as e:
+                print(f"Title generation failed for {len(batch)} conversations: {str(e)}")
+                metrics.increment("title_failed_total", len(batch))
+
+    def stats(self) -> Dict[str, float]:
+        with self.condition:
+            return {"title_queue_pending": len(self.pending)}
@@ -1,15 +1,16 @@
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_community.document_transformers import Html2TextTransformer
-from typing import List, Tuple
+from typing import Iterator, List, Tuple
 import html2text
 import zipfile
 import os
-import requests
 import re
-from io import BytesIO
+from UrlFetcher import UrlFetcher
+
+URL_PATTERN = re.compile(r'https?://[^\s]+')
 
 class UploadHandler:
-    def __init__(self, chunk_size: int = 1000):
+    def __init__(self, chunk_size: int = 1000, fetch_urls: bool = True):
         self.valid_file_types = ['.html', '.txt']
         self.html_transformer = Html2TextTransformer()
         self.chunk_size = chunk_size
@@ -26,15 +27,19 @@ class UploadHandler:
         self.h.ignore_emphasis = True
         with open('scrapingant.txt', 'r') as file:
             self.scraping_key = file.read().strip()
+        # pooled, rate limited fetching with retries and an on-disk page cache; handlers in parse workers do not
+        # fetch, they hand url lists back as ["urls", urls] so the per-host interval is kept by one fetcher per server
+        self.url_fetcher = UrlFetcher(self.scraping_key) if fetch_urls else None
         
         
-    def handle_file(self, file: bytes, filename: str):
+    def handle_file(self, file: bytes, filename: str, url_list: bool = None):
+        # url_list is decided from the start of the whole file when it is read in segments, see iter_file_segments
         file_extension = os.path.splitext(filename)[1]
         if file_extension in self.valid_file_types:
             if file_extension == '.html':
                 return self.handle_html(file, filename)
             elif file_extension == '.txt':
-                return self.handle_text(file, filename)
+                return self.handle_text(file, filename, url_list)
         else:
             return ["error", f"Error parsing {filename}: Unsupported file type {file_extension}"]
         
@@ -52,13 +57,19 @@ class UploadHandler:
         except Exception as e:
             return ["error", f"An error occurred while parsing {filename}: {str(e)}"]
         
-    def handle_text(self, file: bytes, filename: str):
+    def is_url_list(self, data: bytes) -> bool:
+        # a text file whose first line is a url is a list of urls to fetch
+        return bool(URL_PATTERN.match(data.split(b"\n", 1)[0].decode(errors="ignore")))
+
+    def handle_text(self, file: bytes, filename: str, url_list: bool = None):
         try:
+            if url_list is None:
+                url_list = self.is_url_list(file)
             text = file.decode()
-            lines = text.splitlines()
-            url_pattern = re.compile(r'https?://[^\s]+')
-            if lines and url_pattern.match(lines[0]):
-                urls = [line for line in lines if url_pattern.match(line)]
+            if url_list:
+                urls = [line for line in text.splitlines() if URL_PATTERN.match(line)]
+                if urls and self.url_fetcher is None:
+                    return ["urls", urls]
                 if urls:
                     return self.handle_urls(urls, filename)
                 else:
@@ -71,30 +82,95 @@ class UploadHandler:
         
         
     def handle_urls(self, urls: List[str], filename: str):
+        # the third element has one {url, status, message, attempts} entry per url, the upload
+        # succeeds when at least one page could be fetched and parsed. Unchanged pages are still chunked, the
+        # document being ingested references their chunks, but those keep their content hash ids and are
+        # neither embedded nor written again (see EmbeddingHandler.add_processed_documents)
         try:
             all_chunks = []
-            for url in urls:
-                params = {
-                    'url': url,
-                    'x-api-key': self.scraping_key,
-                    'proxy_country': 'US',
-                    'return_page_source': 'true'
-                }
-                response = requests.get('https://api.scrapingant.com/v2/general', params=params)
-                # print(f"Response status code: {response}")
-                data = response.text
-                # print(f"Data type: {data}")
-                parsed_html = self.h.handle(data)
-                chunks = self.text_splitter.split_text(parsed_html)
-                all_chunks.extend(chunks)
-            
-            return ["success", all_chunks]
+            url_results = []
+            for result in self.url_fetcher.fetch_all(urls):
+                if result.status != "error":
+                    try:
+                        parsed_html = self.h.handle(result.text)
+                        all_chunks.extend(self.text_splitter.split_text(parsed_html))
+                    except Exception as e:
+                        result.status, result.message = "error", f"Error parsing page: {str(e)}"
+                url_results.append(result.to_dict())
+            failed = [result for result in url_results if result["status"] == "error"]
+            if failed and len(failed) == len(url_results):
+                return ["error", f"None of the URLs from {filename} could be fetched, first error: {failed[0]['url']}: {failed[0]['message']}", url_results]
+            return ["success", all_chunks, url_results]
         except Exception as e:
             return ["error", f"An error occurred while parsing URLs from {filename}: {str(e)}"]
 
-    def extract_zip_contents(self, file: bytes) -> List[Tuple[str, str]]:
-        try:
-            with zipfile.ZipFile(BytesIO(file), 'r') as zip_ref:
-                return [(file, zip_ref.read(file).decode()) for file in zip_ref.namelist()]
-        except Exception as e:
-            return [("error", f"Failed to extract zip contents: {str(e)}")]
\ No newline at end of file
+    def list_zip_members(self, path: str) -> List[str]:
+        with zipfile.ZipFile(path, 'r') as zip_ref:
+            return [info.filename for info in zip_ref.infolist() if not info.is_dir()]
+
+    def iter_segments(self, path: str, filename: str, segment_bytes: int) -> Iterator[Tuple[str, bytes, bool, int, bool]]:
+        # lazily read a spooled upload as (member name, data, is last segment, member size, is url list) tuples,
+        # zip members are decompressed one at a time and nothing larger than one segment is held at once
+        if os.path.splitext(filename)[1] == '.zip':
+            with zipfile.ZipFile(path, 'r') as zip_ref:
+                for info in zip_ref.infolist():
+                    if info.is_dir():
+                        continue
+                    with zip_ref.open(info) as member:
+                        yield from self.iter_file_segments(member, info.filename, info.file_size, segment_bytes)
+        else:
+            with open(path, 'rb') as file:
+                yield from self.iter_file_segments(file, filename, os.path.getsize(path), segment_bytes)
+
+    def iter_file_segments(self, stream, filename: str, size: int, segment_bytes: int) -> Iterator[Tuple[str, bytes, bool, int, bool]]:
+        # html has to be parsed as a whole, so it is only accepted up to one segment in size
+        if os.path.splitext(filename)[1] == '.html' and size > segment_bytes:
+            raise ValueError(f"{filename} is larger than the {segment_bytes} byte limit for HTML files")
+
+        carry = b""
+
+        def read_segment():
+            # a full segment is cut after its last line break and the rest carried into the next one,
+            # so no segment is ever larger than segment_bytes, however long the lines are
+            nonlocal carry
+            data = carry + stream.read(segment_bytes - len(carry))
+            carry = b""
+            if len(data) == segment_bytes:
+                cut = segment_boundary(data) or len(data)
+                data, carry = data[:cut], data[cut:]
+            return data
+
+        data = read_segment()
+        # whether a text file is a url list is decided once from its first segment, every later segment
+        # is then handled the same way, whatever line it happens to start with
+        url_list = os.path.splitext(filename)[1] == '.txt' and self.is_url_list(data)
+        while True:
+            next_data = read_segment()
+            yield filename, data, not next_data, size, url_list
+            if not next_data:
+                break
+            data = next_data
+
+def segment_boundary(data: bytes) -> int:
+    # offset right after the last line break, or for a segment without any, before a trailing incomplete utf-8 character
+    newline = data.rfind(b"\n")
+    if newline >= 0:
+        return newline + 1
+    for index in range(len(data) - 1, max(len(data) - 4, 0) - 1, -1):
+        byte = data[index]
+        if byte & 0xC0 != 0x80:
+            # ascii or the lead byte of a multi-byte character, which says how long the character is
+            length = 1 if byte < 0x80 else 2 if byte >> 5 == 0b110 else 3 if byte >> 4 == 0b1110 else 4
+            return index if index + length > len(data) else len(data)
+    return len(data)
+
+# per-process handler used by the parsing pool, created once in each worker process
+worker_upload_handler = None
+
+def init_parse_worker(chunk_size: int = 1000):
+    global worker_upload_handler
+    worker_upload_handler = UploadHandler(chunk_size=chunk_size, fetch_urls=False)
+
+def parse_file(filename: str, file: bytes, url_list: bool = None):
+    # runs in a pool worker: parse and chunk a single file, url lists are returned unfetched
+    return worker_upload_handler.handle_file(file, filename, url_list)
@@ -0,0 +1,143 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+from urllib.parse import urlparse
+import hashlib
+import json
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+class FetchResult:
+    def __init__(self, url: str, status: str, text: str = "", message: str = "", attempts: int = 0):
+        self.url = url
+        # fetched | unchanged | error
+        self.status = status
+        self.text = text
+        self.message = message
+        self.attempts = attempts
+
+    def to_dict(self) -> Dict[str, any]:
+        return {"url": self.url, "status": self.status, "message": self.message, "attempts": self.attempts}
+
+class PageCache:
+    def __init__(self, directory: str = "./pagecache"):
+        # one metadata file and one body file per url, named by the hash of the url
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, url: str, extension: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(url.encode()).hexdigest() + extension)
+
+    def get(self, url: str) -> Dict[str, any]:
+        try:
+            with open(self.path(url, ".json"), "r") as file:
+                entry = json.load(file)
+            with open(self.path(url, ".html"), "r", encoding="utf-8") as file:
+                entry["text"] = file.read()
+            return entry
+        except (OSError, ValueError):
+            return None
+
+    def put(self, url: str, text: str, etag: str = None, last_modified: str = None) -> str:
+        content_hash = hashlib.sha256(text.encode()).hexdigest()
+        entry = {"url": url, "etag": etag, "last_modified": last_modified, "content_hash": content_hash, "fetched_at": time.time()}
+        # write to temporary files first, parse workers in other processes may read the same url
+        for extension, data in ((".html", text), (".json", json.dumps(entry))):
+            temporary = f"{self.path(url, extension)}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temporary, "w", encoding="utf-8") as file:
+                file.write(data)
+            os.replace(temporary, self.path(url, extension))
+        return content_hash
+
+class UrlFetcher:
+    def __init__(self, scraping_key: str = None, endpoint: str = "https://api.scrapingant.com/v2/general", max_workers: int = 8, host_interval: float = 0.5,
+                 timeout: float = 60, retries: int = 3, backoff: float = 1.0, cache_dir: str = "./pagecache", max_age: float = None):
+        # pages go through the scraping proxy when there is a key, otherwise they are requested directly
+        self.scraping_key = scraping_key
+        self.endpoint = endpoint
+        self.max_workers = max_workers
+        # minimum seconds between two requests for pages of the same host
+        self.host_interval = host_interval
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        # cached pages younger than max_age seconds are used without asking the server again. Direct requests
+        # revalidate every time by default, a 304 costs next to nothing; the scraping proxy sends no conditional
+        # headers to the site and every request through it is paid, so by default its pages are kept for a day
+        if max_age is None:
+            max_age = 24 * 60 * 60 if scraping_key else 0
+        self.max_age = max_age
+        self.cache = PageCache(cache_dir)
+        # one pooled session shared by the worker threads
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.next_request: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def fetch_all(self, urls: List[str]) -> List[FetchResult]:
+        # one result per url in input order, a failing url never fails the others
+        if not urls:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(urls)), thread_name_prefix="fetch") as executor:
+            return list(executor.map(self.fetch, urls))
+
+    def wait_for_host(self, url: str):
+        # reserve the next slot for the host, then sleep outside the lock until it comes up
+        host = urlparse(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_request.get(host, now))
+            self.next_request[host] = slot + self.host_interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def request(self, url: str, cached: Dict[str, any]) -> requests.Response:
+        if self.scraping_key:
+            # the proxy fetches the page in full every time, cached copies are only reused within max_age
+            params = {
+                'url': url,
+                'x-api-key': self.scraping_key,
+                'proxy_country': 'US',
+                'return_page_source': 'true'
+            }
+            return self.session.get(self.endpoint, params=params, timeout=self.timeout)
+        # conditional request, the server answers 304 when the cached copy is still current
+        headers = {}
+        if cached and cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached and cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+        return self.session.get(url, headers=headers, timeout=self.timeout)
+
+    def fetch(self, url: str) -> FetchResult:
+        cached = self.cache.get(url)
+        if cached and time.time() - cached["fetched_at"] < self.max_age:
+            return FetchResult(url, "unchanged", cached["text"], "Served from the page cache", 0)
+        message = ""
+        for attempt in range(1, self.retries + 2):
+            self.wait_for_host(url)
+            try:
+                response = self.request(url, cached)
+                if response.status_code == 304 and cached:
+                    self.cache.put(url, cached["text"], cached.get("etag"), cached.get("last_modified"))
+                    return FetchResult(url, "unchanged", cached["text"], "Not modified", attempt)
+                if response.status_code == 429 or response.status_code >= 500:
+                    message = f"HTTP {response.status_code}"
+                elif response.status_code >= 400:
+                    # client errors will not go away by asking again
+                    return FetchResult(url, "error", message=f"HTTP {response.status_code}", attempts=attempt)
+                else:
+                    text = response.text
+                    content_hash = self.cache.put(url, text, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+                    status = "unchanged" if cached and cached.get("content_hash") == content_hash else "fetched"
+                    return FetchResult(url, status, text, "", attempt)
+            except requests.RequestException as e:
+                message = str(e)
+            if attempt <= self.retries:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+        return FetchResult(url, "error", message=f"Failed after {self.retries + 1} attempts: {message}", attempts=self.retries + 1)
@@ -286,7 +286,7 @@ export function MainChat({ collection_id, conversation_id }: MainChatProps) {
             </div>
           </div>
           <div className="flex items-center gap-1 flex-grow justify-center">
-            <ModelSelector />
+            <ModelSelector userId={user?.sub} />
           </div>
           <div>
             <UserProfileDropdown />
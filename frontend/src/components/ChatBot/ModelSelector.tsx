@@ -20,7 +20,7 @@ const modelOptions: ModelOption[] = [
   { id: '8', title: 'Claude 3: Haiku', endpoint: 'anthropic/claude-3-haiku:beta', logo: '/modelLogos/anthropic.png', category: 'Paid' },
 ];
 
-const ModelSelector: React.FC<{ selectedModel?: ModelOption; onSelectModel?: (model: ModelOption) => void }> = ({ selectedModel, onSelectModel }) => {
+const ModelSelector: React.FC<{ selectedModel?: ModelOption; onSelectModel?: (model: ModelOption) => void; userId?: string | null }> = ({ selectedModel, onSelectModel, userId }) => {
   const [isOpen, setIsOpen] = useState(false);
   const [currentModel, setCurrentModel] = useState<ModelOption>(selectedModel || modelOptions[0]);
   const [includePaidModels, setIncludePaidModels] = useState(false);
@@ -41,6 +41,23 @@ const ModelSelector: React.FC<{ selectedModel?: ModelOption; onSelectModel?: (mo
 
     fetchPaidStatus();
 
+    // the model is saved per user, show the one this user picked last time
+    const fetchUserModel = async () => {
+      if (!userId) return;
+      try {
+        const response = await fetch(`/api/chat/get_user_model?user_id=${encodeURIComponent(userId)}`);
+        const data = await response.json();
+        const savedModel = modelOptions.find(model => model.endpoint === data.model);
+        if (savedModel) {
+          setCurrentModel(savedModel);
+        }
+      } catch (error) {
+        console.error('Error fetching user model:', error);
+      }
+    };
+
+    fetchUserModel();
+
     const handleClickOutside = (event: MouseEvent) => {
       if (ref.current && !ref.current.contains(event.target as Node)) {
         setIsOpen(false);
@@ -51,9 +68,15 @@ const ModelSelector: React.FC<{ selectedModel?: ModelOption; onSelectModel?: (mo
     return () => {
       document.removeEventListener('mousedown', handleClickOutside);
     };
-  }, [ref]);
+  }, [ref, userId]);
 
   const handleModelSelect = async (model: ModelOption) => {
+    // the model is saved for the signed in user, nothing is sent until the user is known
+    if (!userId) {
+      console.warn('Model not changed, the user is not loaded yet');
+      setIsOpen(false);
+      return;
+    }
     setCurrentModel(model);
     onSelectModel?.(model);
     setIsOpen(false);
@@ -63,7 +86,7 @@ const ModelSelector: React.FC<{ selectedModel?: ModelOption; onSelectModel?: (mo
         headers: {
           'Content-Type': 'application/json',
         },
-        body: JSON.stringify({ model_name: model.endpoint }),
+        body: JSON.stringify({ model_name: model.endpoint, user_id: userId }),
       });
       const data = await response.json();
       if (!response.ok) {
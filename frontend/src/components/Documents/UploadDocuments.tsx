@@ -268,6 +268,22 @@ const UploadDocuments: React.FC<UploadDocumentsProps> = ({ collectionId }) => {
           console.log("Collection created successfully, processing files...");
           console.log("Files:", files);
           console.log("URLs:", urls);
+          // poll the backend until a queued processing job has finished; an unknown job (e.g. after a
+          // backend restart) or a job still running after maxPolls seconds is reported as a failure
+          const waitForJob = async (jobId: string, maxPolls: number = 1800) => {
+            for (let poll = 0; poll < maxPolls; poll++) {
+              await new Promise(resolve => setTimeout(resolve, 1000));
+              const response = await fetch(`http://localhost:8000/get_job_status/?job_id=${jobId}`);
+              const job = await response.json();
+              if (!response.ok) {
+                return { status: "error", message: job.detail || `Job status request failed with HTTP ${response.status}` };
+              }
+              if (job.status === "success" || job.status === "error") {
+                return job;
+              }
+            }
+            return { status: "error", message: `Processing did not finish within ${maxPolls} seconds` };
+          };
           // send validated files to the backend for processing
           const processItem = async (item: File | string, type: 'file' | 'url') => {
             const itemName = typeof item === 'string' ? item : item.name;
@@ -285,7 +301,10 @@ const UploadDocuments: React.FC<UploadDocumentsProps> = ({ collectionId }) => {
                       method: 'POST',
                       body: formData,
                     });
-                    const result = await response.json();
+                    let result = await response.json();
+                    if (result.status === "queued") {
+                      result = await waitForJob(result.job_id);
+                    }
                     if (result.status === "success") {
                       console.log(`File ${itemName} processed successfully:`, result);
                       fileUrlItemsRef.current[itemName].completeProcessing = () => true;
@@ -315,7 +334,10 @@ const UploadDocuments: React.FC<UploadDocumentsProps> = ({ collectionId }) => {
                       method: 'POST',
                       body: formData,
                     });
-                    const result = await response.json();
+                    let result = await response.json();
+                    if (result.status === "queued") {
+                      result = await waitForJob(result.job_id);
+                    }
                     if (result.status === "success") {
                       console.log(`URL ${itemName} processed successfully:`, result);
                       fileUrlItemsRef.current[itemName].completeProcessing = () => true;
@@ -7,12 +7,24 @@ export default async function handler(
   if (req.method === 'POST') {
     try {
       console.log('chat endpoint: Initiating fetch request', req.body);
+      // when the browser goes away the backend request is aborted too, so the backend stops generating;
+      // res 'close' before the response was ended means the client disconnected (req 'close' also fires
+      // once the request body has been read, so it cannot tell a disconnect apart)
+      const controller = new AbortController();
+      let reader: ReadableStreamDefaultReader<Uint8Array> | undefined;
+      res.on('close', () => {
+        if (!res.writableEnded) {
+          controller.abort();
+          reader?.cancel().catch(() => {});
+        }
+      });
       const response = await fetch('http://localhost:8000/chat/', {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
         },
         body: JSON.stringify(req.body),
+        signal: controller.signal,
       });
 
       if (!response.ok) {
@@ -21,7 +33,8 @@ export default async function handler(
       }
 
       if (response.body) {
-        const reader = response.body.getReader();
+        reader = response.body.getReader();
+        const bodyReader = reader;
         const decoder = new TextDecoder('utf-8');
 
         const processText = async ({ done, value }: ReadableStreamReadResult<Uint8Array>): Promise<void> => {
@@ -32,15 +45,25 @@ export default async function handler(
           const chunk = decoder.decode(value, { stream: true });
           // console.log('Sending chunk:', chunk); // added printout for debugging
           res.write(chunk);
-          const next = await reader.read();
+          const next = await bodyReader.read();
           return processText(next);
         };
 
-        reader.read().then(processText);
+        bodyReader.read().then(processText).catch((error) => {
+          if (controller.signal.aborted) {
+            console.log('chat endpoint: client disconnected, backend request aborted');
+          } else {
+            console.error('Error streaming response from FastAPI:', error);
+          }
+          res.end();
+        });
       } else {
         res.status(500).json({ message: 'Backend service error.' });
       }
     } catch (error) {
+      if (res.writableEnded || res.destroyed) {
+        return;
+      }
       console.error('Error forwarding request to FastAPI:', error);
       res.status(500).json({ message: 'Error processing chat request.' });
     }
@@ -0,0 +1,19 @@
+import { NextApiRequest, NextApiResponse } from 'next';
+
+export default async function handler(req: NextApiRequest, res: NextApiResponse) {
+  if (req.method === 'GET') {
+    const { user_id } = req.query;
+
+    try {
+      const response = await fetch(`http://localhost:8000/get_user_model/?user_id=${encodeURIComponent(user_id as string)}`);
+      const data = await response.json();
+
+      res.status(200).json(data);
+    } catch (error) {
+      console.error('Error fetching user model:', error);
+      res.status(500).json({ error: 'Failed to fetch user model' });
+    }
+  } else {
+    res.status(405).json({ error: 'Method not allowed' });
+  }
+}
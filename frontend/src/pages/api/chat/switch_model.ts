@@ -5,9 +5,14 @@ export default async function handler(
   res: NextApiResponse
 ) {
   if (req.method === 'POST') {
+    if (!req.body.user_id) {
+      res.status(400).json({ message: 'A user_id is required to update the model.' });
+      return;
+    }
     try {
       const modelUpdateData = {
         name_of_model: req.body.model_name,
+        user_id: req.body.user_id,
       };
 
       const response = await fetch('http://localhost:8000/update_model/', {